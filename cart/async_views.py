@@ -0,0 +1,111 @@
+"""
+Async variants of the hot cart endpoints, served instead of the DRF views when
+``CART_ASYNC_VIEWS`` is on (the default under ``cart_service.asgi``).
+
+Reads stay on the event loop: Redis is read with ``redis.asyncio`` and a cache miss goes to
+the async ORM; only re-rendering a cart's stored view takes a worker thread. Writes keep their DRF views, whose row locks and transactions Django can
+only run synchronously; each one is a single hop to a worker thread, so the loop goes on
+serving other requests meanwhile. Methods without an async variant go to the DRF view too.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+
+from . import snapshot, store, views
+from .conditional import acached_cart_response
+from .models import Cart
+from .serializers import RetrieveCartSerializer
+from .warmup import warm_cart_after_miss
+
+logger = logging.getLogger(__name__)
+
+retrieve_delete_cart_view = views.RetrieveDeleteCartView.as_view()
+retrieve_user_cart_view = views.RetrieveUserCartView.as_view()
+add_cart_item_view = views.AddCartItemView.as_view()
+cart_item_view = views.RetrieveUpdateDestroyCartItemView.as_view()
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(JSONRenderer().render(data), status=status_code, content_type='application/json')
+
+
+def not_found():
+    return json_response({'detail': 'Not found.'}, status_code=status.HTTP_404_NOT_FOUND)
+
+
+def csrf_exempt(view):
+    # like the DRF views; Django 4.2's decorator would hide that the view is a coroutine function
+    view.csrf_exempt = True
+    return view
+
+
+async def in_thread(view, request, **kwargs):
+    # thread-sensitive, so each request's sync work shares one thread and its DB connection
+    return await sync_to_async(view)(request, **kwargs)
+
+
+async def acached_cart_response_after_miss(request, cart_id):
+    # cached again from the DB, so the cart has an ETag to send with If-Match
+    if not await sync_to_async(warm_cart_after_miss)(cart_id) or not settings.CART_VIEW_CACHE:
+        return None
+    return await acached_cart_response(request, cart_id=cart_id)
+
+
+@csrf_exempt
+async def retrieve_delete_cart(request, pk):
+    if request.method != 'GET':
+        return await in_thread(retrieve_delete_cart_view, request, pk=pk)
+
+    if settings.CART_VIEW_CACHE:
+        response = await acached_cart_response(request, cart_id=pk)
+        if response is not None:
+            return response
+
+    cart = await store.aload_cart_document(pk)
+    if cart is None:
+        logger.warning(f"Cart with ID {pk} not found in Redis, checking DB")
+        response = await acached_cart_response_after_miss(request, pk)
+        if response is not None:
+            return response
+        cart = await snapshot.abuild_cart_document(pk)
+        if cart is None:
+            return not_found()
+    return json_response(RetrieveCartSerializer(cart).data)
+
+
+@csrf_exempt
+async def retrieve_user_cart(request, user_id):
+    if request.method != 'GET':
+        return await in_thread(retrieve_user_cart_view, request, user_id=user_id)
+
+    if settings.CART_VIEW_CACHE:
+        response = await acached_cart_response(request, user_id=user_id)
+        if response is not None:
+            return response
+
+    cart = await store.aload_user_cart_document(user_id)
+    if cart is None:
+        logger.warning(f"Cart with ID {user_id} not found in Redis, checking DB")
+        cart_id = await Cart.objects.filter(user_id=user_id).values_list('pk', flat=True).afirst()
+        if cart_id is not None:
+            response = await acached_cart_response_after_miss(request, cart_id)
+            if response is not None:
+                return response
+        cart = await snapshot.abuild_cart_document(cart_id) if cart_id else None
+        if cart is None:
+            return not_found()
+    return json_response(RetrieveCartSerializer(cart).data)
+
+
+@csrf_exempt
+async def add_cart_item(request, pk):
+    return await in_thread(add_cart_item_view, request, pk=pk)
+
+
+@csrf_exempt
+async def cart_item(request, cart_id, pk):
+    return await in_thread(cart_item_view, request, cart_id=cart_id, pk=pk)
@@ -0,0 +1,224 @@
+import logging
+import time
+import uuid
+from collections import Counter
+
+from . import snapshot, store
+from .connection import redis_client
+from .listing import CART_INDEX_KEY, CART_ITEM_INDEX_KEY, ITEM_OPTION_INDEX_KEY, prune_index
+from .models import Cart, CartItem, ItemOption
+from .queries import carts_with_items
+
+logger = logging.getLogger(__name__)
+
+
+class Throttle:
+    """Sleeps between batches so that no more than ``rate`` keys or rows are processed per second (0 = no limit)."""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.processed = 0
+
+    def __call__(self, count):
+        self.processed += count
+        if self.rate:
+            ahead = self.processed / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def scan_batches(pattern, batch_size):
+    """Yield the keys matching ``pattern`` in lists of up to ``batch_size``, with a SCAN cursor."""
+    batch = []
+    for key in redis_client.scan_iter(match=pattern, count=batch_size):
+        batch.append(key.decode('utf-8'))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_uuids(values):
+    parsed = set()
+    for value in values:
+        try:
+            parsed.add(str(uuid.UUID(value)))
+        except ValueError:
+            pass
+    return parsed
+
+
+def existing_cart_ids(cart_ids):
+    valid = parse_uuids(cart_ids)
+    return {str(pk) for pk in Cart.objects.filter(pk__in=valid).values_list('pk', flat=True)}
+
+
+def document_fingerprint(document):
+    """What must agree between the cached and the DB copy of a cart; timestamps are left out."""
+    return (
+        document['user_id'] or None,
+        document['total_quantity'],
+        sorted(
+            (str(item['id']), item['prod_id'], item['quantity'], item['is_active'],
+             sorted((str(option['id']), option['attribute'], option['value']) for option in item['item_options']))
+            for item in document['cart_items']
+        ),
+    )
+
+
+class CartStoreAuditor:
+    """
+    Compares the cart keys in Redis with the rows in the DB and, with ``repair``, fixes what disagrees.
+
+    Redis is walked with SCAN and the DB with a server-side cursor, ``batch_size`` keys or rows
+    at a time, so memory stays bounded. Each batch costs one pipelined Redis round trip and at
+    most a few queries, and ``throttle`` spaces the batches out. Findings are counted in
+    ``stats`` under ``{check}.{finding}``.
+    """
+    CHECKS = ('carts', 'drift', 'user_pointers', 'lines', 'items', 'options', 'indexes')
+
+    def __init__(self, repair=False, batch_size=500, throttle=None):
+        self.repair = repair
+        self.batch_size = batch_size
+        self.throttle = throttle or Throttle()
+        self.stats = Counter()
+
+    def run(self, checks=None):
+        for name in checks or self.CHECKS:
+            started = time.monotonic()
+            getattr(self, f'check_{name}')()
+            yield name, time.monotonic() - started
+
+    def check_carts(self):
+        """Cached carts whose DB row is gone, and carts cached in the layout not in use."""
+        active = store.get_layout()
+        for layout in store.LAYOUTS.values():
+            prefix = layout.key('')
+            for keys in scan_batches(f'{prefix}*', self.batch_size):
+                cart_ids = [key[len(prefix):] for key in keys]
+                self.stats['carts.scanned'] += len(cart_ids)
+                if layout is active:
+                    existing = existing_cart_ids(cart_ids)
+                    orphans = [cart_id for cart_id in cart_ids if cart_id not in existing]
+                    self.stats['carts.orphaned'] += len(orphans)
+                else:
+                    orphans = cart_ids
+                    self.stats['carts.stale_layout'] += len(orphans)
+                if orphans and self.repair:
+                    documents = layout.load_carts(orphans)
+                    with store.write_batch() as pipe:
+                        for cart_id, document in zip(orphans, documents):
+                            pipe.delete(layout.key(cart_id))
+                            if layout is active and document is not None:
+                                store.delete_cart(pipe, cart_id, document['user_id'], document['cart_items'])
+                    self.stats['carts.repaired'] += len(orphans)
+                self.throttle(len(cart_ids))
+
+    def check_drift(self):
+        """Carts whose cached copy disagrees with the DB; repaired by rewriting the cache from the DB."""
+        cart_ids = Cart.objects.order_by().values_list('pk', flat=True).iterator(chunk_size=self.batch_size)
+        batch = []
+        for cart_id in cart_ids:
+            batch.append(str(cart_id))
+            if len(batch) >= self.batch_size:
+                self._check_drift(batch)
+                batch = []
+        if batch:
+            self._check_drift(batch)
+
+    def _check_drift(self, cart_ids):
+        self.stats['drift.checked'] += len(cart_ids)
+        cached = {
+            document['id']: document
+            for document in store.load_cart_documents(cart_ids) if document is not None
+        }
+        self.stats['drift.uncached'] += len(cart_ids) - len(cached)
+        if cached:
+            for cart in carts_with_items(Cart.objects.filter(pk__in=list(cached))):
+                if document_fingerprint(snapshot.build_cart_document(cart)) == document_fingerprint(cached[str(cart.pk)]):
+                    continue
+                self.stats['drift.drifted'] += 1
+                logger.warning(f"Cart {cart.pk} differs between Redis and the DB")
+                if self.repair:
+                    cart.save_cart_to_redis()
+                    self.stats['drift.repaired'] += 1
+        self.throttle(len(cart_ids))
+
+    def check_user_pointers(self):
+        """``cart:user:*`` pointers to a cart that is gone or belongs to someone else."""
+        prefix = store.user_cart_key('')
+        for keys in scan_batches(f'{prefix}*', self.batch_size):
+            self.stats['user_pointers.scanned'] += len(keys)
+            targets = {}
+            for key, value in zip(keys, redis_client.mget(keys)):
+                # full copies from before the key became a pointer are checked as carts on their next read
+                if value and value[:1] not in (b'{', b'\x01'):
+                    targets[key] = value.decode('utf-8')
+            owners = dict(
+                (str(pk), user_id) for pk, user_id in
+                Cart.objects.filter(pk__in=parse_uuids(targets.values())).values_list('pk', 'user_id')
+            )
+            orphans = [key for key, cart_id in targets.items() if owners.get(cart_id, '') != key[len(prefix):]]
+            self._delete_keys('user_pointers', orphans)
+            self.throttle(len(keys))
+
+    def check_lines(self):
+        """``cart:lines:*`` indexes left behind by a cart that is no longer cached."""
+        prefix = store.cart_lines_key('')
+        layout = store.get_layout()
+        for keys in scan_batches(f'{prefix}*', self.batch_size):
+            self.stats['lines.scanned'] += len(keys)
+            pipe = redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.exists(layout.key(key[len(prefix):]))
+            orphans = [key for key, exists in zip(keys, pipe.execute()) if not exists]
+            self._delete_keys('lines', orphans)
+            self.throttle(len(keys))
+
+    def check_items(self):
+        """``cart_item:*`` copies of items that are gone or now belong to another cart."""
+        self._check_side_keys('items', store.cart_item_key(''), None, CartItem._base_manager, 'cart_id')
+        self._check_side_keys('items', 'cart_item:cart:', 'cart_id', CartItem._base_manager, 'cart_id')
+
+    def check_options(self):
+        """``item_option:*`` copies of options that are gone or now belong to another item."""
+        self._check_side_keys('options', store.item_option_key(''), None, ItemOption.objects, 'cart_item_id')
+        self._check_side_keys('options', 'item_option:cart_item:', 'cart_item_id', ItemOption.objects, 'cart_item_id')
+
+    def _check_side_keys(self, check, prefix, parent, manager, parent_field):
+        # keys are '{prefix}{id}', or '{prefix}{parent id}:{id}' when ``parent`` is set
+        for keys in scan_batches(f'{prefix}*', self.batch_size):
+            self.stats[f'{check}.scanned'] += len(keys)
+            parsed = {}
+            for key in keys:
+                parent_id, _, object_id = key[len(prefix):].rpartition(':')
+                if object_id.isdigit():
+                    parsed[key] = (parent_id, int(object_id))
+            rows = dict(
+                manager.filter(pk__in=[object_id for _, object_id in parsed.values()]).values_list('pk', parent_field)
+            )
+            orphans = [
+                key for key in keys
+                if key not in parsed or parsed[key][1] not in rows
+                or (parent and str(rows[parsed[key][1]]) != parsed[key][0])
+            ]
+            self._delete_keys(check, orphans)
+            self.throttle(len(keys))
+
+    def check_indexes(self):
+        """Entries of the listing indexes whose key has expired or was deleted."""
+        for index_key, document_key in (
+            (CART_INDEX_KEY, store.get_layout().key), (CART_ITEM_INDEX_KEY, None), (ITEM_OPTION_INDEX_KEY, None),
+        ):
+            stale = prune_index(index_key, document_key, self.batch_size, dry_run=not self.repair)
+            self.stats['indexes.orphaned'] += stale
+            if self.repair:
+                self.stats['indexes.repaired'] += stale
+
+    def _delete_keys(self, check, keys):
+        self.stats[f'{check}.orphaned'] += len(keys)
+        if keys and self.repair:
+            redis_client.delete(*keys)
+            self.stats[f'{check}.repaired'] += len(keys)
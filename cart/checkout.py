@@ -0,0 +1,54 @@
+from decimal import Decimal
+
+from .models import CartItem
+from .products import get_product_client
+
+
+def price_cart(cart_document, client=None):
+    """
+    Price the active lines of a cart document.
+
+    Every product is looked up in one ``fetch_many`` call, so latency follows the
+    client's concurrency rather than the number of lines. Line totals use
+    ``CartItem.sub_total``. Lines whose product is unknown, unavailable or short of
+    stock are listed under ``unavailable`` and left out of ``total_price``.
+    """
+    cart_items = [cart_item for cart_item in cart_document['cart_items'] if cart_item['is_active']]
+    products = (client or get_product_client()).fetch_many(cart_item['prod_id'] for cart_item in cart_items)
+
+    lines, unavailable = [], []
+    total_price = Decimal('0')
+    for cart_item_data in cart_items:
+        product = products.get(str(cart_item_data['prod_id']))
+        quantity = cart_item_data['quantity']
+        if product is None:
+            reason = 'unknown product'
+        elif not product['available']:
+            reason = 'out of stock'
+        elif product['stock'] is not None and product['stock'] < quantity:
+            reason = f"only {product['stock']} in stock"
+        else:
+            reason = None
+
+        line = {
+            'cart_item_id': cart_item_data['id'],
+            'prod_id': cart_item_data['prod_id'],
+            'quantity': quantity,
+            'unit_price': product['price'] if product else None,
+            'sub_total': None,
+            'available': reason is None,
+        }
+        if reason is None:
+            line['sub_total'] = CartItem(quantity=quantity).sub_total(product['price'])
+            total_price += line['sub_total']
+        else:
+            unavailable.append({'cart_item_id': line['cart_item_id'], 'prod_id': line['prod_id'], 'reason': reason})
+        lines.append(line)
+
+    return {
+        'cart_id': cart_document['id'],
+        'lines': lines,
+        'total_quantity': sum(cart_item['quantity'] for cart_item in cart_items),
+        'total_price': total_price,
+        'unavailable': unavailable,
+    }
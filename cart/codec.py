@@ -0,0 +1,188 @@
+import json
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import msgpack
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_datetime
+
+# First byte of every binary payload. JSON documents always start with '{' or '[', so
+# entries written before the codec existed are still read transparently. The other bytes
+# below '\t' are kept for later binary versions.
+MSGPACK_V1 = b'\x01'
+
+CART_FIELDS = {'id', 'user_id', 'cart_items', 'total_quantity', 'created_at', 'modified_at'}
+ITEM_FIELDS = {'id', 'cart_id', 'prod_id', 'quantity', 'is_active', 'created_at', 'modified_at', 'item_options'}
+OPTION_FIELDS = {'id', 'cart_item_id', 'attribute', 'value', 'created_at', 'modified_at'}
+
+KIND_CART, KIND_ITEM, KIND_OPTION, KIND_OTHER = 0, 1, 2, 3
+
+_json_encoder = DjangoJSONEncoder()
+
+
+class JSONCodec:
+    """The original format: ``DjangoJSONEncoder`` output, no version byte."""
+    name = 'json'
+
+    def encode(self, document):
+        return json.dumps(document, cls=DjangoJSONEncoder)
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+
+class MsgpackCodec:
+    """
+    Compact binary format, version 1.
+
+    Cart, item and option documents are stored as positional msgpack arrays instead of
+    maps, and timestamps as integer microseconds since the epoch. The ``cart_id`` /
+    ``cart_item_id`` fields of nested items and options are stored as nil when they
+    repeat the parent's ID and restored on decode. Anything else is stored as a plain
+    msgpack map.
+    """
+    name = 'msgpack'
+
+    def encode(self, document):
+        return MSGPACK_V1 + msgpack.packb(self._pack(document), use_bin_type=True)
+
+    def decode(self, raw):
+        return self._unpack(msgpack.unpackb(raw[1:], raw=False))
+
+    def _pack(self, document):
+        if isinstance(document, dict):
+            if _is_cart(document):
+                return [KIND_CART, *self._pack_cart(document)]
+            if _is_item(document):
+                return [KIND_ITEM, document['cart_id'], *self._pack_item(document, document['cart_id'])]
+            if set(document) == OPTION_FIELDS:
+                return [KIND_OPTION, document['cart_item_id'], *self._pack_option(document, document['cart_item_id'])]
+        return [KIND_OTHER, json.loads(json.dumps(document, cls=DjangoJSONEncoder))]
+
+    def _unpack(self, packed):
+        kind, *values = packed
+        if kind == KIND_CART:
+            return self._unpack_cart(values)
+        if kind == KIND_ITEM:
+            cart_id, *values = values
+            return self._unpack_item(values, cart_id)
+        if kind == KIND_OPTION:
+            cart_item_id, *values = values
+            return self._unpack_option(values, cart_item_id)
+        return values[0]
+
+    def _pack_cart(self, cart):
+        return [
+            cart['id'], cart['user_id'], cart['total_quantity'],
+            _pack_timestamp(cart['created_at']), _pack_timestamp(cart['modified_at']),
+            [self._pack_item(cart_item, cart['id']) for cart_item in cart['cart_items']],
+        ]
+
+    def _unpack_cart(self, values):
+        cart_id, user_id, total_quantity, created_at, modified_at, cart_items = values
+        return {
+            'id': cart_id,
+            'user_id': user_id,
+            'cart_items': [self._unpack_item(cart_item, cart_id) for cart_item in cart_items],
+            'total_quantity': total_quantity,
+            'created_at': _unpack_timestamp(created_at),
+            'modified_at': _unpack_timestamp(modified_at),
+        }
+
+    def _pack_item(self, cart_item, parent_id=None):
+        return [
+            cart_item['id'], _pack_reference(cart_item['cart_id'], parent_id),
+            cart_item['prod_id'], cart_item['quantity'], cart_item['is_active'],
+            _pack_timestamp(cart_item['created_at']), _pack_timestamp(cart_item['modified_at']),
+            [self._pack_option(option, cart_item['id']) for option in cart_item['item_options']],
+        ]
+
+    def _unpack_item(self, values, parent_id):
+        cart_item_id, cart_id, prod_id, quantity, is_active, created_at, modified_at, item_options = values
+        return {
+            'id': cart_item_id,
+            'cart_id': cart_id or parent_id,
+            'prod_id': prod_id,
+            'quantity': quantity,
+            'is_active': is_active,
+            'created_at': _unpack_timestamp(created_at),
+            'modified_at': _unpack_timestamp(modified_at),
+            'item_options': [self._unpack_option(option, cart_item_id) for option in item_options],
+        }
+
+    def _pack_option(self, option, parent_id=None):
+        return [
+            option['id'], _pack_reference(option['cart_item_id'], parent_id), option['attribute'], option['value'],
+            _pack_timestamp(option['created_at']), _pack_timestamp(option['modified_at']),
+        ]
+
+    def _unpack_option(self, values, parent_id):
+        item_option_id, cart_item_id, attribute, value, created_at, modified_at = values
+        return {
+            'id': item_option_id,
+            'cart_item_id': cart_item_id or parent_id,
+            'attribute': attribute,
+            'value': value,
+            'created_at': _unpack_timestamp(created_at),
+            'modified_at': _unpack_timestamp(modified_at),
+        }
+
+
+def _is_item(document):
+    return set(document) == ITEM_FIELDS and all(set(option) == OPTION_FIELDS for option in document['item_options'])
+
+
+def _is_cart(document):
+    return set(document) == CART_FIELDS and all(_is_item(cart_item) for cart_item in document['cart_items'])
+
+
+def _pack_reference(value, parent_id):
+    # a child pointing at its own parent is the common case; store nil instead of repeating the ID
+    return None if value == parent_id else value
+
+
+# Timestamp conversion dominates the cost of this codec, and the same cart is re-encoded and
+# re-decoded on every access, so conversions are memoised.
+@lru_cache(maxsize=16384)
+def _pack_timestamp(value):
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if value is None:
+        return None
+    delta = value - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+@lru_cache(maxsize=16384)
+def _unpack_timestamp(value):
+    if value is None:
+        return None
+    seconds, microseconds = divmod(value, 1000000)
+    moment = datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=microseconds)
+    # same string the JSON codec would have produced
+    return _json_encoder.default(moment)
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), MsgpackCodec())}
+
+
+def get_codec():
+    return CODECS[getattr(settings, 'CART_CACHE_CODEC', 'json')]
+
+
+def encode(document):
+    """Encode with the codec selected by the ``CART_CACHE_CODEC`` setting."""
+    return get_codec().encode(document)
+
+
+def decode(raw):
+    """
+    Decode any supported format, picking the codec from the payload's first byte. Raises
+    ``ValueError`` for a binary version this code does not know, as written by a newer one.
+    """
+    if raw[:1] == MSGPACK_V1:
+        return CODECS['msgpack'].decode(raw)
+    if isinstance(raw, bytes) and raw[:1] < b'\t':
+        raise ValueError(f"Unknown cache payload version {raw[:1]!r}")
+    return CODECS['json'].decode(raw)
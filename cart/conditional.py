@@ -0,0 +1,135 @@
+import logging
+import uuid
+from functools import wraps
+
+import redis
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from . import store
+from .unit_of_work import after_flush
+
+logger = logging.getLogger(__name__)
+
+
+def etag_matches(header, etag):
+    etags = parse_etags(header or '')
+    return etag is not None and (etag in etags or '*' in etags)
+
+
+def cart_view_response(request, etag, body):
+    """
+    A response with a cart's rendered view (see ``store.load_cart_view``) as its body and its
+    version as the ETag, or a 304 when the client's ``If-None-Match`` already names that version.
+    """
+    if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+        return HttpResponseNotModified(headers={'ETag': etag})
+    return HttpResponse(body, content_type='application/json', headers={'ETag': etag})
+
+
+def cached_cart_response(request, cart_id=None, user_id=None):
+    """
+    The cached cart, by ``cart_id`` or ``user_id``, as a ``cart_view_response``; ``None`` when
+    it is not cached.
+
+    With ``If-None-Match`` the version alone is read first, so a cart that has not changed
+    costs one small read and its body never leaves Redis.
+    """
+    def load(body=True):
+        if cart_id is not None:
+            return (cart_id, *store.load_cart_view(cart_id, body))
+        return store.load_user_cart_view(user_id, body)
+
+    if request.META.get('HTTP_IF_NONE_MATCH'):
+        _, etag, _ = load(body=False)
+        if etag_matches(request.META['HTTP_IF_NONE_MATCH'], etag):
+            return HttpResponseNotModified(headers={'ETag': etag})
+
+    found_cart_id, etag, body = load()
+    if found_cart_id is not None and (etag is None or body is None):
+        etag, body = store.cache_cart_view(found_cart_id) or (None, None)
+    if body is None:
+        return None
+    return cart_view_response(request, etag, body)
+
+
+async def acached_cart_response(request, cart_id=None, user_id=None):
+    """``cached_cart_response`` for the async views."""
+    async def load(body=True):
+        if cart_id is not None:
+            return (cart_id, *await store.aload_cart_view(cart_id, body))
+        return await store.aload_user_cart_view(user_id, body)
+
+    if request.META.get('HTTP_IF_NONE_MATCH'):
+        _, etag, _ = await load(body=False)
+        if etag_matches(request.META['HTTP_IF_NONE_MATCH'], etag):
+            return HttpResponseNotModified(headers={'ETag': etag})
+
+    found_cart_id, etag, body = await load()
+    if found_cart_id is not None and (etag is None or body is None):
+        etag, body = await sync_to_async(store.cache_cart_view)(found_cart_id) or (None, None)
+    if body is None:
+        return None
+    return cart_view_response(request, etag, body)
+
+
+def if_match(cart_id_kwarg):
+    """
+    Honour an ``If-Match`` header on a view handler that changes the cart in ``kwargs[cart_id_kwarg]``.
+
+    When one of the header's ETags is the cart's current version, the cart is claimed (see
+    ``store.claim_version``) and the handler runs; the claim is released once the request's
+    changes have been flushed to Redis, which bumps the version along with them. A request
+    whose ETag is stale gets a 412 carrying the current ETag, if the cart has one; one that
+    comes while another conditional write holds the cart gets a 409 to retry. A cart that is
+    not cached has no version, so it never matches: the client reads it, which caches it,
+    and retries. Requests without the header run as usual.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            etags = parse_etags(request.headers.get('If-Match', ''))
+            if not etags:
+                return handler(view, request, *args, **kwargs)
+
+            cart_id = kwargs[cart_id_kwarg]
+            token = uuid.uuid4().hex
+            try:
+                outcome, etag = store.claim_version(cart_id, etags, token)
+            except redis.RedisError as e:
+                # unlike an idempotency key, a precondition cannot be waived
+                logger.error(f"If-Match check failed for {request.method} {request.path}: {e}")
+                return Response({'message': 'Cart version unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+            if outcome == store.STALE:
+                logger.info(f"{request.method} {request.path} rejected: cart is at {etag}, not {', '.join(etags)}")
+                headers = {'ETag': etag} if etag else None
+                return Response({'message': 'Cart has changed'}, status=status.HTTP_412_PRECONDITION_FAILED,
+                                headers=headers)
+            if outcome == store.CLAIM_HELD:
+                logger.info(f"{request.method} {request.path} rejected: another write to the cart is in progress")
+                return Response({'message': 'Another change to the cart is in progress'},
+                                status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+
+            def release():
+                try:
+                    store.release_version_claim(cart_id, token)
+                except redis.RedisError as e:
+                    logger.warning(f"Releasing the claim on cart {cart_id} failed: {e}")
+
+            try:
+                response = handler(view, request, *args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            # held until the version the changes bring is in Redis, so no other write matches the old one meanwhile
+            after_flush(release)
+            return response
+
+        return wrapper
+
+    return decorator
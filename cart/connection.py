@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import weakref
+from functools import lru_cache
+
+import redis
+import redis.asyncio
+import redis.asyncio.retry
+from django.conf import settings
+from django_redis.pool import ConnectionFactory
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+def get_connection_kwargs(retry_class=Retry):
+    options = settings.REDIS
+    return {
+        'host': options['HOST'],
+        'port': options['PORT'],
+        'db': options['DB'],
+        'password': options['PASSWORD'] or None,
+        'socket_connect_timeout': options['SOCKET_CONNECT_TIMEOUT'],
+        'socket_timeout': options['SOCKET_TIMEOUT'],
+        'socket_keepalive': True,
+        'health_check_interval': options['HEALTH_CHECK_INTERVAL'],
+        'retry': retry_class(
+            ExponentialBackoff(cap=options['RETRY_BACKOFF_CAP'], base=options['RETRY_BACKOFF_BASE']),
+            options['RETRY_ATTEMPTS'],
+        ),
+        'retry_on_error': [redis.exceptions.ConnectionError, redis.exceptions.TimeoutError],
+    }
+
+
+@lru_cache(maxsize=None)
+def get_connection_pool():
+    """
+    The process-wide Redis connection pool.
+
+    A ``BlockingConnectionPool`` caps the number of sockets per worker: when all of them
+    are busy, callers wait up to ``POOL_TIMEOUT`` seconds for one instead of opening more.
+    """
+    options = settings.REDIS
+    logger.info(
+        f"Creating Redis connection pool for {options['HOST']}:{options['PORT']} "
+        f"(max_connections={options['MAX_CONNECTIONS']})"
+    )
+    return redis.BlockingConnectionPool(
+        max_connections=options['MAX_CONNECTIONS'],
+        timeout=options['POOL_TIMEOUT'],
+        **get_connection_kwargs(),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_redis_client():
+    return redis.StrictRedis(connection_pool=get_connection_pool())
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_redis_client():
+    """
+    The ``redis.asyncio`` client of the running event loop, for the async views.
+
+    asyncio connections can only be used on the loop that opened them, so each loop gets its
+    own pool, with the same limits as the sync one. Under an ASGI server that is one pool
+    per worker; a loop's pool goes away with the loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        options = settings.REDIS
+        client = _async_clients[loop] = redis.asyncio.StrictRedis(
+            connection_pool=redis.asyncio.BlockingConnectionPool(
+                max_connections=options['MAX_CONNECTIONS'],
+                timeout=options['POOL_TIMEOUT'],
+                **get_connection_kwargs(redis.asyncio.retry.Retry),
+            )
+        )
+    return client
+
+
+class SharedPoolConnectionFactory(ConnectionFactory):
+    """django-redis connection factory that makes ``CACHES`` (and sessions) use the shared pool."""
+
+    def get_or_create_connection_pool(self, params):
+        return get_connection_pool()
+
+
+redis_client = get_redis_client()
@@ -0,0 +1,164 @@
+"""
+The ``cart:events`` feed: a Redis Stream with an entry for every change of a cart, for other
+services to follow instead of polling the cart endpoints.
+
+An event is a flat map of strings: ``type`` (``cart_created``, ``cart_updated``,
+``cart_deleted``, ``item_added``, ``item_updated`` or ``item_removed``), ``cart_id``, the
+cart ``version`` the change made (see ``store.bump_version``; deleted carts have none) and,
+for item events, ``item``, ``prod_id`` and the quantity ``delta``. A cart deleted by the
+expiry sweep or merged into a user's cart has a ``reason`` (``expired`` or ``merged``, with
+the cart it went ``into``). Events are published in the same MULTI/EXEC or script as the
+cart write they describe, so the feed never shows a change that Redis does not have. The
+stream is capped at about ``CART_EVENTS_MAXLEN`` entries.
+
+Consumers read it through a consumer group (see ``CartEventConsumer``), so each event is
+handled by one consumer of the group, and events a consumer took but never acknowledged are
+handed to another one after ``min_idle_time``.
+"""
+import json
+import logging
+import socket
+
+import redis
+from django.conf import settings
+
+from .connection import get_connection_kwargs
+
+logger = logging.getLogger(__name__)
+
+CART_EVENTS_KEY = 'cart:events'
+
+EVENT_INT_FIELDS = ('version', 'item', 'delta')
+
+
+def event_fields(event):
+    """An event's fields as a flat ``[field, value, ...]`` list of strings, leaving out ``None`` values."""
+    return [str(part) for field, value in event.items() if value is not None for part in (field, value)]
+
+
+def encode_events(events):
+    """Events for the store's scripts to publish along with a cart write; ``'[]'`` when the feed is off."""
+    if not settings.CART_EVENTS:
+        return '[]'
+    return json.dumps([event_fields(event) for event in events])
+
+
+def publish(pipe, cart_id, event):
+    """Queue an event that comes with no cart version, such as the cart's deletion."""
+    if not settings.CART_EVENTS:
+        return
+    fields = {'cart_id': str(cart_id), **{field: str(value) for field, value in event.items() if value is not None}}
+    pipe.xadd(CART_EVENTS_KEY, fields, maxlen=settings.CART_EVENTS_MAXLEN, approximate=True)
+
+
+def decode_event(fields):
+    event = {field.decode(): value.decode() for field, value in fields.items()}
+    for field in EVENT_INT_FIELDS:
+        if field in event:
+            event[field] = int(event[field])
+    return event
+
+
+def _decode_entries(entries):
+    # pending entries that were trimmed off the stream since come back without fields
+    return [(entry_id.decode(), decode_event(fields)) for entry_id, fields in entries if fields]
+
+
+def _blocking_client(block):
+    # a blocking read waits longer than the pooled clients' socket timeout allows
+    socket_timeout = block / 1000 + settings.REDIS['SOCKET_TIMEOUT']
+    return redis.StrictRedis(**{**get_connection_kwargs(), 'socket_timeout': socket_timeout})
+
+
+class CartEventConsumer:
+    """
+    One consumer in a consumer group on the ``cart:events`` feed.
+
+    ``read`` returns ``(entry_id, event)`` pairs: first the consumer's own events that were
+    delivered but not acknowledged (after a restart), then events claimed from consumers of
+    the group that have been idle for ``min_idle_time`` milliseconds, then new events,
+    waiting up to ``block`` milliseconds for them. Each event has to be ``ack``ed once it is
+    handled; ``consume`` does that after its handler returns.
+    """
+
+    def __init__(self, group, consumer=None, start='$', block=5000, min_idle_time=60000, count=100):
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.block = block
+        self.min_idle_time = min_idle_time
+        self.count = count
+        self.client = _blocking_client(block)
+        self._pending_from = '0'
+        self._claim_from = '0-0'
+        self.create_group(start)
+
+    def create_group(self, start='$'):
+        """Create the group, starting at ``start`` (``'$'`` for new events, ``'0'`` for the whole feed), unless it exists."""
+        try:
+            self.client.xgroup_create(CART_EVENTS_KEY, self.group, id=start, mkstream=True)
+            logger.info(f"Created consumer group {self.group} on {CART_EVENTS_KEY} at {start}")
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self):
+        if self._pending_from is not None:
+            # an ID instead of '>' re-reads what was delivered to this consumer and never acknowledged
+            entries = self._read_group(self._pending_from, block=None)
+            if entries:
+                self._pending_from = entries[-1][0]
+                return entries
+            self._pending_from = None
+
+        claimed = self._claim()
+        if claimed:
+            return claimed
+        return self._read_group('>', block=self.block)
+
+    def _read_group(self, entry_id, block):
+        response = self.client.xreadgroup(self.group, self.consumer, {CART_EVENTS_KEY: entry_id},
+                                          count=self.count, block=block)
+        return _decode_entries(response[0][1]) if response else []
+
+    def _claim(self):
+        self._claim_from, entries, *_ = self.client.xautoclaim(
+            CART_EVENTS_KEY, self.group, self.consumer, self.min_idle_time, start_id=self._claim_from, count=self.count,
+        )
+        return _decode_entries([entry for entry in entries if entry])
+
+    def ack(self, *entry_ids):
+        if entry_ids:
+            self.client.xack(CART_EVENTS_KEY, self.group, *entry_ids)
+
+    def consume(self, handler, stop=None):
+        """
+        Call ``handler(event)`` for every event, acknowledging each one once it returns, until
+        ``stop()`` is true. An event whose handler raises stays pending, to be retried.
+        """
+        while stop is None or not stop():
+            for entry_id, event in self.read():
+                try:
+                    handler(event)
+                except Exception as e:
+                    logger.error(f"Handling cart event {entry_id} in group {self.group} failed: {e}")
+                    continue
+                self.ack(entry_id)
+
+
+def tail(start='$', block=5000, count=100):
+    """
+    Yield ``(entry_id, event)`` for every event after ``start`` (``'$'`` for new events only)
+    as it arrives, without a consumer group: nothing is acknowledged, and every reader sees
+    every event.
+    """
+    client = _blocking_client(block)
+    last_id = start
+    if last_id == '$':
+        # pinned to an ID, so that nothing published between two reads is missed
+        newest = client.xrevrange(CART_EVENTS_KEY, count=1)
+        last_id = newest[0][0].decode() if newest else '0-0'
+    while True:
+        response = client.xread({CART_EVENTS_KEY: last_id}, count=count, block=block)
+        for entry_id, event in _decode_entries(response[0][1] if response else []):
+            last_id = entry_id
+            yield entry_id, event
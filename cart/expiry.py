@@ -0,0 +1,87 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import events, store
+from .connection import redis_client
+from .models import Cart, CartItem, ItemOption
+
+logger = logging.getLogger(__name__)
+
+GUEST_CARTS = Q(user_id__isnull=True) | Q(user_id='')
+
+
+def expiry_tiers():
+    """``(name, carts, ttl)`` for each kind of cart that expires: guest carts and user carts."""
+    tiers = [
+        ('guest', Cart.objects.filter(GUEST_CARTS), settings.GUEST_CART_TTL),
+        ('user', Cart.objects.exclude(GUEST_CARTS), settings.USER_CART_TTL),
+    ]
+    return [tier for tier in tiers if tier[2]]
+
+
+def expiry_cutoff(ttl, now=None):
+    return (now or timezone.now()) - timedelta(seconds=ttl)
+
+
+def cached_cart_ids(cart_ids):
+    """
+    The carts among ``cart_ids`` that are still in Redis, with one pipelined round of EXISTS.
+
+    Every read renews a cached cart's TTL, so a cart still cached has been used lately even
+    if it has not been modified: it is not abandoned. Its rendered view counts too, since
+    reads are served from it alone and Redis can evict the two keys separately. A read that
+    finds neither (the cart expired, was evicted or was lost in a failover) caches the cart
+    again from the DB (see ``warmup.warm_cart_after_miss``), so a cart that is still being
+    read is never taken for an abandoned one.
+    """
+    layout = store.get_layout()
+    pipe = redis_client.pipeline(transaction=False)
+    for cart_id in cart_ids:
+        pipe.exists(layout.key(cart_id), store.cart_view_key(cart_id))
+    return {cart_id for cart_id, exists in zip(cart_ids, pipe.execute()) if exists}
+
+
+def delete_expired_carts(cart_ids, cutoff):
+    """
+    Delete the carts among ``cart_ids`` still untouched since ``cutoff``, with their items and
+    options, and clear whatever they left in Redis. Returns the number of carts deleted.
+
+    The carts are locked and re-checked first, so a cart that was written to after it was
+    picked is kept. The rows go in one transaction.
+    """
+    with transaction.atomic():
+        carts = list(
+            Cart.objects.select_for_update().filter(pk__in=cart_ids, modified_at__lt=cutoff).values_list('pk', 'user_id')
+        )
+        if not carts:
+            return 0
+        locked_ids = [cart_id for cart_id, _ in carts]
+        cart_items = CartItem._base_manager.filter(cart_id__in=locked_ids)
+        item_options = ItemOption.objects.filter(cart_item__cart_id__in=locked_ids)
+
+        options_by_item = {}
+        for item_option_id, cart_item_id in item_options.values_list('id', 'cart_item_id'):
+            options_by_item.setdefault(cart_item_id, []).append(
+                {'id': str(item_option_id), 'cart_item_id': str(cart_item_id)}
+            )
+        items_by_cart = {}
+        for cart_item_id, cart_id in cart_items.values_list('id', 'cart_id'):
+            items_by_cart.setdefault(cart_id, []).append(
+                {'id': str(cart_item_id), 'cart_id': str(cart_id), 'item_options': options_by_item.get(cart_item_id, [])}
+            )
+
+        item_options.delete()
+        cart_items.delete()
+        Cart.objects.filter(pk__in=locked_ids).delete()
+
+    with store.write_batch() as pipe:
+        for cart_id, user_id in carts:
+            store.delete_cart(pipe, str(cart_id), user_id, items_by_cart.get(cart_id, []))
+            events.publish(pipe, cart_id, {'type': 'cart_deleted', 'reason': 'expired'})
+    logger.info(f"Deleted {len(carts)} expired carts")
+    return len(carts)
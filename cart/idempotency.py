@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+from functools import wraps
+
+import redis
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from .connection import redis_client
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+PENDING = b'pending'
+
+
+def idempotency_key(method, path, key):
+    # the same key sent to another endpoint is another request
+    digest = hashlib.blake2b(f'{method} {path} {key}'.encode('utf-8'), digest_size=16).hexdigest()
+    return f'idempotency:{digest}'
+
+
+def request_fingerprint(request):
+    payload = json.dumps(request.data, sort_keys=True, cls=DjangoJSONEncoder, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def idempotent(handler):
+    """
+    Honour an ``Idempotency-Key`` header on a view handler.
+
+    The first request with a key reserves it with ``SET NX`` and runs the handler; its
+    response is then stored for ``IDEMPOTENCY_KEY_TTL`` seconds and replayed, without
+    running the handler, for any retry with the same key. A retry that arrives while the
+    first request is still running gets 409, and reusing a key with a different body gets
+    422. Responses that raised or returned a 5xx are not stored, so those retries run
+    again. Requests without the header, or while Redis is unreachable, run as usual.
+    """
+    @wraps(handler)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return handler(view, request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return Response({'message': f'{IDEMPOTENCY_HEADER} must be at most {MAX_KEY_LENGTH} characters'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        redis_key = idempotency_key(request.method, request.path, key)
+        fingerprint = request_fingerprint(request)
+        try:
+            reserved = redis_client.set(redis_key, PENDING, nx=True, ex=settings.IDEMPOTENCY_LOCK_TTL)
+            stored = None if reserved else redis_client.get(redis_key)
+        except redis.RedisError as e:
+            logger.warning(f"Idempotency check failed, running {request.method} {request.path} unguarded: {e}")
+            return handler(view, request, *args, **kwargs)
+
+        if not reserved:
+            if stored is None:
+                # expired between SET NX and GET: the first request gave up on it
+                return wrapper(view, request, *args, **kwargs)
+            return replay(request, key, stored, fingerprint)
+
+        try:
+            response = handler(view, request, *args, **kwargs)
+        except BaseException:
+            release(redis_key)
+            raise
+        if response.status_code >= 500 or not isinstance(response, Response):
+            release(redis_key)
+            return response
+
+        record = {'fingerprint': fingerprint, 'status': response.status_code, 'data': response.data}
+        try:
+            redis_client.set(redis_key, json.dumps(record, cls=DjangoJSONEncoder), ex=settings.IDEMPOTENCY_KEY_TTL)
+        except redis.RedisError as e:
+            logger.warning(f"Storing the response for idempotency key {key} failed: {e}")
+        return response
+
+    return wrapper
+
+
+def replay(request, key, stored, fingerprint):
+    if stored == PENDING:
+        logger.info(f"Request with idempotency key {key} is still in progress")
+        return Response({'message': 'A request with this idempotency key is in progress'},
+                        status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'})
+    record = json.loads(stored)
+    if record['fingerprint'] != fingerprint:
+        return Response({'message': f'{IDEMPOTENCY_HEADER} was already used with a different request body'},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    logger.info(f"Replaying {request.method} {request.path} for idempotency key {key}")
+    return Response(record['data'], status=record['status'], headers={REPLAYED_HEADER: 'true'})
+
+
+def release(redis_key):
+    try:
+        redis_client.delete(redis_key)
+    except redis.RedisError as e:
+        logger.warning(f"Releasing idempotency key {redis_key} failed: {e}")
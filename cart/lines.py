@@ -0,0 +1,22 @@
+import hashlib
+import json
+
+
+def line_signature(prod_id, item_options):
+    """
+    Canonical key of a cart line: the product plus its exact set of options.
+
+    Attributes and values are stripped and case-folded, duplicates are dropped and the
+    pairs sorted, so the same selection always hashes the same way whatever order or
+    casing it was submitted in, and a subset of another line's options never matches it.
+    """
+    options = sorted({
+        (str(option['attribute']).strip().casefold(), str(option['value']).strip().casefold())
+        for option in item_options
+    })
+    payload = json.dumps([str(prod_id).strip(), options], separators=(',', ':'))
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def item_signature(item_data):
+    return line_signature(item_data['prod_id'], item_data['item_options'])
@@ -0,0 +1,209 @@
+import logging
+
+from django.utils.dateparse import parse_datetime
+
+from . import codec
+from .connection import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Sorted-set indexes of document IDs, scored by creation time. They replace
+# KEYS-based listing so that a page of carts never touches the whole keyspace.
+CART_INDEX_KEY = 'cart:index'
+CART_ITEM_INDEX_KEY = 'cart_item:index'
+ITEM_OPTION_INDEX_KEY = 'item_option:index'
+
+INDEX_DOCUMENT_PREFIXES = {
+    CART_INDEX_KEY: 'cart:main:',
+    CART_ITEM_INDEX_KEY: 'cart_item:main:',
+    ITEM_OPTION_INDEX_KEY: 'item_option:main:',
+}
+
+MGET_BATCH_SIZE = 500
+
+
+def _score(timestamp):
+    if isinstance(timestamp, str):
+        timestamp = parse_datetime(timestamp)
+    return timestamp.timestamp() if timestamp else 0
+
+
+def index_document(index_key, document_id, created_at, pipe=None):
+    client = pipe if pipe is not None else redis_client
+    client.zadd(index_key, {str(document_id): _score(created_at)})
+
+
+def unindex_document(index_key, *document_ids, pipe=None):
+    if not document_ids:
+        return
+    client = pipe if pipe is not None else redis_client
+    client.zrem(index_key, *[str(document_id) for document_id in document_ids])
+
+
+def fetch_documents(index_key, document_ids, load_many=None):
+    """
+    Load the documents for ``document_ids`` with MGET batches sent in one pipeline, preserving order.
+
+    ``load_many`` replaces the MGETs for documents not stored as plain keys; it takes a list
+    of IDs and returns the decoded documents, ``None`` for missing ones. IDs whose document
+    has disappeared are dropped from the result and pruned from the index.
+    """
+    documents = []
+    missing = []
+
+    if load_many is not None:
+        values = load_many(document_ids)
+    else:
+        prefix = INDEX_DOCUMENT_PREFIXES[index_key]
+        pipe = redis_client.pipeline(transaction=False)
+        for start in range(0, len(document_ids), MGET_BATCH_SIZE):
+            pipe.mget([f'{prefix}{document_id}' for document_id in document_ids[start:start + MGET_BATCH_SIZE]])
+        values = [codec.decode(raw) if raw else None for batch in pipe.execute() for raw in batch]
+
+    for document_id, document in zip(document_ids, values):
+        if document is None:
+            missing.append(document_id)
+            continue
+        documents.append(document)
+
+    if missing:
+        logger.warning(f"Pruning {len(missing)} stale entries from index '{index_key}'")
+        unindex_document(index_key, *missing)
+    return documents
+
+
+def iter_index_documents(index_key, batch_size=MGET_BATCH_SIZE):
+    """
+    Stream every document referenced by an index using a ZSCAN cursor.
+
+    Memory stays bounded by ``batch_size`` regardless of how many documents exist.
+    """
+    batch = []
+    for member, _ in redis_client.zscan_iter(index_key, count=batch_size):
+        batch.append(member.decode('utf-8'))
+        if len(batch) >= batch_size:
+            yield from fetch_documents(index_key, batch)
+            batch = []
+    if batch:
+        yield from fetch_documents(index_key, batch)
+
+
+def prune_index(index_key, document_key=None, batch_size=MGET_BATCH_SIZE, dry_run=False):
+    """
+    Drop the index entries whose document no longer exists (expired or deleted behind the
+    index's back), checking ``batch_size`` of them per pipelined round of EXISTS.
+
+    ``document_key`` maps an ID to its key; by default the index's ``INDEX_DOCUMENT_PREFIXES``
+    entry is used. Returns the number of entries removed (or, with ``dry_run``, found).
+    """
+    if document_key is None:
+        prefix = INDEX_DOCUMENT_PREFIXES[index_key]
+
+        def document_key(document_id):
+            return f'{prefix}{document_id}'
+
+    def prune(document_ids):
+        pipe = redis_client.pipeline(transaction=False)
+        for document_id in document_ids:
+            pipe.exists(document_key(document_id))
+        missing = [document_id for document_id, exists in zip(document_ids, pipe.execute()) if not exists]
+        if not dry_run:
+            unindex_document(index_key, *missing)
+        return len(missing)
+
+    pruned = 0
+    batch = []
+    for member, _ in redis_client.zscan_iter(index_key, count=batch_size):
+        batch.append(member.decode('utf-8'))
+        if len(batch) >= batch_size:
+            pruned += prune(batch)
+            batch = []
+    if batch:
+        pruned += prune(batch)
+    return pruned
+
+
+class IndexedDocuments:
+    """
+    Lazy, sliceable view over an index, newest first.
+
+    It implements just enough of the sequence protocol for Django's ``Paginator``
+    (and therefore ``DefaultPagination``): ``count()`` is a ZCARD and a slice is a
+    ZREVRANGE followed by batched MGETs of only the requested page. Entries of the page
+    whose document is gone are pruned, and the page is filled up from the entries after it.
+    """
+
+    def __init__(self, index_key, load_many=None):
+        self.index_key = index_key
+        self.load_many = load_many
+
+    def count(self):
+        return redis_client.zcard(self.index_key)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            documents = self[item:item + 1]
+            if not documents:
+                raise IndexError(item)
+            return documents[0]
+
+        start = item.start or 0
+        stop = item.stop if item.stop is not None else self.count()
+        if stop <= start:
+            return []
+        documents = []
+        while len(documents) < stop - start:
+            # the stale entries were pruned, so the next ones have moved up into the page's range
+            members = redis_client.zrevrange(self.index_key, start + len(documents), stop - 1)
+            if not members:
+                break
+            documents.extend(
+                fetch_documents(self.index_key, [member.decode('utf-8') for member in members], self.load_many)
+            )
+        return documents
+
+
+def rebuild_index(index_key, batch_size=MGET_BATCH_SIZE, document_key=None, load_many=None):
+    """
+    Repopulate an index from the documents already in Redis.
+
+    Uses SCAN rather than KEYS, so it is safe to run against a live instance. As in
+    ``prune_index`` and ``fetch_documents``, ``document_key`` maps an ID to its key and
+    ``load_many`` loads documents not stored as plain keys, such as carts in the hash layout.
+    """
+    if document_key is None:
+        prefix = INDEX_DOCUMENT_PREFIXES[index_key]
+
+        def document_key(document_id):
+            return f'{prefix}{document_id}'
+
+    prefix = document_key('')
+    indexed = 0
+    keys = []
+
+    def flush(batch_keys):
+        document_ids = [key[len(prefix):] for key in batch_keys]
+        if load_many is not None:
+            documents = load_many(document_ids)
+        else:
+            documents = [codec.decode(raw) if raw else None for raw in redis_client.mget(batch_keys)]
+        pipe = redis_client.pipeline(transaction=False)
+        for document_id, document in zip(document_ids, documents):
+            if document is None:
+                continue
+            pipe.zadd(index_key, {document_id: _score(document.get('created_at'))})
+        return len(pipe.execute())
+
+    for key in redis_client.scan_iter(match=document_key('*'), count=batch_size):
+        keys.append(key.decode('utf-8'))
+        if len(keys) >= batch_size:
+            indexed += flush(keys)
+            keys = []
+    if keys:
+        indexed += flush(keys)
+
+    logger.info(f"Rebuilt index '{index_key}' with {indexed} entries")
+    return indexed
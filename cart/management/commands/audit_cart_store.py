@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cart.audit import CartStoreAuditor, Throttle
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the carts cached in Redis with the DB: report cached carts that drifted from their '
+        'rows and keys left behind by deleted carts, items and options. With --repair, fix them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Delete orphaned keys and rewrite drifted carts.')
+        parser.add_argument('--check', action='append', choices=CartStoreAuditor.CHECKS, dest='checks',
+                            help='Run only this check; repeat for several. Default: all.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Keys or rows per SCAN batch and query.')
+        parser.add_argument('--rate', type=float, default=2000,
+                            help='Most keys or rows processed per second, to spare production traffic; 0 = no limit.')
+
+    def handle(self, *args, **options):
+        auditor = CartStoreAuditor(repair=options['repair'], batch_size=options['batch_size'],
+                                   throttle=Throttle(options['rate']))
+        started = time.monotonic()
+        for name, elapsed in auditor.run(options['checks']):
+            findings = {key.split('.', 1)[1]: count for key, count in auditor.stats.items() if key.startswith(f'{name}.')}
+            processed = findings.get('scanned', findings.get('checked', 0))
+            rate = f', {processed / elapsed:.0f}/s' if processed and elapsed else ''
+            summary = ', '.join(f'{finding} {count}' for finding, count in sorted(findings.items())) or 'nothing found'
+            self.stdout.write(f'{name}: {summary} ({elapsed:.1f}s{rate})')
+
+        found = sum(count for key, count in auditor.stats.items() if key.endswith(('.orphaned', '.drifted', '.stale_layout')))
+        elapsed = time.monotonic() - started
+        if not found:
+            self.stdout.write(self.style.SUCCESS(f'Redis and the DB agree ({elapsed:.1f}s)'))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {found} problems ({elapsed:.1f}s)'))
+        else:
+            self.stdout.write(self.style.WARNING(f'Found {found} problems; run with --repair to fix them ({elapsed:.1f}s)'))
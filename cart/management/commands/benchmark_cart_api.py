@@ -0,0 +1,105 @@
+import statistics
+import threading
+import time
+import uuid
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+ENDPOINTS = ('retrieve', 'user', 'add', 'update')
+
+
+class Target:
+    """A running server and the cart the benchmark works on, created through its API."""
+
+    def __init__(self, name, base_url):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.user_id = str(uuid.uuid4())
+        session = requests.Session()
+        self.cart_id = session.post(f'{self.base_url}/carts/', json={'user_id': self.user_id}).json()['id']
+        self.item_id = session.post(f'{self.base_url}/carts/{self.cart_id}/items/', json=self.item_body()).json()['id']
+
+    def item_body(self):
+        return {'prod_id': 'BENCH-0001', 'quantity': 1, 'item_options': [{'attribute': 'size', 'value': 'M'}]}
+
+    def request(self, session, endpoint):
+        if endpoint == 'retrieve':
+            return session.get(f'{self.base_url}/carts/{self.cart_id}/')
+        if endpoint == 'user':
+            return session.get(f'{self.base_url}/carts/user/{self.user_id}/')
+        if endpoint == 'add':
+            # the same line every time, so the cart stays one item long and requests merge into it
+            return session.post(f'{self.base_url}/carts/{self.cart_id}/items/', json=self.item_body())
+        return session.patch(f'{self.base_url}/carts/{self.cart_id}/items/{self.item_id}/', json={'quantity': 2})
+
+
+def run_load(target, endpoint, concurrency, duration):
+    """``concurrency`` clients send requests back to back for ``duration`` seconds; returns latencies and errors."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        own_latencies = []
+        own_errors = 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                ok = target.request(session, endpoint).status_code < 400
+            except requests.RequestException:
+                ok = False
+            own_latencies.append(time.perf_counter() - started)
+            own_errors += not ok
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return latencies, errors[0]
+
+
+class Command(BaseCommand):
+    help = (
+        'Load running cart servers with concurrent clients and compare requests/sec per worker on the '
+        'hot endpoints, e.g. `gunicorn cart_service.wsgi -w 1` against '
+        '`gunicorn cart_service.asgi -k uvicorn.workers.UvicornWorker -w 1`.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', required=True, metavar='NAME=URL',
+                            help='A server to load, by name and API root, e.g. sync=http://127.0.0.1:8000/api/v1. '
+                                 'Repeat to compare several.')
+        parser.add_argument('--workers', type=int, default=1, help='Worker processes each server runs.')
+        parser.add_argument('--endpoint', action='append', choices=ENDPOINTS, dest='endpoints',
+                            help='Benchmark only this endpoint; repeat for several. Default: all.')
+        parser.add_argument('--concurrency', type=int, default=32, help='Clients sending requests at once.')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per endpoint and server.')
+
+    def handle(self, *args, **options):
+        targets = []
+        for value in options['target']:
+            name, _, base_url = value.partition('=')
+            if not name or not base_url:
+                raise CommandError(f'--target must be NAME=URL, got {value!r}')
+            targets.append(Target(name, base_url))
+
+        self.stdout.write(f"{'endpoint':>9} {'server':>8} {'req/s':>8} {'per worker':>10} "
+                          f"{'p50 ms':>7} {'p99 ms':>7} {'errors':>7}")
+        for endpoint in options['endpoints'] or ENDPOINTS:
+            for target in targets:
+                latencies, errors = run_load(target, endpoint, options['concurrency'], options['duration'])
+                if len(latencies) < 2:
+                    self.stdout.write(self.style.WARNING(f'{endpoint:>9} {target.name:>8} too few requests completed'))
+                    continue
+                rate = len(latencies) / options['duration']
+                percentiles = statistics.quantiles(latencies, n=100)
+                self.stdout.write(
+                    f"{endpoint:>9} {target.name:>8} {rate:>8.0f} {rate / options['workers']:>10.0f} "
+                    f"{percentiles[49] * 1000:>7.1f} {percentiles[98] * 1000:>7.1f} {errors:>7}")
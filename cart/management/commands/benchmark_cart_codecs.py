@@ -0,0 +1,77 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cart.codec import CODECS
+
+
+def make_cart(item_count, options_per_item):
+    now = timezone.now()
+    cart_id = str(uuid.uuid4())
+    cart_items = []
+    for item_index in range(item_count):
+        cart_item_id = str(100000 + item_index)
+        cart_items.append({
+            "id": cart_item_id,
+            "cart_id": cart_id,
+            "prod_id": f"PROD-{random.randint(1, 10 ** 8):08d}",
+            "quantity": random.randint(1, 5),
+            "is_active": True,
+            "created_at": now - timedelta(minutes=item_index),
+            "modified_at": now,
+            "item_options": [
+                {
+                    "id": str(500000 + item_index * options_per_item + option_index),
+                    "cart_item_id": cart_item_id,
+                    "attribute": random.choice(['color', 'size', 'material', 'pattern']),
+                    "value": random.choice(['red', 'XL', 'cotton', 'striped', 'navy blue']),
+                    "created_at": now,
+                    "modified_at": now,
+                }
+                for option_index in range(options_per_item)
+            ],
+        })
+    return {
+        "id": cart_id,
+        "user_id": str(uuid.uuid4()),
+        "cart_items": cart_items,
+        "total_quantity": sum(item['quantity'] for item in cart_items),
+        "created_at": now - timedelta(days=1),
+        "modified_at": now,
+    }
+
+
+def time_per_call(func, arg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+class Command(BaseCommand):
+    help = 'Compare size and encode/decode time of the cart cache codecs for realistic cart sizes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,50,200', help='Comma-separated item counts per cart.')
+        parser.add_argument('--options', type=int, default=2, help='Options per item.')
+        parser.add_argument('--iterations', type=int, default=500)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'items':>6} {'codec':>8} {'bytes':>9} {'ratio':>6} {'encode µs':>10} {'decode µs':>10}")
+        for item_count in [int(size) for size in options['sizes'].split(',')]:
+            # documents read back from Redis hold ISO strings rather than datetimes
+            document = CODECS['json'].decode(CODECS['json'].encode(make_cart(item_count, options['options'])))
+            baseline = None
+            for name, codec in CODECS.items():
+                payload = codec.encode(document)
+                size = len(payload.encode('utf-8') if isinstance(payload, str) else payload)
+                baseline = baseline or size
+                encode_us = time_per_call(codec.encode, document, options['iterations'])
+                decode_us = time_per_call(codec.decode, payload, options['iterations'])
+                assert codec.decode(payload) == document, f'{name} codec does not round-trip'
+                self.stdout.write(
+                    f"{item_count:>6} {name:>8} {size:>9} {size / baseline:>6.2f} {encode_us:>10.1f} {decode_us:>10.1f}")
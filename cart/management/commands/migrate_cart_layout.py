@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+
+from cart import store
+from cart.connection import redis_client
+from cart.listing import MGET_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        'Convert the carts cached in Redis to another storage layout. Run it right after changing '
+        'CART_STORAGE_LAYOUT; carts not converted yet are rebuilt from the DB on their next write.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=sorted(store.LAYOUTS), required=True)
+        parser.add_argument('--batch-size', type=int, default=MGET_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        source = store.get_layout('document' if options['to'] == 'hash' else 'hash')
+        target = store.get_layout(options['to'])
+        prefix = source.key('')
+
+        migrated = 0
+        cart_ids = []
+        for key in redis_client.scan_iter(match=source.key('*'), count=options['batch_size']):
+            cart_ids.append(key.decode('utf-8')[len(prefix):])
+            if len(cart_ids) >= options['batch_size']:
+                migrated += self.migrate(cart_ids, source, target)
+                cart_ids = []
+        if cart_ids:
+            migrated += self.migrate(cart_ids, source, target)
+
+        self.stdout.write(self.style.SUCCESS(f"Migrated {migrated} carts to the '{options['to']}' layout"))
+
+    def migrate(self, cart_ids, source, target):
+        """
+        Convert a batch in one MULTI/EXEC, so a cart is never visible in both layouts. Both
+        layouts' keys are WATCHed while the batch is read, as in ``warm_carts``: a cart written
+        in between makes the batch start over rather than be overwritten with the older copy.
+        A cart already written in the new layout is newer than its old copy, which is dropped.
+        """
+        def write(pipe):
+            # the keys are WATCHed by now, so reading them on another connection is still safe
+            documents = source.load_carts(cart_ids)
+            check = redis_client.pipeline(transaction=False)
+            for cart_id in cart_ids:
+                check.exists(target.key(cart_id))
+            converted = check.execute()
+
+            pipe.multi()
+            migrated = 0
+            for document, exists in zip(documents, converted):
+                if document is None:
+                    continue
+                source.delete_cart(pipe, document['id'])
+                for cart_item_data in document['cart_items']:
+                    source.delete_item(pipe, cart_item_data)
+                if exists:
+                    continue
+                ttl = store.cart_ttl(document['user_id'])
+                target.put_cart(pipe, document)
+                store.expire_cart(pipe, document['id'], document['user_id'], layout=target)
+                for cart_item_data in document['cart_items']:
+                    target.put_item(pipe, cart_item_data, ttl)
+                migrated += 1
+            return migrated
+
+        keys = [layout.key(cart_id) for cart_id in cart_ids for layout in (source, target)]
+        return redis_client.transaction(write, *keys, value_from_callable=True)
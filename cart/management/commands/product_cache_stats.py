@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from cart.connection import redis_client
+from cart.product_cache import PRODUCT_CACHE_STATS_KEY
+
+
+def ratio(hits, misses):
+    return f'{hits / (hits + misses):.1%}' if hits + misses else '-'
+
+
+class Command(BaseCommand):
+    help = "Show the product cache hit/miss counters published by all processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the counters after showing them.')
+
+    def handle(self, *args, **options):
+        stats = {name.decode(): int(count) for name, count in redis_client.hgetall(PRODUCT_CACHE_STATS_KEY).items()}
+        for name in sorted(stats):
+            self.stdout.write(f'{name}: {stats[name]}')
+        self.stdout.write(f"local hit ratio: {ratio(stats.get('local_hits', 0), stats.get('local_misses', 0))}")
+        self.stdout.write(f"redis hit ratio: {ratio(stats.get('redis_hits', 0), stats.get('redis_misses', 0))}")
+        if options['reset']:
+            redis_client.delete(PRODUCT_CACHE_STATS_KEY)
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from cart import store
+from cart.listing import CART_INDEX_KEY, INDEX_DOCUMENT_PREFIXES, MGET_BATCH_SIZE, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the Redis listing indexes for carts, cart items and item options from the cached documents.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=MGET_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        layout = store.get_layout()
+        for index_key in INDEX_DOCUMENT_PREFIXES:
+            if index_key == CART_INDEX_KEY:
+                # carts are stored the way the configured layout stores them
+                indexed = rebuild_index(index_key, batch_size=options['batch_size'],
+                                        document_key=layout.key, load_many=layout.load_carts)
+            else:
+                indexed = rebuild_index(index_key, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} documents into '{index_key}'"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from cart.models import Cart
+from cart.queries import reconcile_cart_totals
+
+
+class Command(BaseCommand):
+    help = "Recount every cart's total_quantity and item_count from its items and fix the ones that drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many carts drifted.')
+
+    def handle(self, *args, **options):
+        checked = corrected = 0
+        carts = Cart.objects.order_by('pk')
+        # keyset pagination: each batch is an indexed range scan, however many carts there are
+        while True:
+            cart_ids = list(carts.values_list('pk', flat=True)[:options['batch_size']])
+            if not cart_ids:
+                break
+            corrected += reconcile_cart_totals(Cart.objects.filter(pk__in=cart_ids), dry_run=options['dry_run'])
+            checked += len(cart_ids)
+            carts = Cart.objects.order_by('pk').filter(pk__gt=cart_ids[-1])
+
+        verb = 'would be corrected' if options['dry_run'] else 'corrected'
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} carts, {corrected} {verb}"))
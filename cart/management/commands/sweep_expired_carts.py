@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from cart import store
+from cart.expiry import cached_cart_ids, delete_expired_carts, expiry_cutoff, expiry_tiers
+from cart.listing import CART_INDEX_KEY, CART_ITEM_INDEX_KEY, ITEM_OPTION_INDEX_KEY, prune_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete guest and user carts that have expired: not modified for GUEST_CART_TTL / USER_CART_TTL '
+        'seconds and no longer cached in Redis. Then drop index entries whose Redis keys have expired.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Carts deleted per transaction.')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many carts have expired.')
+        parser.add_argument('--skip-indexes', action='store_true', help='Do not prune the Redis indexes.')
+
+    def handle(self, *args, **options):
+        for name, carts, ttl in expiry_tiers():
+            cutoff = expiry_cutoff(ttl)
+            expired = carts.filter(modified_at__lt=cutoff).order_by('modified_at', 'pk')
+            remaining = expired
+            checked = deleted = 0
+            # oldest first, by keyset on (modified_at, id): each batch reads on from where the
+            # last one ended along the cart_modified_at_id_idx index
+            while True:
+                batch = list(remaining.values_list('modified_at', 'pk')[:options['batch_size']])
+                if not batch:
+                    break
+                checked += len(batch)
+                cached = cached_cart_ids([str(cart_id) for _, cart_id in batch])
+                cart_ids = [cart_id for _, cart_id in batch if str(cart_id) not in cached]
+                if options['dry_run']:
+                    deleted += len(cart_ids)
+                elif cart_ids:
+                    deleted += delete_expired_carts(cart_ids, cutoff)
+                modified_at, cart_id = batch[-1]
+                remaining = expired.filter(Q(modified_at__gt=modified_at) | Q(modified_at=modified_at, pk__gt=cart_id))
+                if options['pause']:
+                    time.sleep(options['pause'])
+
+            verb = 'would be deleted' if options['dry_run'] else 'deleted'
+            self.stdout.write(f"{name} carts: {checked} past their TTL, {deleted} {verb}")
+
+        if options['skip_indexes'] or options['dry_run']:
+            return
+        pruned = prune_index(CART_INDEX_KEY, store.get_layout().key)
+        pruned += prune_index(CART_ITEM_INDEX_KEY)
+        pruned += prune_index(ITEM_OPTION_INDEX_KEY)
+        self.stdout.write(self.style.SUCCESS(f"Pruned {pruned} expired entries from the Redis indexes"))
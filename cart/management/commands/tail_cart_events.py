@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from cart.events import CartEventConsumer, tail
+
+
+class Command(BaseCommand):
+    help = (
+        'Print cart change events from the cart:events stream as they are published. With --group, '
+        'read them as a consumer of that group and acknowledge each one printed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', default='$',
+                            help="Stream ID to start after: '$' (default) for new events only, 0 for the whole feed. "
+                                 "With --group, where a new group starts.")
+        parser.add_argument('--group', help='Consumer group to read in; created if it does not exist.')
+        parser.add_argument('--consumer', help='Consumer name within the group. Default: the host name.')
+        parser.add_argument('--block', type=int, default=5000, help='Milliseconds each read waits for new events.')
+        parser.add_argument('--count', type=int, default=100, help='Events fetched per read.')
+        parser.add_argument('--limit', type=int, help='Stop after this many events.')
+        parser.add_argument('--json', action='store_true', help='Print each event as a line of JSON.')
+
+    def handle(self, *args, **options):
+        printed = 0
+
+        def show(entry_id, event):
+            nonlocal printed
+            printed += 1
+            if options['json']:
+                self.stdout.write(json.dumps({'id': entry_id, **event}))
+                return
+            details = ' '.join(f'{field}={value}' for field, value in event.items() if field not in ('type', 'cart_id'))
+            self.stdout.write(f"{entry_id} {event['type']:<13} cart={event['cart_id']} {details}")
+
+        def done():
+            return options['limit'] is not None and printed >= options['limit']
+
+        try:
+            if options['group']:
+                consumer = CartEventConsumer(options['group'], options['consumer'], start=options['start'],
+                                             block=options['block'], count=options['count'])
+                while not done():
+                    for entry_id, event in consumer.read():
+                        show(entry_id, event)
+                        consumer.ack(entry_id)
+                        if done():
+                            break
+            else:
+                for entry_id, event in tail(options['start'], block=options['block'], count=options['count']):
+                    show(entry_id, event)
+                    if done():
+                        break
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'{printed} events'))
@@ -0,0 +1,45 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from cart.warmup import warm_cache
+
+
+class Command(BaseCommand):
+    help = (
+        'Cache carts from the DB after Redis lost them, most recently modified first. Stopped runs resume '
+        'from their last batch; run one process per --shard to warm in parallel.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Carts loaded and written per round trip.')
+        parser.add_argument('--shard', type=int, default=0, help='Which slice of the carts this process warms.')
+        parser.add_argument('--shards', type=int, default=1, help='How many processes share the work.')
+        parser.add_argument('--modified-within', type=float, metavar='DAYS',
+                            help='Only warm carts modified in the last DAYS days.')
+        parser.add_argument('--limit', type=int, help='Stop after this many carts.')
+        parser.add_argument('--restart', action='store_true', help='Ignore the saved position and start over.')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['shard'] < options['shards']:
+            raise CommandError('--shard must be between 0 and --shards - 1')
+        modified_since = None
+        if options['modified_within'] is not None:
+            modified_since = timezone.now() - timedelta(days=options['modified_within'])
+
+        started = time.monotonic()
+
+        def progress(warmed, written):
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'{warmed} carts read, {written} cached ({warmed / elapsed:.0f} carts/s)')
+
+        warmed, written = warm_cache(
+            shard=options['shard'], shards=options['shards'], batch_size=options['batch_size'],
+            modified_since=modified_since, limit=options['limit'], resume=not options['restart'], progress=progress,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Shard {options['shard']}/{options['shards']}: cached {written} of {warmed} carts "
+            f"in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,89 @@
+import logging
+
+from django.db import transaction
+
+from . import events, snapshot, store
+from .lines import item_signature
+from .models import Cart, CartItem
+from .queries import carts_with_items, reconcile_cart_totals
+
+logger = logging.getLogger(__name__)
+
+
+class CartOwnershipError(Exception):
+    """The cart to merge from belongs to another user."""
+
+
+def serialize_items(cart):
+    return [
+        snapshot.serialize_item(cart_item, [snapshot.serialize_option(option) for option in cart_item.item_options.all()])
+        for cart_item in cart.cart_items.all()
+    ]
+
+
+def merge_carts(guest_cart_id, user_id):
+    """
+    Merge a guest cart into the user's cart and return the user's cart document.
+
+    Lines are keyed by their signature, so matching is linear in the number of items.
+    A guest line the user already has adds its quantity to it; any other guest line
+    is moved over with its options. Rows are changed with two ``bulk_update`` calls
+    and the guest cart is deleted, all in one transaction. Redis is then updated in
+    one MULTI/EXEC: the guest cart goes and the merged cart is written in full.
+
+    Raises ``CartOwnershipError``, changing nothing, when the cart to merge from has a
+    user ID other than ``user_id``: only guest carts, or the user's own, are merged.
+    """
+    with transaction.atomic():
+        auth_cart = Cart.objects.filter(user_id=user_id).first() or Cart.objects.create(user_id=user_id)
+        # lock both rows in a fixed order so two merges touching the same carts cannot deadlock
+        locked = Cart.objects.select_for_update().filter(pk__in=[auth_cart.pk, guest_cart_id]).order_by('pk')
+        carts = {str(cart.pk): cart for cart in carts_with_items(locked)}
+        auth_cart = carts[str(auth_cart.pk)]
+        guest_cart = carts.get(str(guest_cart_id))
+        if guest_cart is None or guest_cart.pk == auth_cart.pk:
+            return snapshot.build_cart_document(auth_cart)
+        if guest_cart.user_id and guest_cart.user_id != str(user_id):
+            raise CartOwnershipError(f"Cart {guest_cart_id} belongs to another user")
+
+        guest_items = serialize_items(guest_cart)
+        lines = {}
+        for cart_item, cart_item_data in zip(auth_cart.cart_items.all(), serialize_items(auth_cart)):
+            lines.setdefault(item_signature(cart_item_data), cart_item)
+
+        merged, moved, merge_events = {}, [], []
+        for cart_item, cart_item_data in zip(guest_cart.cart_items.all(), guest_items):
+            signature = item_signature(cart_item_data)
+            target = lines.get(signature)
+            if target is None:
+                cart_item.cart_id = auth_cart.pk
+                lines[signature] = cart_item
+                moved.append(cart_item)
+                merge_events.append({'type': 'item_added', 'item': cart_item.pk, 'prod_id': cart_item.prod_id,
+                                     'delta': cart_item.quantity})
+            else:
+                target.quantity += cart_item.quantity
+                merged[target.pk] = target
+                merge_events.append({'type': 'item_updated', 'item': target.pk, 'prod_id': target.prod_id,
+                                     'delta': cart_item.quantity})
+        CartItem.objects.bulk_update(moved, ['cart'])
+        CartItem.objects.bulk_update(merged.values(), ['quantity'])
+
+        guest_cart.delete()
+        reconcile_cart_totals(Cart.objects.filter(pk=auth_cart.pk))
+        # read again: the items prefetched above are missing the lines just moved over
+        auth_document = snapshot.build_cart_document(carts_with_items(Cart.objects.filter(pk=auth_cart.pk)).get())
+
+    ttl = store.cart_ttl(auth_document['user_id'])
+    with store.write_batch() as pipe:
+        store.delete_cart(pipe, guest_cart_id, guest_cart.user_id, guest_items)
+        events.publish(pipe, guest_cart_id, {'type': 'cart_deleted', 'reason': 'merged', 'into': auth_document['id']})
+        store.put_cart(pipe, auth_document, events=merge_events)
+        for cart_item_data in auth_document['cart_items']:
+            store.put_item(pipe, cart_item_data, ttl)
+            for item_option_data in cart_item_data['item_options']:
+                store.put_option(pipe, item_option_data, ttl)
+
+    logger.info(f"Guest cart {guest_cart_id} merged into cart {auth_document['id']}: "
+                f"{len(merged)} lines combined, {len(moved)} moved")
+    return auth_document
@@ -0,0 +1,30 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .unit_of_work import async_unit_of_work, unit_of_work
+
+
+class CartUnitOfWorkMiddleware:
+    """
+    Run each request inside a cart unit of work.
+
+    However many carts, items and options a request touches, every affected Redis
+    document is written once, after the request's DB changes have committed.
+    Async-capable, so that under ASGI it does not push async views into a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with unit_of_work():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        async with async_unit_of_work():
+            return await self.get_response(request)
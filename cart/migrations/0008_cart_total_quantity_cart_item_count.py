@@ -0,0 +1,33 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model("cart", "Cart")
+    CartItem = apps.get_model("cart", "CartItem")
+    active_items = CartItem.objects.filter(cart=OuterRef("pk"), is_active=True).order_by().values("cart")
+    Cart.objects.update(
+        total_quantity=Coalesce(Subquery(active_items.annotate(total=Sum("quantity")).values("total")), 0),
+        item_count=Coalesce(Subquery(active_items.annotate(count=Count("id")).values("count")), 0),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("cart", "0007_merge_0005_wishlist_alter_cart_user_id_0006_wishlist"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cart",
+            name="total_quantity",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="cart",
+            name="item_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_cart_totals, migrations.RunPython.noop),
+    ]
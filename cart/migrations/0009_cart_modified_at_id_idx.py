@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-17 01:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cart', '0008_cart_total_quantity_cart_item_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['modified_at', 'id'], name='cart_modified_at_id_idx'),
+        ),
+    ]
@@ -1,20 +1,13 @@
-import os
-import json
 import uuid
 import logging
 
 import redis
 from django.db import models
-from django.core.serializers.json import DjangoJSONEncoder
-from django.db.models import Sum
 
-logger = logging.getLogger(__name__)
+from . import snapshot, store
+from .unit_of_work import unit_of_work
 
-# Create a Redis client instance
-redis_client = redis.StrictRedis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=os.getenv('REDIS_PORT', 6379),
-    db=0, password=os.getenv('REDIS_PASSWORD', ''))
+logger = logging.getLogger(__name__)
 
 
 class CartItemManager(models.Manager):
@@ -37,80 +30,46 @@ class Wishlist(TimeStampedModel):
     product_id = models.CharField(max_length=50, null=True, blank=True)
 
 
+CART_COUNTER_FIELDS = {'total_quantity', 'item_count'}
+
+
 class Cart(TimeStampedModel):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user_id = models.CharField(max_length=50, null=True, blank=True)
+    # sum of quantities and number of active items, kept up to date with F() updates by cart.signals
+    total_quantity = models.PositiveIntegerField(default=0, editable=False)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     modified_at = models.DateTimeField(auto_now=True)
 
-    @property
-    def total_quantity(self):
-        return self.cart_items.aggregate(total_quantity=Sum('quantity'))['total_quantity'] or 0
-
-    @classmethod
-    def get_cart_from_redis(cls, cart_id):
-        cart_data = redis_client.get(cart_id)
-        if cart_data:
-            return Cart(**json.loads(cart_data.decode('utf-8')))
-        return None
+    class Meta:
+        # warm-up walks carts newest first and the expiry sweep oldest first, both by (modified_at, id)
+        indexes = [models.Index(fields=['modified_at', 'id'], name='cart_modified_at_id_idx')]
 
-    # override to save directly to redis
+    # override to save directly to redis; the write happens once per unit of work, on commit
     def save(self, *args, **kwargs):
+        created = self._state.adding
+        if not created and kwargs.get('update_fields') is None:
+            # the counters change under us through F() updates; never write back a stale copy
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in CART_COUNTER_FIELDS
+            ]
         super().save(*args, **kwargs)
-        self.save_cart_to_redis()
+        with unit_of_work() as uow:
+            uow.record_cart(self, created=created)
 
     def save_cart_to_redis(self):
-        cart_data = {
-            "id": str(self.id),
-            "user_id": self.user_id,
-            "cart_items": [],
-            "total_quantity": self.total_quantity,
-            "created_at": self.created_at,
-            "modified_at": self.modified_at,
-        }
-
-        cart_items_data = []
-
-        # Iterate through related CartItem instances
-        for cart_item in self.cart_items.all():
-            # Load CartItem data
-            cart_item_data = {
-                "id": str(cart_item.id),
-                "cart_id": str(cart_item.cart_id),
-                "prod_id": cart_item.prod_id,
-                "quantity": cart_item.quantity,
-                "is_active": cart_item.is_active,
-                "created_at": cart_item.created_at,
-                "modified_at": cart_item.modified_at,
-            }
-
-            item_options_data = []
-
-            # Iterate through related ItemOption instances for the CartItem
-            for item_option in cart_item.item_options.all():
-                option_data = {
-                    "id": str(item_option.id),
-                    "cart_item_id": str(item_option.cart_item_id),
-                    "attribute": item_option.attribute,
-                    "value": item_option.value,
-                    "created_at": item_option.created_at,
-                    "modified_at": item_option.modified_at,
-                }
-                item_options_data.append(option_data)
-
-            cart_item_data["item_options"] = item_options_data
-            cart_items_data.append(cart_item_data)
-
-        cart_data["cart_items"] = cart_items_data
-
-        cart_data_json = json.dumps(cart_data, cls=DjangoJSONEncoder)
-        redis_cart_key = f'cart:main:{self.id}'
-        redis_user_key = f'cart:user:{self.user_id}'
-
+        """Rebuild the cached cart document from the database (repair/reconcile path)."""
         try:
-            # Attempt to set the data in Redis
-            redis_client.set(redis_cart_key, cart_data_json)
-            redis_client.set(redis_user_key, cart_data_json)
+            document = snapshot.build_cart_document(self)
+            ttl = store.cart_ttl(document['user_id'])
+            with store.write_batch() as pipe:
+                store.put_cart(pipe, document)
+                for cart_item_data in document['cart_items']:
+                    store.put_item(pipe, cart_item_data, ttl)
+                    for item_option_data in cart_item_data['item_options']:
+                        store.put_option(pipe, item_option_data, ttl)
             logging.info(f"Cart with ID 'cart:main:{self.id}' added to Redis successfully")
         except redis.exceptions.ConnectionError as e:
             logging.error(f"Error saving data to Redis: {str(e)}")
@@ -121,6 +80,9 @@ class Cart(TimeStampedModel):
         return str(self.id)
 
 
+QUANTITY_UPDATE_FIELDS = {'quantity', 'modified_at'}
+
+
 class CartItem(TimeStampedModel):
     id = models.AutoField(primary_key=True)
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='cart_items')
@@ -135,76 +97,42 @@ class CartItem(TimeStampedModel):
     def sub_total(self, prod_price):
         return prod_price * self.quantity
 
-    # override to save directly to redis
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_quantity = instance.quantity
+        instance._saved_is_active = instance.is_active
+        return instance
+
+    def counted_totals(self, saved=False):
+        """This item's share of its cart's ``(total_quantity, item_count)``, as stored in the DB if ``saved``."""
+        if saved:
+            quantity, is_active = self._saved_quantity, self._saved_is_active
+        else:
+            quantity, is_active = self.quantity, self.is_active
+        return (quantity, 1) if is_active else (0, 0)
+
+    # override to save directly to redis; the write happens once per unit of work, on commit
     def save(self, *args, **kwargs):
+        created = self._state.adding
         super().save(*args, **kwargs)
-        self.save_cart_item_to_redis()
-
-    # override the safe method to save the cart item to Redis
-    def save_cart_item_to_redis(self, *args, **kwargs):
-        cart_item_data = {
-            "id": str(self.id),
-            "cart_id": str(self.cart_id),
-            "prod_id": self.prod_id,
-            "quantity": self.quantity,
-            "is_active": self.is_active,
-            "created_at": self.created_at,
-            "modified_at": self.modified_at,
-        }
-
-        item_options_data = []
-
-        # Iterate through related ItemOption instances for the CartItem
-        for item_option in self.item_options.all():
-            option_data = {
-                "id": str(item_option.id),
-                "cart_item_id": str(item_option.cart_item_id),
-                "attribute": item_option.attribute,
-                "value": item_option.value,
-                "created_at": item_option.created_at,
-                "modified_at": item_option.modified_at,
-            }
-            item_options_data.append(option_data)
-
-        cart_item_data["item_options"] = item_options_data
-
-        redis_key = f'cart_item:main:{self.id}'
-        redis_cart_key = f'cart_item:cart:{self.cart_id}:{self.id}'
-        cart_item_data_json = json.dumps(cart_item_data, cls=DjangoJSONEncoder)
-
-        try:
-            # Attempt to set the data in Redis
-            redis_client.set(redis_key, cart_item_data_json)
-            redis_client.set(redis_cart_key, cart_item_data_json)
-            logging.info(f"Cart Item with ID 'cart_item:main:{self.id}' added/modified in Redis successfully")
-        except redis.exceptions.ConnectionError as e:
-            logging.error(f"Error saving Cart Item to Redis: {str(e)}")
-        except Exception as e:
-            logging.error(f"An error occurred while saving cart item to Redis: {str(e)}")
-
-        self.cart.save_cart_to_redis()
+        update_fields = kwargs.get('update_fields')
+        with unit_of_work() as uow:
+            if update_fields and set(update_fields) <= QUANTITY_UPDATE_FIELDS and hasattr(self, '_saved_quantity'):
+                # save(update_fields=['quantity', 'modified_at']) is sent to Redis as a counter increment
+                uow.record_quantity_change(self, self.quantity - self._saved_quantity)
+            else:
+                uow.record_item(self, created=created)
+        self._saved_quantity = self.quantity
+        self._saved_is_active = self.is_active
 
     # override the delete method to delete the cart item from Redis
     def delete(self, *args, **kwargs):
-        super().delete(*args, **kwargs)
-
-        # Delete cart item from Redis
-        redis_key = f'cart_item:main:{self.id}'
-        redis_client.delete(redis_key)
-        logging.info(f"Cart Item with ID 'cart_item:main:{self.id}' deleted from Redis successfully")
-
-        # Save cart items to cart's Redis representation after deletion
-        self.cart.save_cart_to_redis()
-
-    # get cart items from redis
-    @classmethod
-    def get_cart_items_from_redis(cls, cart_id):
-        cart_data = redis_client.get(cart_id)
-        if cart_data:
-            cart_dict = json.loads(cart_data.decode('utf-8'))
-            cart_items = cart_dict.get('cart_items', [])
-            return [CartItem(**item) for item in cart_items]
-        return []
+        cart_item_id = self.id
+        result = super().delete(*args, **kwargs)
+        with unit_of_work() as uow:
+            uow.record_item_deleted(self, cart_item_id)
+        return result
 
     def __str__(self):
         return str(self.id)
@@ -220,44 +148,15 @@ class ItemOption(models.Model):
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        self.save_item_options_to_redis()
-
-    def save_item_options_to_redis(self):
-        # Serialize the item option data
-        item_option_data = {
-            "id": str(self.id),
-            "cart_item_id": str(self.cart_item_id),
-            "attribute": self.attribute,
-            "value": self.value,
-            "created_at": self.created_at,
-            "modified_at": self.modified_at,
-        }
-
-        redis_key = f'item_option:main:{self.id}'
-        redis_cart_item_key = f'item_option:cart_item:{self.cart_item_id}:{self.id}'
-        item_option_data_json = json.dumps(item_option_data, cls=DjangoJSONEncoder)
-        try:
-            redis_client.set(redis_cart_item_key, item_option_data_json)
-            redis_client.set(redis_key, item_option_data_json)
-            logging.info(f"Item Option with ID 'item_option:main:{self.id}' added into Redis")
-        except redis.exceptions.ConnectionError as e:
-            logging.error(f"Error saving Item Option to Redis: {str(e)}")
-        except Exception as e:
-            logging.error(f"An error occurred while saving Item Option to Redis: {str(e)}")
-
-        self.cart_item.save_cart_item_to_redis()
+        with unit_of_work() as uow:
+            uow.record_option(self)
 
     def delete(self, *args, **kwargs):
-        # Remove the reference from the cart item's list of item_options
-        self.cart_item.item_options.remove(self)
-
-        super().delete(*args, **kwargs)
-
-        redis_key = f'item_option:main:{self.id}'
-        redis_client.delete(redis_key)
-
-        # Save the cart item to Redis after removing the item option
-        self.cart_item.save_cart_item_to_redis()
+        item_option_id = self.id
+        result = super().delete(*args, **kwargs)
+        with unit_of_work() as uow:
+            uow.record_option_deleted(self, item_option_id)
+        return result
 
     def __str__(self):
         return str(self.id)
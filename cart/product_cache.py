@@ -0,0 +1,234 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, TimeoutError
+from decimal import Decimal
+
+import redis
+
+from .connection import redis_client
+from .products import ProductServiceError
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_CACHE_STATS_KEY = 'product:cache:stats'
+
+
+def product_key(prod_id):
+    return f'product:info:{prod_id}'
+
+
+class LocalTTLCache:
+    """
+    Thread-safe in-process LRU whose entries expire after ``ttl`` seconds.
+
+    A ``None`` value is a negative entry (the product does not exist) and expires after
+    ``negative_ttl``. Each TTL gets up to 10% random jitter so entries cached together
+    do not all expire, and go upstream, together.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30, negative_ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, value = entry
+                if expires_at <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, values):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in values.items():
+                ttl = self.ttl if value is not None else self.negative_ttl
+                self._entries[key] = (now + ttl * random.uniform(0.9, 1.0), value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedProductClient:
+    """
+    Product client with an in-process tier in front of a shared Redis tier.
+
+    Lookups go local cache, then Redis (one MGET), then the wrapped client for whatever
+    is left; results are written back to both tiers. Products the service does not know
+    are cached as negative entries with a shorter TTL. Concurrent lookups of the same
+    missing product are coalesced: the first caller fetches it and the others wait for
+    its result, so a hot product expiring sends one request upstream per process.
+
+    Hit/miss counters are kept per process (``stats()``) and added to the
+    ``product:cache:stats`` Redis hash every ``stats_interval`` seconds, where
+    ``manage.py product_cache_stats`` reports them for all processes.
+    """
+
+    def __init__(self, client, local_ttl=30, local_maxsize=10000, redis_ttl=300, negative_ttl=10,
+                 stats_interval=60, shared=True):
+        self.client = client
+        self.local = LocalTTLCache(local_maxsize, local_ttl, negative_ttl)
+        self.redis_ttl = redis_ttl
+        self.negative_ttl = negative_ttl
+        self.stats_interval = stats_interval
+        self.shared = shared
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._unpublished = Counter()
+        self._published_at = time.monotonic()
+
+    @property
+    def timeout(self):
+        return self.client.timeout
+
+    def fetch_many(self, prod_ids):
+        prod_ids = list(dict.fromkeys(str(prod_id) for prod_id in prod_ids))
+        found = self.local.get_many(prod_ids)
+        self._count(local_hits=len(found), local_misses=len(prod_ids) - len(found))
+
+        missing = [prod_id for prod_id in prod_ids if prod_id not in found]
+        if missing:
+            owned, waiting = self._claim(missing)
+            if owned:
+                found.update(self._load(owned))
+            if waiting:
+                self._count(coalesced=len(waiting))
+                found.update(self._wait(waiting))
+
+        self._count(negative_hits=sum(1 for value in found.values() if value is None))
+        self._maybe_publish_stats()
+        return {prod_id: product for prod_id, product in found.items() if product is not None}
+
+    def _claim(self, prod_ids):
+        owned, waiting = {}, {}
+        with self._lock:
+            for prod_id in prod_ids:
+                future = self._inflight.get(prod_id)
+                if future is None:
+                    owned[prod_id] = self._inflight[prod_id] = Future()
+                else:
+                    waiting[prod_id] = future
+        return owned, waiting
+
+    def _wait(self, waiting):
+        deadline = time.monotonic() + self.timeout
+        try:
+            return {
+                prod_id: future.result(timeout=max(deadline - time.monotonic(), 0))
+                for prod_id, future in waiting.items()
+            }
+        except TimeoutError:
+            raise ProductServiceError(f"Timed out waiting for {len(waiting)} product lookups in progress")
+
+    def _load(self, owned):
+        try:
+            values = self._read_shared(list(owned))
+            rest = [prod_id for prod_id in owned if prod_id not in values]
+            if rest:
+                fetched = self.client.fetch_many(rest)
+                self._count(upstream_fetches=len(rest))
+                fetched = {prod_id: fetched.get(prod_id) for prod_id in rest}
+                self._write_shared(fetched)
+                values.update(fetched)
+            self.local.set_many(values)
+        except BaseException as e:
+            for future in owned.values():
+                future.set_exception(e)
+            raise
+        else:
+            for prod_id, future in owned.items():
+                future.set_result(values[prod_id])
+        finally:
+            with self._lock:
+                for prod_id in owned:
+                    self._inflight.pop(prod_id, None)
+        return values
+
+    def _read_shared(self, prod_ids):
+        if not self.shared:
+            return {}
+        try:
+            raws = redis_client.mget([product_key(prod_id) for prod_id in prod_ids])
+        except redis.RedisError as e:
+            logger.warning(f"Product cache read failed, going to the product service: {e}")
+            return {}
+        values = {prod_id: decode_product(prod_id, raw) for prod_id, raw in zip(prod_ids, raws) if raw is not None}
+        self._count(redis_hits=len(values), redis_misses=len(prod_ids) - len(values))
+        return values
+
+    def _write_shared(self, values):
+        if not self.shared:
+            return
+        pipe = redis_client.pipeline(transaction=False)
+        for prod_id, product in values.items():
+            ttl = self.redis_ttl if product is not None else self.negative_ttl
+            pipe.set(product_key(prod_id), encode_product(product), ex=ttl)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Product cache write failed: {e}")
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                if count:
+                    self._stats[name] += count
+                    self._unpublished[name] += count
+
+    def _maybe_publish_stats(self):
+        if not self.shared or time.monotonic() - self._published_at < self.stats_interval:
+            return
+        with self._lock:
+            unpublished, self._unpublished = self._unpublished, Counter()
+            self._published_at = time.monotonic()
+        if not unpublished:
+            return
+        pipe = redis_client.pipeline(transaction=False)
+        for name, count in unpublished.items():
+            pipe.hincrby(PRODUCT_CACHE_STATS_KEY, name, count)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Publishing product cache stats failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {**dict(self._stats), 'local_size': len(self.local), 'inflight': len(self._inflight)}
+
+
+def encode_product(product):
+    if product is None:
+        return b'null'
+    return json.dumps({'price': str(product['price']), 'stock': product['stock'],
+                       'available': product['available']}).encode()
+
+
+def decode_product(prod_id, raw):
+    data = json.loads(raw)
+    if data is None:
+        return None
+    return {'prod_id': prod_id, 'price': Decimal(data['price']), 'stock': data['stock'],
+            'available': data['available']}
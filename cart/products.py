@@ -0,0 +1,134 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from decimal import Decimal
+from functools import lru_cache
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class ProductServiceError(Exception):
+    pass
+
+
+def parse_product(data):
+    """Normalise a product-service record to ``{'prod_id', 'price', 'stock', 'available'}``."""
+    stock = data.get('stock')
+    available = data.get('is_available', True) and (stock is None or stock > 0)
+    return {
+        'prod_id': str(data.get('prod_id', data.get('id'))),
+        'price': Decimal(str(data['price'])),
+        'stock': stock,
+        'available': bool(available),
+    }
+
+
+class ProductClient:
+    """
+    Looks up many products at once.
+
+    ``fetch_many`` splits the ids into chunks of ``batch_size`` (one id per chunk when
+    ``batch`` is off) and fetches them on a shared pool of ``max_concurrency`` threads,
+    so a lookup takes roughly one round trip per ``max_concurrency`` chunks instead of one
+    per product. ``timeout`` bounds the whole lookup; subclasses implement ``fetch_chunk``.
+    """
+
+    def __init__(self, timeout=2.0, max_concurrency=8, batch=True, batch_size=100):
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.batch = batch
+        self.batch_size = batch_size if batch else 1
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='product-client')
+
+    def fetch_chunk(self, prod_ids):
+        raise NotImplementedError
+
+    def fetch_many(self, prod_ids):
+        """Return ``{prod_id: product}`` for the given ids; unknown products are left out."""
+        prod_ids = list(dict.fromkeys(str(prod_id) for prod_id in prod_ids))
+        if not prod_ids:
+            return {}
+        chunks = [prod_ids[start:start + self.batch_size] for start in range(0, len(prod_ids), self.batch_size)]
+        futures = [self._executor.submit(self.fetch_chunk, chunk) for chunk in chunks]
+        done, pending = wait(futures, timeout=self.timeout)
+        if pending:
+            for future in pending:
+                future.cancel()
+            raise ProductServiceError(f"Product lookup timed out after {self.timeout}s "
+                                      f"({len(pending)} of {len(futures)} requests pending)")
+        products = {}
+        for future in done:
+            products.update(future.result())
+        return products
+
+
+class HTTPProductClient(ProductClient):
+    def __init__(self, base_url, **options):
+        super().__init__(**options)
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_chunk(self, prod_ids):
+        try:
+            if self.batch:
+                response = self.session.get(f'{self.base_url}/products/', params={'ids': ','.join(prod_ids)},
+                                            timeout=self.timeout)
+                response.raise_for_status()
+                data = response.json()
+                records = data['results'] if isinstance(data, dict) else data
+            else:
+                response = self.session.get(f'{self.base_url}/products/{prod_ids[0]}/', timeout=self.timeout)
+                if response.status_code == 404:
+                    return {}
+                response.raise_for_status()
+                records = [response.json()]
+            products = [parse_product(record) for record in records]
+        except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+            logger.error(f"Product lookup failed for {len(prod_ids)} products: {e}")
+            raise ProductServiceError(str(e)) from e
+        return {product['prod_id']: product for product in products}
+
+
+class FakeProductClient(ProductClient):
+    """In-memory product service for tests and local runs; ``latency`` is slept once per chunk."""
+
+    def __init__(self, products=None, latency=0, base_url=None, **options):
+        super().__init__(**options)
+        self.products = {
+            str(prod_id): parse_product({'prod_id': prod_id, **data}) for prod_id, data in (products or {}).items()
+        }
+        self.latency = latency
+        self.requests = []
+
+    def fetch_chunk(self, prod_ids):
+        self.requests.append(prod_ids)
+        if self.latency:
+            time.sleep(self.latency)
+        return {prod_id: self.products[prod_id] for prod_id in prod_ids if prod_id in self.products}
+
+
+@lru_cache(maxsize=None)
+def get_product_client():
+    config = settings.PRODUCT_SERVICE
+    client = import_string(config['CLIENT'])(**config.get('OPTIONS', {}))
+    cache = config.get('CACHE', {})
+    if cache.get('ENABLED', False):
+        from .product_cache import CachedProductClient
+        client = CachedProductClient(
+            client,
+            local_ttl=cache['LOCAL_TTL'],
+            local_maxsize=cache['LOCAL_MAXSIZE'],
+            redis_ttl=cache['REDIS_TTL'],
+            negative_ttl=cache['NEGATIVE_TTL'],
+            stats_interval=cache['STATS_INTERVAL'],
+        )
+    return client
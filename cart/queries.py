@@ -0,0 +1,51 @@
+from django.db.models import Count, F, OuterRef, Prefetch, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Cart, CartItem
+
+
+def cart_items_with_options():
+    return CartItem.objects.prefetch_related('item_options').order_by('created_at', 'id')
+
+
+def carts_with_items(queryset=None):
+    """
+    Carts ready for ``RetrieveCartSerializer`` when Redis misses.
+
+    Items and their options are prefetched and ``total_quantity`` is a column, so any
+    number of carts serializes in three queries: carts, items and options.
+    """
+    if queryset is None:
+        queryset = Cart.objects.all()
+    return queryset.prefetch_related(Prefetch('cart_items', queryset=cart_items_with_options()))
+
+
+def counted_totals():
+    """Annotations with each cart's actual ``(total_quantity, item_count)``, counted from its active items."""
+    active_items = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    return {
+        'actual_total_quantity': Coalesce(Subquery(active_items.annotate(total=Sum('quantity')).values('total')), 0),
+        'actual_item_count': Coalesce(Subquery(active_items.annotate(count=Count('id')).values('count')), 0),
+    }
+
+
+def reconcile_cart_totals(queryset=None, dry_run=False):
+    """
+    Reset the ``total_quantity`` and ``item_count`` counters of carts that drifted from their items.
+
+    Counters only drift when items are changed without ``save()``/``delete()`` (bulk
+    operations, raw SQL). Returns the number of carts that were (or, with ``dry_run``,
+    would be) corrected.
+    """
+    if queryset is None:
+        queryset = Cart.objects.all()
+    drifted = queryset.annotate(**counted_totals()).filter(
+        ~Q(total_quantity=F('actual_total_quantity')) | ~Q(item_count=F('actual_item_count'))
+    )
+    cart_ids = list(drifted.values_list('pk', flat=True))
+    if cart_ids and not dry_run:
+        totals = counted_totals()
+        Cart.objects.filter(pk__in=cart_ids).update(
+            total_quantity=totals['actual_total_quantity'], item_count=totals['actual_item_count'],
+        )
+    return len(cart_ids)
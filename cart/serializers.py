@@ -1,24 +1,21 @@
-import json
 import logging
-import os
 
-import redis
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
 from django.http import HttpResponse
 
 from rest_framework import serializers
 from rest_framework.generics import get_object_or_404
+from rest_framework.renderers import JSONRenderer
 
+from . import snapshot, store
 from .models import Cart, CartItem, ItemOption, Wishlist
-from .utils import get_existing_cart_item_redis, merge_cart_items
-
-redis_client = redis.StrictRedis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=os.getenv('REDIS_PORT', 6379),
-    db=0, password=os.getenv('REDIS_PASSWORD', ''))
+from .utils import add_cart_items, get_existing_cart_item_db, get_existing_cart_item_redis, merge_cart_items
 
 logger = logging.getLogger(__name__)
 
+BULK_MAX_ITEMS = 100
+
 
 class ItemOptionsSerializer(serializers.ModelSerializer):
     class Meta:
@@ -42,9 +39,8 @@ class CartSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         cart = Cart.objects.create(**validated_data)
         if not validated_data['user_id']:
-            print('user_id not set')
+            logger.debug(f"Cart {cart.id} has no user_id, setting the guest cart cookie")
             HttpResponse().set_cookie('guest_cart_id', cart.id, path='/')
-            # print('cookie set response ', response)
         # log new cart creation
         logger.info("New cart created successfully")
         return cart
@@ -92,40 +88,58 @@ class CartItemSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         cart_id = self.context['cart_id']
-        redis_key = f'cart:main:{cart_id}'
-
-        cart_data_json = redis_client.get(redis_key)
-        cart = json.loads(cart_data_json.decode('utf-8'))
-        # if cart is None:
-        #     cart = get_object_or_404(Cart, id=cart_id)
+        cart = store.load_cart_document(cart_id)
+        if cart is None:
+            cart = snapshot.build_cart_document(get_object_or_404(Cart, id=cart_id))
 
         logger.info(f"cart_id {cart_id} context received in CartItemSerializer")
 
         # Remove options from validated_data
         item_options_data = validated_data.pop('item_options', [])
 
-        existing_cart_item = get_existing_cart_item_redis(cart, validated_data['prod_id'], item_options_data)
-        logger.info(f'get_existing_cart_item function returned {existing_cart_item}')
-
-        if existing_cart_item:
-            print('EXISTING CART ITEM AVAILABLE')
-            merge_cart_items(cart, existing_cart_item, validated_data['quantity'])
-            cart_item = existing_cart_item
-        else:
-            logger.warning(f'No cart item with {item_options_data} found')
-            print(f'No cart item with {item_options_data} found')
-            cart_item = CartItem(cart_id=cart['id'], **validated_data)
-            cart_item.save()  # Save the cart item to generate an ID
-
-            # Create and associate ItemOptions instances
-            for option_data in item_options_data:
-                ItemOption.objects.create(cart_item=cart_item, **option_data)
+        # the item and its options commit together, then the cart is flushed to Redis once
+        with transaction.atomic():
+            # adds to one cart queue up on its row, so two requests for a new line cannot both create it
+            Cart.objects.select_for_update().only('id').get(id=cart['id'])
+
+            # the cart loaded above is reused; the line index turns the match into one HGET, and
+            # a miss is confirmed in the DB in case a concurrent add has not reached Redis yet
+            existing_cart_item = (
+                get_existing_cart_item_redis(cart, validated_data['prod_id'], item_options_data)
+                or get_existing_cart_item_db(cart, validated_data['prod_id'], item_options_data)
+            )
+            logger.info(f'get_existing_cart_item function returned {existing_cart_item}')
+
+            if existing_cart_item and merge_cart_items(cart, existing_cart_item, validated_data['quantity']):
+                cart_item = existing_cart_item
+            else:
+                logger.warning(f'No cart item with {item_options_data} found')
+                cart_item = CartItem(cart_id=cart['id'], **validated_data)
+                cart_item.save()  # Save the cart item to generate an ID
+
+                # Create and associate ItemOptions instances
+                for option_data in item_options_data:
+                    ItemOption.objects.create(cart_item=cart_item, **option_data)
 
         # Log the creation or merge of a cart item
         logger.info(f"Cart with ID {cart_id} retrieved")
         return cart_item
 
 
+class BulkCartItemSerializer(serializers.Serializer):
+    items = CartItemSerializer(many=True, allow_empty=False, max_length=BULK_MAX_ITEMS)
+
+    def create(self, validated_data):
+        cart_id = self.context['cart_id']
+        cart = store.load_cart_document(cart_id)
+        if cart is None:
+            cart = snapshot.build_cart_document(get_object_or_404(Cart, id=cart_id))
+
+        items = add_cart_items(cart, validated_data['items'])
+        logger.info(f"{len(validated_data['items'])} items added to cart {cart_id} as {len(items)} lines")
+        return {'items': items}
+
+
 class RetrieveCartSerializer(serializers.ModelSerializer):
     cart_items = CartItemSerializer(many=True)
 
@@ -134,6 +148,27 @@ class RetrieveCartSerializer(serializers.ModelSerializer):
         fields = ['id', 'user_id', 'cart_items', 'total_quantity', 'created_at', 'modified_at']
 
 
+def render_cart(document):
+    """
+    The ``GET /carts/{id}/`` body for a cart document, as stored by ``store.put_cart_view``.
+
+    Rendered from the document as it reads back from Redis, so that it is the same body,
+    byte for byte, as ``RetrieveCartSerializer`` gives for the cached cart.
+    """
+    return JSONRenderer().render(RetrieveCartSerializer(store.decode(store.encode(document))).data)
+
+
+def change_representation(change):
+    """A cart change log entry (see ``store.load_changes``) with its items rendered by ``CartItemSerializer``."""
+    ops = []
+    for op in change['ops']:
+        if 'item' in op:
+            ops.append({'op': op['op'], 'item': CartItemSerializer(op['item']).data})
+        else:
+            ops.append({**op, 'id': int(op['id'])})
+    return {**change, 'ops': ops}
+
+
 class CustomCartItemSerializer(serializers.ModelSerializer):
     cart = CartSerializer(read_only=True, required=False)
     item_options = ItemOptionsSerializer(many=True, required=False)
@@ -152,4 +187,27 @@ class CustomItemOptionsSerializer(serializers.ModelSerializer):
     cart_item = CustomCartItemSerializer(read_only=True)
     class Meta:
         model = ItemOption
-        fields = ['id', 'cart_item', 'attribute', 'value', 'created_at']
\ No newline at end of file
+        fields = ['id', 'cart_item', 'attribute', 'value', 'created_at']
+
+
+class CheckoutLineSerializer(serializers.Serializer):
+    cart_item_id = serializers.CharField()
+    prod_id = serializers.CharField()
+    quantity = serializers.IntegerField()
+    unit_price = serializers.DecimalField(max_digits=None, decimal_places=None, allow_null=True)
+    sub_total = serializers.DecimalField(max_digits=None, decimal_places=None, allow_null=True)
+    available = serializers.BooleanField()
+
+
+class CheckoutUnavailableSerializer(serializers.Serializer):
+    cart_item_id = serializers.CharField()
+    prod_id = serializers.CharField()
+    reason = serializers.CharField()
+
+
+class CheckoutSummarySerializer(serializers.Serializer):
+    cart_id = serializers.CharField()
+    lines = CheckoutLineSerializer(many=True)
+    total_quantity = serializers.IntegerField()
+    total_price = serializers.DecimalField(max_digits=None, decimal_places=None)
+    unavailable = CheckoutUnavailableSerializer(many=True)
@@ -1,12 +1,38 @@
-# Signal receivers to update total_quantity when CartItem is saved or deleted
+# Signal receivers keeping the cart's modified_at and its total_quantity / item_count counters
+# up to date when a CartItem is saved or deleted. Each is a single UPDATE with F() expressions,
+# so concurrent requests never lose each other's changes.
+from django.db.models import F
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
-from cart.models import CartItem
+from cart.models import Cart, CartItem
+from cart.queries import reconcile_cart_totals
+
+
+def update_cart(cart_id, quantity_delta=0, count_delta=0):
+    Cart.objects.filter(pk=cart_id).update(
+        modified_at=timezone.now(),
+        total_quantity=F('total_quantity') + quantity_delta,
+        item_count=F('item_count') + count_delta,
+    )
 
 
 @receiver(post_save, sender=CartItem)
+def update_cart_on_item_save(sender, instance, created, **kwargs):
+    quantity, count = instance.counted_totals()
+    if created:
+        update_cart(instance.cart_id, quantity, count)
+    elif hasattr(instance, '_saved_quantity'):
+        saved_quantity, saved_count = instance.counted_totals(saved=True)
+        update_cart(instance.cart_id, quantity - saved_quantity, count - saved_count)
+    else:
+        # an instance built by hand: what it replaced is unknown, so recount the cart
+        reconcile_cart_totals(Cart.objects.filter(pk=instance.cart_id))
+        update_cart(instance.cart_id)
+
+
 @receiver(post_delete, sender=CartItem)
-def update_cart_total_quantity(sender, instance, **kwargs):
-    print('SIGNAL TRIGGERED')
-    instance.cart.save()
\ No newline at end of file
+def update_cart_on_item_delete(sender, instance, **kwargs):
+    quantity, count = instance.counted_totals(saved=hasattr(instance, '_saved_quantity'))
+    update_cart(instance.cart_id, -quantity, -count)
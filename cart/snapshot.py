@@ -0,0 +1,156 @@
+import logging
+
+from . import store
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_option(item_option):
+    return {
+        "id": str(item_option.id),
+        "cart_item_id": str(item_option.cart_item_id),
+        "attribute": item_option.attribute,
+        "value": item_option.value,
+        "created_at": item_option.created_at,
+        "modified_at": item_option.modified_at,
+    }
+
+
+def serialize_item(cart_item, item_options=()):
+    return {
+        "id": str(cart_item.id),
+        "cart_id": str(cart_item.cart_id),
+        "prod_id": cart_item.prod_id,
+        "quantity": cart_item.quantity,
+        "is_active": cart_item.is_active,
+        "created_at": cart_item.created_at,
+        "modified_at": cart_item.modified_at,
+        "item_options": list(item_options),
+    }
+
+
+def serialize_cart(cart, cart_items=()):
+    cart_items = list(cart_items)
+    return {
+        "id": str(cart.id),
+        "user_id": cart.user_id,
+        "cart_items": cart_items,
+        "total_quantity": sum(item['quantity'] for item in cart_items),
+        "created_at": cart.created_at,
+        "modified_at": cart.modified_at,
+    }
+
+
+def build_cart_document(cart):
+    """
+    Build the full cart document from the database.
+
+    This is the repair/reconcile path: two queries regardless of the number of items or options,
+    or none for a cart from ``queries.carts_with_items``, whose items are already prefetched.
+    """
+    if 'cart_items' in getattr(cart, '_prefetched_objects_cache', {}):
+        cart_items = cart.cart_items.all()
+    else:
+        cart_items = cart.cart_items.prefetch_related('item_options')
+    return serialize_cart(cart, [
+        serialize_item(cart_item, [serialize_option(option) for option in cart_item.item_options.all()])
+        for cart_item in cart_items
+    ])
+
+
+async def abuild_cart_document(cart_id):
+    """
+    ``build_cart_document`` with the async ORM, for the async views; ``None`` if there is no such cart.
+
+    Async querysets cannot prefetch yet, so the cart, its items and their options are three
+    queries joined here.
+    """
+    from .models import Cart, CartItem, ItemOption
+
+    cart = await Cart.objects.filter(pk=cart_id).afirst()
+    if cart is None:
+        return None
+    item_options = {}
+    async for option in ItemOption.objects.filter(cart_item__cart_id=cart_id).order_by('pk'):
+        item_options.setdefault(option.cart_item_id, []).append(serialize_option(option))
+    return serialize_cart(cart, [
+        serialize_item(cart_item, item_options.get(cart_item.pk, []))
+        async for cart_item in CartItem.objects.filter(cart_id=cart_id).order_by('created_at', 'id')
+    ])
+
+
+def find_item(document, cart_item_id):
+    for cart_item in document['cart_items']:
+        if cart_item['id'] == str(cart_item_id):
+            return cart_item
+    return None
+
+
+def apply_cart(document, cart_data):
+    for field in ('user_id', 'created_at', 'modified_at'):
+        document[field] = cart_data[field]
+
+
+def apply_item(document, item_data):
+    """Insert or replace an item in the document, keeping the running total in step."""
+    existing = find_item(document, item_data['id'])
+    if existing is None:
+        document['cart_items'].append(item_data)
+        document['total_quantity'] += item_data['quantity']
+    else:
+        document['total_quantity'] += item_data['quantity'] - existing['quantity']
+        existing.update(item_data)
+    document['modified_at'] = item_data['modified_at']
+
+
+def drop_item(document, cart_item_id):
+    existing = find_item(document, cart_item_id)
+    if existing is not None:
+        document['cart_items'].remove(existing)
+        document['total_quantity'] -= existing['quantity']
+    return existing
+
+
+def apply_option(item_data, option_data):
+    for index, option in enumerate(item_data['item_options']):
+        if option['id'] == option_data['id']:
+            item_data['item_options'][index] = option_data
+            return
+    item_data['item_options'].append(option_data)
+
+
+def drop_option(item_data, item_option_id):
+    item_data['item_options'] = [
+        option for option in item_data['item_options'] if option['id'] != str(item_option_id)
+    ]
+
+
+def patch_cart_document(pipe, cart_id, mutate, rebuild, initial=None, cart_item_ids=None, removed_cart_items=(),
+                        describe=None, events=()):
+    """
+    Apply ``mutate`` to the cached cart document and queue the write on ``pipe``.
+
+    ``initial`` is the starting document for a cart that was just created and is not
+    cached yet. When there is still no document, or ``mutate`` returns ``False`` because
+    the cache does not know about the object being patched, the document is rebuilt
+    from the database with ``rebuild`` instead. ``cart_item_ids`` and ``removed_cart_items``
+    are the items ``mutate`` touched, so the store can write only those; a rebuilt document
+    is always written in full. ``describe(document)`` gives the patched document's entry in
+    the cart's change log; a rebuilt one is logged as a reset. ``events`` are published
+    with the write either way (see ``store.put_cart``).
+    """
+    document = store.load_cart_document(cart_id, touch=False) or initial
+    rebuilt = document is None or mutate(document) is False
+    if rebuilt:
+        logger.warning(f"Cart with ID {cart_id} missing or stale in Redis, rebuilding from DB")
+        document = rebuild()
+
+    if pipe.watching:
+        # the reads are done; an optimistic transaction (see store.watched_write) starts queuing here
+        pipe.multi()
+    if rebuilt:
+        store.put_cart(pipe, document, events=events)
+    else:
+        change = describe(document) if describe is not None else None
+        store.put_cart(pipe, document, cart_item_ids, removed_cart_items, change, events)
+    return document
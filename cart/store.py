@@ -0,0 +1,891 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import codec
+from .events import CART_EVENTS_KEY, encode_events
+from .lines import item_signature
+from .connection import get_async_redis_client, redis_client
+from .listing import CART_INDEX_KEY, CART_ITEM_INDEX_KEY, ITEM_OPTION_INDEX_KEY, index_document, unindex_document
+
+logger = logging.getLogger(__name__)
+
+
+def cart_key(cart_id):
+    return f'cart:main:{cart_id}'
+
+
+def cart_hash_key(cart_id):
+    return f'cart:hash:{cart_id}'
+
+
+def cart_lines_key(cart_id):
+    return f'cart:lines:{cart_id}'
+
+
+def user_cart_key(user_id):
+    return f'cart:user:{user_id}'
+
+
+def cart_view_key(cart_id):
+    return f'cart:view:{cart_id}'
+
+
+def cart_version_key(cart_id):
+    return f'cart:version:{cart_id}'
+
+
+def cart_changes_key(cart_id):
+    return f'cart:changes:{cart_id}'
+
+
+def cart_claim_key(cart_id):
+    return f'cart:claim:{cart_id}'
+
+
+def cart_item_key(cart_item_id):
+    return f'cart_item:main:{cart_item_id}'
+
+
+def cart_item_cart_key(cart_id, cart_item_id):
+    return f'cart_item:cart:{cart_id}:{cart_item_id}'
+
+
+def item_option_key(item_option_id):
+    return f'item_option:main:{item_option_id}'
+
+
+def item_option_cart_item_key(cart_item_id, item_option_id):
+    return f'item_option:cart_item:{cart_item_id}:{item_option_id}'
+
+
+def encode(document):
+    return codec.encode(document)
+
+
+def decode(raw):
+    return codec.decode(raw)
+
+
+def encode_change(change):
+    # change log entries are read by clients as they are, so they are always JSON
+    return json.dumps(change, cls=DjangoJSONEncoder) if change is not None else ''
+
+
+def load(key):
+    raw = redis_client.get(key)
+    if raw:
+        return decode(raw)
+    return None
+
+
+@contextmanager
+def write_batch():
+    """
+    Queue every key update of one mutation on a MULTI/EXEC pipeline.
+
+    The whole batch is sent in a single round trip when the block exits, and readers see
+    either none or all of it, never a cart whose copies disagree.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    yield pipe
+    pipe.execute()
+
+
+# Follows the ``cart:user:{user_id}`` pointer to the cart in the same round trip, along with
+# the cart key's remaining TTL. Values that look like an encoded document (JSON '{' or the
+# msgpack version byte) are full copies written before the key became a pointer and are
+# returned as they are. ARGV: the cart key prefix and the command that reads a cart (GET or HGETALL).
+RESOLVE_USER_CART_SCRIPT = redis_client.register_script("""
+local value = redis.call('GET', KEYS[1])
+if not value then
+    return false
+end
+local first = string.byte(value, 1)
+if first == 123 or first == 1 then
+    return {'copy', value, redis.call('TTL', KEYS[1])}
+end
+local key = ARGV[1] .. value
+return {'cart', redis.call(ARGV[2], key), redis.call('TTL', key)}
+""")
+
+
+def _resolve_user_cart(user_id, layout_key, command):
+    result = RESOLVE_USER_CART_SCRIPT(keys=[user_cart_key(user_id)], args=[layout_key(''), command])
+    if not result:
+        return None, None, -2
+    kind, value, remaining = result
+    return kind.decode('utf-8'), value, remaining
+
+
+async def arun_script(script, keys, args):
+    """Run a script registered on the sync client with the async one."""
+    client = get_async_redis_client()
+    try:
+        return await client.evalsha(script.sha, len(keys), *keys, *args)
+    except redis.exceptions.NoScriptError:
+        await client.script_load(script.script)
+        return await client.evalsha(script.sha, len(keys), *keys, *args)
+
+
+async def _aresolve_user_cart(user_id, layout_key, command):
+    result = await arun_script(RESOLVE_USER_CART_SCRIPT, [user_cart_key(user_id)], [layout_key(''), command])
+    if not result:
+        return None, None, -2
+    kind, value, remaining = result
+    return kind.decode('utf-8'), value, remaining
+
+
+def cart_ttl(user_id):
+    """Seconds a cart stays cached after its last access; guest and user carts have separate TTLs, 0 is forever."""
+    return settings.USER_CART_TTL if user_id else settings.GUEST_CART_TTL
+
+
+def expire_cart(pipe, cart_id, user_id=None, layout=None):
+    """Queue the renewal of the TTL on the cart's keys: the cart, its line index and the user's pointer."""
+    ttl = cart_ttl(user_id)
+    if not ttl:
+        return
+    keys = [
+        (layout or get_layout()).key(cart_id), cart_lines_key(cart_id), cart_view_key(cart_id), cart_version_key(cart_id),
+        cart_changes_key(cart_id),
+    ]
+    if user_id:
+        keys.append(user_cart_key(user_id))
+    for key in keys:
+        pipe.expire(key, ttl)
+
+
+def touch_cart(document, remaining):
+    """
+    Renew the TTL of a cart that was just read, given what was ``remaining`` of it.
+
+    Renewal waits until ``CART_TTL_REFRESH_INTERVAL`` seconds of the TTL have run down,
+    so a busy cart costs one EXPIRE round trip per interval rather than one per read.
+    Carts cached before TTLs existed (``remaining`` of -1) are renewed right away.
+    """
+    if not _needs_touch(document, remaining):
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    expire_cart(pipe, document['id'], document['user_id'])
+    pipe.execute()
+
+
+async def atouch_cart(document, remaining):
+    """``touch_cart`` on the async client."""
+    if not _needs_touch(document, remaining):
+        return
+    pipe = get_async_redis_client().pipeline(transaction=False)
+    expire_cart(pipe, document['id'], document['user_id'])
+    await pipe.execute()
+
+
+def _needs_touch(document, remaining):
+    if document is None:
+        return False
+    ttl = cart_ttl(document['user_id'])
+    return bool(ttl) and not (remaining >= 0 and 0 <= ttl - remaining < settings.CART_TTL_REFRESH_INTERVAL)
+
+
+def watched_write(cart_id, write):
+    """
+    Run ``write(pipe)`` as an optimistic transaction on the cart.
+
+    The cart's key is WATCHed; ``write`` does its reads, calls ``pipe.multi()`` and queues its
+    writes. If another client changes the cart before EXEC, nothing is written and ``write``
+    runs again on fresh data. Returns what ``write`` returned.
+    """
+    return redis_client.transaction(write, get_layout().key(cart_id), value_from_callable=True)
+
+
+class DocumentLayout:
+    """
+    One encoded document per cart under ``cart:main:{id}``; ``cart:user:{user_id}`` holds the cart ID.
+
+    Items are also copied to their own ``cart_item:*`` keys. Any change rewrites the whole
+    document.
+    """
+    name = 'document'
+    key = staticmethod(cart_key)
+
+    def load_cart(self, cart_id):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(cart_key(cart_id))
+        pipe.ttl(cart_key(cart_id))
+        raw, remaining = pipe.execute()
+        return (decode(raw) if raw else None), remaining
+
+    async def aload_cart(self, cart_id):
+        pipe = get_async_redis_client().pipeline(transaction=False)
+        pipe.get(cart_key(cart_id))
+        pipe.ttl(cart_key(cart_id))
+        raw, remaining = await pipe.execute()
+        return (decode(raw) if raw else None), remaining
+
+    def load_carts(self, cart_ids):
+        if not cart_ids:
+            return []
+        return [decode(raw) if raw else None for raw in redis_client.mget([cart_key(cart_id) for cart_id in cart_ids])]
+
+    def load_user_cart(self, user_id):
+        kind, value, remaining = _resolve_user_cart(user_id, cart_key, 'GET')
+        return (decode(value) if value else None), remaining
+
+    async def aload_user_cart(self, user_id):
+        kind, value, remaining = await _aresolve_user_cart(user_id, cart_key, 'GET')
+        return (decode(value) if value else None), remaining
+
+    def load_item(self, cart_id, cart_item_id):
+        return load(cart_item_key(cart_item_id)) or load(cart_item_cart_key(cart_id, cart_item_id))
+
+    def put_cart(self, pipe, document, cart_item_ids=None, removed_cart_items=()):
+        pipe.set(cart_key(document['id']), encode(document))
+        if document['user_id']:
+            pipe.set(user_cart_key(document['user_id']), document['id'])
+
+    def delete_cart(self, pipe, cart_id, user_id=None):
+        keys = [cart_key(cart_id)]
+        if user_id:
+            keys.append(user_cart_key(user_id))
+        pipe.delete(*keys)
+
+    def put_item(self, pipe, item_data, ttl=None):
+        cart_item_data_json = encode(item_data)
+        pipe.set(cart_item_key(item_data['id']), cart_item_data_json, ex=ttl or None)
+        pipe.set(cart_item_cart_key(item_data['cart_id'], item_data['id']), cart_item_data_json, ex=ttl or None)
+        index_document(CART_ITEM_INDEX_KEY, item_data['id'], item_data['created_at'], pipe=pipe)
+
+    def delete_item(self, pipe, item_data):
+        pipe.delete(cart_item_key(item_data['id']), cart_item_cart_key(item_data['cart_id'], item_data['id']))
+        unindex_document(CART_ITEM_INDEX_KEY, item_data['id'], pipe=pipe)
+
+    def increment_quantities(self, cart_id, quantity_deltas, modified_at, events=()):
+        # a blob can only be changed by rewriting it
+        return False
+
+
+# Appends a change to a cart's change log (see ``put_cart``) as entry ``{version}-0``, so the
+# log can be read by version; an empty change is logged as a reset. A log left ahead of a
+# version counter that was lost and started over is dropped first.
+LOG_CHANGE_LUA = """
+local function log_change(key, version, maxlen, change)
+    local fields = change == '' and {'reset', '1'} or {'change', change}
+    local added = redis.pcall('XADD', key, 'MAXLEN', maxlen, version .. '-0', unpack(fields))
+    if type(added) == 'table' and added['err'] then
+        redis.call('DEL', key)
+        redis.call('XADD', key, 'MAXLEN', maxlen, version .. '-0', unpack(fields))
+    end
+end
+"""
+
+# Publishes a cart write's events (see ``events.encode_events``) to the ``cart:events`` feed,
+# stamped with the cart's ID and the version the write made.
+PUBLISH_EVENTS_LUA = """
+local function publish_events(key, maxlen, cart_id, version, events)
+    for _, fields in ipairs(cjson.decode(events)) do
+        redis.call('XADD', key, 'MAXLEN', '~', maxlen, '*', 'cart_id', cart_id, 'version', version, unpack(fields))
+    end
+end
+"""
+
+# Adds quantity deltas to a cart hash in one step, but only when every item is already in
+# it, so a cold or stale cart is never half-patched. The items' and the cart's modified_at
+# fields are set along with their counters. The cart's rendered view (KEYS[2]) is
+# dropped rather than re-rendered, and its version (KEYS[3]) bumped, the new quantities
+# logged (KEYS[4]) and the events published (KEYS[5]) as ``bump_version`` does.
+# ARGV: modified_at, the version seed, the log length, modified_at as JSON, the cart ID, the
+# feed's length, the events, then id/delta pairs.
+INCREMENT_QUANTITIES_SCRIPT = redis_client.register_script(LOG_CHANGE_LUA + PUBLISH_EVENTS_LUA + """
+for i = 8, #ARGV, 2 do
+    if redis.call('HEXISTS', KEYS[1], 'item:' .. ARGV[i]) == 0 then
+        return 0
+    end
+end
+local ops = {}
+local total_quantity = 0
+for i = 8, #ARGV, 2 do
+    local quantity = redis.call('HINCRBY', KEYS[1], 'qty:' .. ARGV[i], ARGV[i + 1])
+    redis.call('HSET', KEYS[1], 'mod:' .. ARGV[i], ARGV[1])
+    total_quantity = redis.call('HINCRBY', KEYS[1], 'total_quantity', ARGV[i + 1])
+    ops[#ops + 1] = {op = 'quantity', id = ARGV[i], quantity = quantity}
+end
+redis.call('HSET', KEYS[1], 'modified_at', ARGV[1])
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[3], ARGV[2], 'NX')
+redis.call('INCR', KEYS[3])
+local change = {total_quantity = total_quantity, modified_at = cjson.decode(ARGV[4]), ops = ops}
+local version = redis.call('GET', KEYS[3])
+log_change(KEYS[4], version, ARGV[3], cjson.encode(change))
+publish_events(KEYS[5], ARGV[6], ARGV[5], version, ARGV[7])
+local ttl = redis.call('TTL', KEYS[1])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[3], ttl)
+    redis.call('EXPIRE', KEYS[4], ttl)
+end
+return 1
+""")
+
+
+class HashLayout:
+    """
+    One Redis hash per cart under ``cart:hash:{id}``.
+
+    Fields are ``meta`` (id, user_id and created_at), ``modified_at``, a ``total_quantity``
+    counter, and for every item an encoded ``item:{id}``, a ``qty:{id}`` counter and its
+    ``mod:{id}`` modified_at. The two fields a quantity change touches are kept out of the
+    encoded item, so quantity changes are an HINCRBY and an HSET that leave it as it is;
+    other item changes rewrite only that item's fields.
+    As in the document layout, ``cart:user:{user_id}`` holds the cart ID.
+    """
+    name = 'hash'
+    key = staticmethod(cart_hash_key)
+
+    def load_cart(self, cart_id):
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(cart_hash_key(cart_id))
+        pipe.ttl(cart_hash_key(cart_id))
+        fields, remaining = pipe.execute()
+        return self._assemble(fields), remaining
+
+    async def aload_cart(self, cart_id):
+        pipe = get_async_redis_client().pipeline(transaction=False)
+        pipe.hgetall(cart_hash_key(cart_id))
+        pipe.ttl(cart_hash_key(cart_id))
+        fields, remaining = await pipe.execute()
+        return self._assemble(fields), remaining
+
+    def load_carts(self, cart_ids):
+        pipe = redis_client.pipeline(transaction=False)
+        for cart_id in cart_ids:
+            pipe.hgetall(cart_hash_key(cart_id))
+        return [self._assemble(fields) for fields in pipe.execute()]
+
+    def load_user_cart(self, user_id):
+        return self._assemble_user_cart(*_resolve_user_cart(user_id, cart_hash_key, 'HGETALL'))
+
+    async def aload_user_cart(self, user_id):
+        return self._assemble_user_cart(*await _aresolve_user_cart(user_id, cart_hash_key, 'HGETALL'))
+
+    def _assemble_user_cart(self, kind, value, remaining):
+        if kind == 'copy':
+            return decode(value), remaining
+        if not value:
+            return None, remaining
+        return self._assemble(dict(zip(value[::2], value[1::2]))), remaining
+
+    def load_item(self, cart_id, cart_item_id):
+        raw, quantity, modified_at = redis_client.hmget(
+            cart_hash_key(cart_id), f'item:{cart_item_id}', f'qty:{cart_item_id}', f'mod:{cart_item_id}',
+        )
+        if raw is None:
+            return None
+        return self._assemble_item(raw, quantity, modified_at)
+
+    def put_cart(self, pipe, document, cart_item_ids=None, removed_cart_items=()):
+        key = cart_hash_key(document['id'])
+        fields = {
+            'meta': encode({'id': document['id'], 'user_id': document['user_id'], 'created_at': document['created_at']}),
+            'modified_at': encode(document['modified_at']),
+            'total_quantity': document['total_quantity'],
+        }
+        if cart_item_ids is None:
+            pipe.delete(key)
+            cart_items = document['cart_items']
+        else:
+            cart_items = [item for item in document['cart_items'] if item['id'] in cart_item_ids]
+            removed_fields = [
+                f'{prefix}:{item["id"]}' for item in removed_cart_items for prefix in ('item', 'qty', 'mod')
+            ]
+            if removed_fields:
+                pipe.hdel(key, *removed_fields)
+        for cart_item_data in cart_items:
+            item = {field: value for field, value in cart_item_data.items() if field not in ('quantity', 'modified_at')}
+            fields[f'item:{cart_item_data["id"]}'] = encode(item)
+            fields[f'qty:{cart_item_data["id"]}'] = cart_item_data['quantity']
+            fields[f'mod:{cart_item_data["id"]}'] = encode(cart_item_data['modified_at'])
+        pipe.hset(key, mapping=fields)
+
+        if document['user_id']:
+            pipe.set(user_cart_key(document['user_id']), document['id'])
+
+    def delete_cart(self, pipe, cart_id, user_id=None):
+        keys = [cart_hash_key(cart_id)]
+        if user_id:
+            keys.append(user_cart_key(user_id))
+        pipe.delete(*keys)
+
+    def put_item(self, pipe, item_data, ttl=None):
+        # items only live inside the cart hash
+        pass
+
+    def delete_item(self, pipe, item_data):
+        pass
+
+    def increment_quantities(self, cart_id, quantity_deltas, modified_at, events=()):
+        args = [
+            encode(modified_at), version_seed(), settings.CART_CHANGE_LOG_LENGTH, encode_change(modified_at),
+            cart_id, settings.CART_EVENTS_MAXLEN, encode_events(events),
+        ]
+        for cart_item_id, delta in quantity_deltas.items():
+            args.extend([cart_item_id, delta])
+        keys = [
+            cart_hash_key(cart_id), cart_view_key(cart_id), cart_version_key(cart_id), cart_changes_key(cart_id),
+            CART_EVENTS_KEY,
+        ]
+        return bool(INCREMENT_QUANTITIES_SCRIPT(keys=keys, args=args))
+
+    def _assemble(self, fields):
+        if not fields or b'meta' not in fields:
+            return None
+        document = decode(fields[b'meta'])
+        document['modified_at'] = decode(fields[b'modified_at'])
+        document['total_quantity'] = int(fields.get(b'total_quantity', 0))
+        cart_items = [
+            self._assemble_item(raw, fields.get(b'qty:' + field[5:]), fields.get(b'mod:' + field[5:]))
+            for field, raw in fields.items() if field.startswith(b'item:')
+        ]
+        # hash fields are unordered; items are listed in the order they were added
+        document['cart_items'] = sorted(cart_items, key=lambda item: int(item['id']))
+        return document
+
+    def _assemble_item(self, raw, quantity, modified_at):
+        cart_item_data = decode(raw)
+        cart_item_data['quantity'] = int(quantity or 0)
+        # items cached before ``mod:{id}`` existed carry their modified_at inside
+        if modified_at is not None:
+            cart_item_data['modified_at'] = decode(modified_at)
+        return cart_item_data
+
+
+LAYOUTS = {layout.name: layout for layout in (DocumentLayout(), HashLayout())}
+
+
+def get_layout(name=None):
+    return LAYOUTS[name or getattr(settings, 'CART_STORAGE_LAYOUT', 'document')]
+
+
+def load_cart_document(cart_id, touch=True):
+    """
+    The cached cart, or ``None``. Reading a cart counts as an access and renews its TTL
+    (see ``touch_cart``) unless ``touch`` is off, as for reads about to be followed by a write.
+    """
+    document, remaining = get_layout().load_cart(cart_id)
+    if touch:
+        touch_cart(document, remaining)
+    return document
+
+
+async def aload_cart_document(cart_id):
+    """``load_cart_document`` on the async client, for the async views."""
+    document, remaining = await get_layout().aload_cart(cart_id)
+    await atouch_cart(document, remaining)
+    return document
+
+
+def load_cart_documents(cart_ids):
+    """Load several carts in one round trip; missing carts come back as ``None``."""
+    return get_layout().load_carts(cart_ids)
+
+
+def load_user_cart_document(user_id):
+    document, remaining = get_layout().load_user_cart(user_id)
+    touch_cart(document, remaining)
+    return document
+
+
+async def aload_user_cart_document(user_id):
+    document, remaining = await get_layout().aload_user_cart(user_id)
+    await atouch_cart(document, remaining)
+    return document
+
+
+def load_item_document(cart_id, cart_item_id):
+    return get_layout().load_item(cart_id, cart_item_id)
+
+
+def put_cart(pipe, document, cart_item_ids=None, removed_cart_items=(), change=None, events=()):
+    """
+    Queue a write of the cart ``document``.
+
+    When ``cart_item_ids`` is given, only those items (and ``removed_cart_items``) changed,
+    and the layout may write just them instead of the whole cart. Every write renews the
+    cart's TTL and bumps its version.
+
+    ``change`` describes the write for the cart's change log (see ``load_changes``): the
+    cart's ``total_quantity`` and ``modified_at`` and a list of ``ops``, each one of
+    ``{'op': 'add' | 'update', 'item': item}``, ``{'op': 'remove', 'id': id}`` or
+    ``{'op': 'quantity', 'id': id, 'quantity': quantity}``. Without one the version is logged
+    as a reset, which readers of the log can only catch up with from a snapshot. ``events``
+    are published to the ``cart:events`` feed with the new version (see ``cart.events``).
+    """
+    get_layout().put_cart(pipe, document, cart_item_ids, removed_cart_items)
+    put_lines(pipe, document, cart_item_ids, removed_cart_items)
+    bump_version(pipe, document['id'], change, events)
+    put_cart_view(pipe, document)
+    index_document(CART_INDEX_KEY, document['id'], document['created_at'], pipe=pipe)
+    expire_cart(pipe, document['id'], document['user_id'])
+
+
+def put_lines(pipe, document, cart_item_ids=None, removed_cart_items=()):
+    """
+    Maintain ``cart:lines:{id}``, a hash from each item's line signature to its ID.
+
+    A signature can outlive a change of the item's options, so readers check the item
+    they are pointed at (see ``find_line``).
+    """
+    key = cart_lines_key(document['id'])
+    if cart_item_ids is None:
+        pipe.delete(key)
+        cart_items = document['cart_items']
+    else:
+        cart_items = [item for item in document['cart_items'] if item['id'] in cart_item_ids]
+        # items removed before the cache knew them have no prod_id; their lines were never indexed
+        removed = [item_signature(item) for item in removed_cart_items if 'prod_id' in item]
+        if removed:
+            pipe.hdel(key, *removed)
+    if cart_items:
+        pipe.hset(key, mapping={item_signature(item): item['id'] for item in cart_items})
+
+
+# Claims the cart for one conditional write if its version (KEYS[1]) is one of ARGV[3..] (or
+# one of them is '*' and the cart has a version), by setting KEYS[2] to the token ARGV[1] for
+# ARGV[2] milliseconds. Returns {1, version} when claimed, {-1, version} when another write
+# holds the claim, and {0, version} without writing anything when the version does not match.
+CLAIM_VERSION_SCRIPT = redis_client.register_script("""
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return {0, false}
+end
+for i = 3, #ARGV do
+    if ARGV[i] == '*' or ARGV[i] == current then
+        if redis.call('SET', KEYS[2], ARGV[1], 'NX', 'PX', ARGV[2]) then
+            return {1, current}
+        end
+        return {-1, current}
+    end
+end
+return {0, current}
+""")
+
+# Drops the claim KEYS[1] if it is still held with the token ARGV[1].
+RELEASE_CLAIM_SCRIPT = redis_client.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def cart_etag(version):
+    """The strong ETag of a cart version."""
+    return f'"{int(version)}"'
+
+
+def parse_cart_version(value):
+    """
+    The cart version in ``value``, an ETag (``"5"``) or a bare number; ``None`` when it is not
+    one. Versions are stream entry IDs in the change log, so only what fits one is accepted.
+    """
+    digits = value.strip('"')
+    if not (digits.isascii() and digits.isdigit()) or len(digits) > 19:
+        return None
+    return int(digits)
+
+
+def version_seed():
+    # a missing counter (never set, or expired or flushed with the cart) starts from the clock in
+    # microseconds, so versions keep growing across cache losses and an old ETag never names a newer cart
+    return time.time_ns() // 1000
+
+
+# Bumps the version (KEYS[1]) as seeded by ARGV[1], logs ARGV[3] under it (KEYS[2], capped
+# at ARGV[2] entries) and publishes the events ARGV[6] of cart ARGV[4] (KEYS[3], capped at
+# about ARGV[5] entries); returns the new version. Sent as EVAL: a registered script queued
+# on a pipeline costs a SCRIPT EXISTS round trip first.
+BUMP_VERSION_LUA = LOG_CHANGE_LUA + PUBLISH_EVENTS_LUA + """
+redis.call('SET', KEYS[1], ARGV[1], 'NX')
+local version = redis.call('INCR', KEYS[1])
+local version_string = redis.call('GET', KEYS[1])
+log_change(KEYS[2], version_string, ARGV[2], ARGV[3])
+publish_events(KEYS[3], ARGV[5], ARGV[4], version_string, ARGV[6])
+return version
+"""
+
+
+def bump_version(pipe, cart_id, change=None, events=()):
+    """
+    Queue a bump of the cart's version, one command that returns the new version, log
+    ``change`` under it (see ``put_cart``) and publish ``events`` with it to the
+    ``cart:events`` feed. Every change of a cached cart makes one.
+    """
+    pipe.eval(BUMP_VERSION_LUA, 3, cart_version_key(cart_id), cart_changes_key(cart_id), CART_EVENTS_KEY,
+              version_seed(), settings.CART_CHANGE_LOG_LENGTH, encode_change(change),
+              str(cart_id), settings.CART_EVENTS_MAXLEN, encode_events(events))
+
+
+CLAIMED, CLAIM_HELD, STALE = 'claimed', 'held', 'stale'
+
+
+def claim_version(cart_id, etags, token):
+    """
+    Claim the cart for a write made on the condition that its current ETag is one of ``etags``
+    (``'*'`` for any). Returns ``(outcome, etag)``, with the current ETag (``None`` when the
+    cart has no version, as when it is not cached): ``CLAIMED`` when it matched and the cart
+    is now held under ``token``, until ``release_version_claim`` or for at most
+    ``CART_WRITE_CLAIM_TTL`` seconds; ``CLAIM_HELD`` when it matched but another conditional
+    write holds the cart; ``STALE`` when it did not match.
+
+    The version itself is only bumped by the write, in the same MULTI/EXEC or script that
+    changes the cart and its view, so a read never pairs the old body with a new ETag and a
+    write that fails uses up no version. Two requests sent with the same ETag cannot both
+    claim the cart, so at most one of them goes on to change the cart the client saw.
+    """
+    versions = ['*' if etag == '*' else etag.strip('"') for etag in etags]
+    claimed, version = CLAIM_VERSION_SCRIPT(
+        keys=[cart_version_key(cart_id), cart_claim_key(cart_id)],
+        args=[token, settings.CART_WRITE_CLAIM_TTL * 1000, *versions],
+    )
+    outcome = {1: CLAIMED, -1: CLAIM_HELD}.get(claimed, STALE)
+    return outcome, (cart_etag(version) if version is not None else None)
+
+
+def release_version_claim(cart_id, token):
+    """Drop the claim ``claim_version`` took under ``token``, unless it has expired and been taken since."""
+    RELEASE_CLAIM_SCRIPT(keys=[cart_claim_key(cart_id)], args=[token])
+
+
+def put_cart_view(pipe, document):
+    """
+    Queue a write of ``cart:view:{id}``, the cart's ``GET`` response body as rendered by
+    ``RetrieveCartSerializer``, with the owner's user ID; returns the body.
+
+    Reads of a cached cart then return the stored bytes as they are (see ``load_cart_view``):
+    the cart is rendered once per write instead of once per read.
+    """
+    if not settings.CART_VIEW_CACHE:
+        return None
+    from .serializers import render_cart  # serializers imports this module
+
+    body = render_cart(document)
+    pipe.hset(cart_view_key(document['id']), mapping={'body': body, 'user_id': document['user_id'] or ''})
+    return body
+
+
+def _cart_view_fields(body):
+    return ('body', 'user_id') if body else ('user_id',)
+
+
+def _cart_view(version, fields, body):
+    """``(etag, body, user_id)`` from what a view read returned."""
+    etag = cart_etag(version) if version is not None else None
+    body, user_id = fields if body else (None, *fields)
+    return etag, body, user_id.decode('utf-8') if user_id is not None else None
+
+
+def load_cart_view(cart_id, body=True):
+    """
+    ``(etag, body)`` of the cart: its version's ETag and its rendered view, each ``None``
+    when it is not cached. With ``body`` off only the ETag is read, to answer ``If-None-Match``.
+    One round trip; like any read of the cart, it renews the cart's TTL (see ``touch_cart``).
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.get(cart_version_key(cart_id))
+    pipe.hmget(cart_view_key(cart_id), *_cart_view_fields(body))
+    pipe.ttl(cart_view_key(cart_id))
+    version, fields, remaining = pipe.execute()
+    etag, body, user_id = _cart_view(version, fields, body)
+    if user_id is not None:
+        touch_cart({'id': str(cart_id), 'user_id': user_id}, remaining)
+    return etag, body
+
+
+async def aload_cart_view(cart_id, body=True):
+    pipe = get_async_redis_client().pipeline(transaction=False)
+    pipe.get(cart_version_key(cart_id))
+    pipe.hmget(cart_view_key(cart_id), *_cart_view_fields(body))
+    pipe.ttl(cart_view_key(cart_id))
+    version, fields, remaining = await pipe.execute()
+    etag, body, user_id = _cart_view(version, fields, body)
+    if user_id is not None:
+        await atouch_cart({'id': str(cart_id), 'user_id': user_id}, remaining)
+    return etag, body
+
+
+# ``load_cart_view`` by user: follows the ``cart:user:{user_id}`` pointer to the cart's version
+# and view in one round trip. Returns the cart ID, the version, the view's fields and its TTL,
+# or nothing for a user without a cached cart. ARGV: the version and view key prefixes, then
+# the view fields to read.
+USER_CART_VIEW_SCRIPT = redis_client.register_script("""
+local cart_id = redis.call('GET', KEYS[1])
+if not cart_id then
+    return false
+end
+local first = string.byte(cart_id, 1)
+if first == 123 or first == 1 then
+    return false
+end
+local key = ARGV[2] .. cart_id
+return {
+    cart_id, redis.call('GET', ARGV[1] .. cart_id),
+    redis.call('HMGET', key, unpack(ARGV, 3)), redis.call('TTL', key),
+}
+""")
+
+
+def _user_cart_view_args(body):
+    return [cart_version_key(''), cart_view_key(''), *_cart_view_fields(body)]
+
+
+def load_user_cart_view(user_id, body=True):
+    """
+    ``(cart_id, etag, body)`` for the user's cart, as from ``load_cart_view``; all ``None``
+    when the user's cart is not cached, or only as a full copy.
+    """
+    result = USER_CART_VIEW_SCRIPT(keys=[user_cart_key(user_id)], args=_user_cart_view_args(body))
+    if not result:
+        return None, None, None
+    cart_id, version, fields, remaining = result
+    etag, body, owner = _cart_view(version, fields, body)
+    if owner is not None:
+        touch_cart({'id': cart_id.decode('utf-8'), 'user_id': owner}, remaining)
+    return cart_id.decode('utf-8'), etag, body
+
+
+async def aload_user_cart_view(user_id, body=True):
+    result = await arun_script(USER_CART_VIEW_SCRIPT, [user_cart_key(user_id)], _user_cart_view_args(body))
+    if not result:
+        return None, None, None
+    cart_id, version, fields, remaining = result
+    etag, body, owner = _cart_view(version, fields, body)
+    if owner is not None:
+        await atouch_cart({'id': cart_id.decode('utf-8'), 'user_id': owner}, remaining)
+    return cart_id.decode('utf-8'), etag, body
+
+
+def cache_cart_view(cart_id):
+    """
+    Render and store the view of a cached cart that has none (its quantities were incremented
+    in place, or it was cached before views existed) and return ``(etag, body)``, or ``None``
+    when the cart is not cached.
+
+    The cart is WATCHed while it is read, so when a write comes in between, the cart is read
+    again rather than a stale view stored. The version is bumped along with the view, so the
+    ETag returned is the one of this very body.
+    """
+    rendered = []
+
+    def write(pipe):
+        rendered.clear()
+        document = load_cart_document(cart_id)
+        if document is None:
+            return
+        pipe.multi()
+        # nothing changed but the version
+        bump_version(pipe, cart_id, {
+            'total_quantity': document['total_quantity'], 'modified_at': document['modified_at'], 'ops': [],
+        })
+        rendered.append(put_cart_view(pipe, document))
+        expire_cart(pipe, cart_id, document['user_id'])
+
+    results = redis_client.transaction(write, get_layout().key(cart_id))
+    if not rendered:
+        return None
+    return cart_etag(results[0]), rendered[0]
+
+
+def _entry_version(entry_id):
+    return int(entry_id.split(b'-')[0])
+
+
+def load_changes(cart_id, since):
+    """
+    What changed in the cached cart after version ``since``, from its change log.
+
+    Returns ``(version, changes)``: the cart's current version (``None`` when it is not
+    cached) and its logged changes since then in order, each with its ``version`` (see
+    ``put_cart``). ``changes`` is ``None`` when the log cannot tell: it no longer reaches
+    back to ``since`` because it was trimmed or lost, or a reset was logged since then.
+    """
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.get(cart_version_key(cart_id))
+    pipe.xrange(cart_changes_key(cart_id), count=1)
+    pipe.xrange(cart_changes_key(cart_id), min=f'{since + 1}-0')
+    version, oldest, entries = pipe.execute()
+    if version is None:
+        return None, None
+    version = int(version)
+    if not oldest or not _entry_version(oldest[0][0]) <= since <= version:
+        return version, None
+
+    changes = []
+    for entry_id, fields in entries:
+        if b'change' not in fields:
+            return version, None
+        changes.append({'version': _entry_version(entry_id), **json.loads(fields[b'change'])})
+    return version, changes
+
+
+def find_lines(cart_id, signatures):
+    """
+    The IDs of the items whose line signatures are ``signatures`` (``None`` where there is
+    none), with one HMGET.
+
+    Returns ``(cart_item_ids, indexed)``; ``indexed`` is ``False`` when the cart has no line
+    index at all (cached before it existed), so a miss does not prove the line is absent.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hmget(cart_lines_key(cart_id), signatures)
+    pipe.exists(cart_lines_key(cart_id))
+    cart_item_ids, indexed = pipe.execute()
+    return [cart_item_id.decode('utf-8') if cart_item_id else None for cart_item_id in cart_item_ids], bool(indexed)
+
+
+def delete_cart(pipe, cart_id, user_id=None, cart_items=()):
+    get_layout().delete_cart(pipe, cart_id, user_id)
+    pipe.delete(cart_lines_key(cart_id), cart_view_key(cart_id), cart_version_key(cart_id), cart_changes_key(cart_id))
+    unindex_document(CART_INDEX_KEY, cart_id, pipe=pipe)
+    for cart_item_data in cart_items:
+        delete_item(pipe, cart_item_data)
+
+
+def increment_quantities(cart_id, quantity_deltas, modified_at, events=()):
+    """
+    Add ``quantity_deltas`` (item ID -> delta) to the cached cart without reading it, and
+    publish ``events`` as ``put_cart`` does.
+
+    Returns ``False`` when nothing was written, because the layout cannot do that or the
+    cart is not fully cached; the caller then falls back to patching the document.
+    """
+    return get_layout().increment_quantities(cart_id, quantity_deltas, modified_at, events)
+
+
+def put_item(pipe, item_data, ttl=None):
+    """Queue a write of the item's own keys, expiring after ``ttl`` seconds (normally its cart's ``cart_ttl``)."""
+    get_layout().put_item(pipe, item_data, ttl)
+
+
+def delete_item(pipe, item_data):
+    get_layout().delete_item(pipe, item_data)
+    for option_data in item_data['item_options']:
+        delete_option(pipe, option_data)
+
+
+def put_option(pipe, option_data, ttl=None):
+    item_option_data_json = encode(option_data)
+    pipe.set(item_option_key(option_data['id']), item_option_data_json, ex=ttl or None)
+    pipe.set(item_option_cart_item_key(option_data['cart_item_id'], option_data['id']), item_option_data_json,
+             ex=ttl or None)
+    index_document(ITEM_OPTION_INDEX_KEY, option_data['id'], option_data['created_at'], pipe=pipe)
+
+
+def delete_option(pipe, option_data):
+    pipe.delete(
+        item_option_key(option_data['id']),
+        item_option_cart_item_key(option_data['cart_item_id'], option_data['id']),
+    )
+    unindex_document(ITEM_OPTION_INDEX_KEY, option_data['id'], pipe=pipe)
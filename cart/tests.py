@@ -1,3 +1,1098 @@
-from django.test import TestCase
+import io
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import redis
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import codec, store
+from .checkout import price_cart
+from .connection import redis_client
+from .events import CART_EVENTS_KEY, CartEventConsumer, tail
+from .idempotency import PENDING, REPLAYED_HEADER, idempotency_key
+from .lines import line_signature
+from .listing import CART_INDEX_KEY, IndexedDocuments
+from .merge import CartOwnershipError, merge_carts
+from .models import Cart, CartItem, ItemOption
+from .product_cache import CachedProductClient
+from .products import FakeProductClient, ProductServiceError
+from .queries import carts_with_items, reconcile_cart_totals
+from .serializers import BULK_MAX_ITEMS, RetrieveCartSerializer
+from .snapshot import abuild_cart_document, build_cart_document, find_item
+from .unit_of_work import CartUnitOfWork, PendingCartChanges
+from .utils import merge_cart_items
+from .views import RetrieveUpdateDestroyCartItemView
+from .warmup import shard_bounds, warmup_checkpoint_key
+
+
+def create_carts(cart_count, items_per_cart=3, options_per_item=2):
+    # bulk_create skips the model save() overrides, so nothing is written to Redis
+    carts = Cart.objects.bulk_create([Cart(user_id=f'user-{index}') for index in range(cart_count)])
+    CartItem.objects.bulk_create([
+        CartItem(cart=cart, prod_id=f'prod-{index}', quantity=index + 1)
+        for cart in carts for index in range(items_per_cart)
+    ])
+    ItemOption.objects.bulk_create([
+        ItemOption(cart_item=cart_item, attribute=f'attribute-{index}', value='value')
+        for cart_item in CartItem.objects.all() for index in range(options_per_item)
+    ])
+    reconcile_cart_totals()
+    return carts
+
+
+def create_cart(user_id, *lines):
+    """A cart saved the regular way, so it is cached too, with ``(prod_id, quantity, options)`` lines."""
+    cart = Cart.objects.create(user_id=user_id)
+    for prod_id, quantity, options in lines:
+        cart_item = CartItem.objects.create(cart=cart, prod_id=prod_id, quantity=quantity)
+        for attribute, value in options:
+            ItemOption.objects.create(cart_item=cart_item, attribute=attribute, value=value)
+    return cart
+
+
+def cart_lines(document):
+    return {
+        (cart_item['prod_id'], tuple((option['attribute'], option['value']) for option in cart_item['item_options'])):
+            cart_item['quantity']
+        for cart_item in document['cart_items']
+    }
+
+
+def redis_available():
+    try:
+        return redis_client.ping()
+    except redis.RedisError:
+        return False
+
+
+@skipUnless(redis_available(), 'needs a Redis server')
+class RedisTestCase(TransactionTestCase):
+    """
+    Tests of the Redis side, against the configured ``REDIS_DB``, which is flushed before each
+    test. Transactions really commit, so the unit of work flushes as it does in production.
+    """
+
+    def setUp(self):
+        redis_client.flushdb()
+
+
+class CartsWithItemsTests(TestCase):
+    def test_query_count_does_not_grow_with_carts(self):
+        for cart_count in (1, 10):
+            with self.subTest(cart_count=cart_count):
+                Cart.objects.all().delete()
+                create_carts(cart_count)
+                # carts, their items, the items' options
+                with self.assertNumQueries(3):
+                    data = RetrieveCartSerializer(carts_with_items(), many=True).data
+                self.assertEqual(len(data), cart_count)
+
+    def test_serialized_cart_matches_unoptimized_queryset(self):
+        create_carts(2, items_per_cart=2)
+        CartItem.objects.filter(prod_id='prod-0').update(is_active=False)
+        reconcile_cart_totals()
+
+        expected = RetrieveCartSerializer(Cart.objects.order_by('id'), many=True).data
+        actual = RetrieveCartSerializer(carts_with_items(Cart.objects.order_by('id')), many=True).data
+
+        self.assertEqual(actual, expected)
+        self.assertEqual([cart['total_quantity'] for cart in actual], [2, 2])
+
+    def test_async_document_matches_sync(self):
+        cart = create_carts(1, items_per_cart=3)[0]
+        CartItem.objects.filter(prod_id='prod-1').update(is_active=False)
+
+        self.assertEqual(async_to_sync(abuild_cart_document)(cart.pk), build_cart_document(cart))
+        self.assertIsNone(async_to_sync(abuild_cart_document)(uuid.uuid4()))
+
+
+class CartCounterTests(TestCase):
+    def assertCounters(self, cart, total_quantity, item_count):
+        cart.refresh_from_db()
+        self.assertEqual((cart.total_quantity, cart.item_count), (total_quantity, item_count))
+
+    def test_item_changes_update_counters(self):
+        cart = Cart.objects.create()
+        first = CartItem.objects.create(cart=cart, prod_id='a', quantity=2)
+        CartItem.objects.create(cart=cart, prod_id='b', quantity=3)
+        self.assertCounters(cart, 5, 2)
+
+        first = CartItem.objects.get(pk=first.pk)
+        first.quantity = 6
+        first.save(update_fields=['quantity', 'modified_at'])
+        self.assertCounters(cart, 9, 2)
+
+        first.is_active = False
+        first.save()
+        self.assertCounters(cart, 3, 1)
+
+        CartItem.objects.get(prod_id='b').delete()
+        self.assertCounters(cart, 0, 0)
+
+    def test_saving_a_stale_cart_keeps_counters(self):
+        cart = Cart.objects.create()
+        stale = Cart.objects.get(pk=cart.pk)
+        CartItem.objects.create(cart=cart, prod_id='a', quantity=4)
+        stale.user_id = 'user'
+        stale.save()
+        self.assertCounters(cart, 4, 1)
+
+    def test_reconcile_fixes_drift(self):
+        carts = create_carts(3)
+        Cart.objects.filter(pk=carts[0].pk).update(total_quantity=100)
+        CartItem.objects.filter(cart=carts[1]).update(quantity=1)
+
+        self.assertEqual(reconcile_cart_totals(dry_run=True), 2)
+        self.assertEqual(reconcile_cart_totals(), 2)
+        self.assertEqual(reconcile_cart_totals(), 0)
+        self.assertCounters(carts[0], 6, 3)
+        self.assertCounters(carts[1], 3, 3)
+
+
+class LineSignatureTests(TestCase):
+    def test_same_options_in_any_order_or_case_match(self):
+        self.assertEqual(
+            line_signature('prod', [{'attribute': 'color', 'value': 'red'}, {'attribute': 'size', 'value': 'L'}]),
+            line_signature('prod', [{'attribute': ' Size', 'value': 'l'}, {'attribute': 'COLOR', 'value': 'Red'}]),
+        )
+
+    def test_subset_of_options_does_not_match(self):
+        self.assertNotEqual(
+            line_signature('prod', [{'attribute': 'color', 'value': 'red'}, {'attribute': 'size', 'value': 'L'}]),
+            line_signature('prod', [{'attribute': 'color', 'value': 'red'}]),
+        )
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentMergeTests(TransactionTestCase):
+    threads = 8
+    merges_per_thread = 25
+
+    @mock.patch.object(CartUnitOfWork, 'flush')
+    def test_concurrent_merges_lose_no_increments(self, flush):
+        cart = Cart.objects.create()
+        cart_item = CartItem.objects.create(cart=cart, prod_id='prod', quantity=1)
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def merge():
+            try:
+                barrier.wait()
+                for _ in range(self.merges_per_thread):
+                    cart_data = build_cart_document(Cart.objects.get(pk=cart.pk))
+                    merge_cart_items(cart_data, cart_data['cart_items'][0], 1)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=merge) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        expected = 1 + self.threads * self.merges_per_thread
+        cart_item.refresh_from_db()
+        cart.refresh_from_db()
+        self.assertEqual(cart_item.quantity, expected)
+        self.assertEqual((cart.total_quantity, cart.item_count), (expected, 1))
+
+
+class QuantityDeltaTests(TestCase):
+    def test_deltas_apply_in_any_order(self):
+        cart_item_data = {'id': '1', 'cart_id': 'cart', 'prod_id': 'prod', 'quantity': 1, 'is_active': True,
+                          'created_at': None, 'modified_at': None}
+        document = {'id': 'cart', 'user_id': None, 'total_quantity': 1, 'created_at': None, 'modified_at': None,
+                    'cart_items': [{**cart_item_data, 'item_options': []}]}
+
+        # two requests added 2 and 3 to the item; the second one's flush reaches Redis first
+        for quantity, delta in ((6, 3), (3, 2)):
+            changes = PendingCartChanges('cart')
+            changes.items['1'] = {**cart_item_data, 'quantity': quantity}
+            changes.quantity_deltas['1'] = delta
+            changes.apply(document)
+
+        self.assertEqual(document['cart_items'][0]['quantity'], 6)
+        self.assertEqual(document['total_quantity'], 6)
+
+    def test_describe_logs_quantities_adds_and_removes(self):
+        cart_item_data = {'id': '1', 'cart_id': 'cart', 'prod_id': 'prod', 'quantity': 1, 'is_active': True,
+                          'created_at': None, 'modified_at': None}
+        document = {'id': 'cart', 'user_id': None, 'total_quantity': 3, 'created_at': None, 'modified_at': None,
+                    'cart_items': [{**cart_item_data, 'item_options': []},
+                                   {**cart_item_data, 'id': '2', 'quantity': 2, 'item_options': []}]}
+
+        changes = PendingCartChanges('cart')
+        changes.items['1'] = {**cart_item_data, 'quantity': 4}
+        changes.quantity_deltas['1'] = 3
+        changes.items['3'] = {**cart_item_data, 'id': '3', 'prod_id': 'other'}
+        changes.created_items.add('3')
+        changes.removed_items['2'] = {'id': '2', 'cart_id': 'cart', 'item_options': []}
+        changes.apply(document)
+
+        change = changes.describe(document)
+        self.assertEqual(change['total_quantity'], 5)
+        self.assertEqual(change['ops'], [
+            {'op': 'remove', 'id': '2'},
+            {'op': 'quantity', 'id': '1', 'quantity': 4},
+            {'op': 'add', 'item': find_item(document, '3')},
+        ])
+
+        changes.cart_data = {'user_id': 'user', 'created_at': None, 'modified_at': None}
+        self.assertIsNone(changes.describe(document))
+
+    def test_events_carry_quantity_deltas(self):
+        changes = PendingCartChanges('cart')
+        changes.record_delta('1', 'prod', 2)
+        changes.record_delta('1', 'prod', 3)
+        changes.items['1'] = {'id': '1', 'prod_id': 'prod', 'quantity': 6}
+        changes.record_delta('2', 'other', -4)
+        changes.removed_items['2'] = {'id': '2', 'cart_id': 'cart', 'item_options': []}
+
+        self.assertEqual(changes.events(), [
+            {'type': 'item_removed', 'item': '2', 'prod_id': 'other', 'delta': -4},
+            {'type': 'item_updated', 'item': '1', 'prod_id': 'prod', 'delta': 5},
+        ])
+
+
+class PriceCartTests(TestCase):
+    def cart_document(self, *lines):
+        return {
+            'id': 'cart',
+            'cart_items': [
+                {'id': str(index), 'prod_id': prod_id, 'quantity': quantity, 'is_active': is_active, 'item_options': []}
+                for index, (prod_id, quantity, is_active) in enumerate(lines)
+            ],
+        }
+
+    def test_summary_totals_available_lines(self):
+        client = FakeProductClient({'a': {'price': '2.50', 'stock': 10}, 'b': {'price': 4}, 'c': {'price': 1, 'stock': 1}})
+        summary = price_cart(self.cart_document(('a', 2, True), ('b', 3, True), ('c', 2, True), ('d', 1, True),
+                                                ('a', 5, False)), client)
+
+        self.assertEqual([line['sub_total'] for line in summary['lines']], [Decimal('5.00'), Decimal('12'), None, None])
+        self.assertEqual(summary['total_price'], Decimal('17.00'))
+        self.assertEqual(summary['total_quantity'], 8)
+        self.assertEqual([line['prod_id'] for line in summary['unavailable']], ['c', 'd'])
+        self.assertEqual(client.requests, [['a', 'b', 'c', 'd']])
+
+    def test_lookups_run_concurrently(self):
+        products = {f'prod-{index}': {'price': 1} for index in range(20)}
+        client = FakeProductClient(products, latency=0.05, batch=False, max_concurrency=10)
+        document = self.cart_document(*((prod_id, 1, True) for prod_id in products))
+
+        started = time.monotonic()
+        summary = price_cart(document, client)
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(len(client.requests), 20)
+        self.assertEqual(summary['total_price'], 20)
+        # 20 serial lookups would take a second
+        self.assertLess(elapsed, 0.5)
+
+    def test_timeout_raises(self):
+        client = FakeProductClient({'a': {'price': 1}}, latency=0.2, timeout=0.05)
+        with self.assertRaises(ProductServiceError):
+            price_cart(self.cart_document(('a', 1, True)), client)
+
+
+class CachedProductClientTests(TestCase):
+    def cached_client(self, latency=0, **options):
+        upstream = FakeProductClient({'a': {'price': 1}, 'b': {'price': 2}}, latency=latency)
+        return upstream, CachedProductClient(upstream, shared=False, **options)
+
+    def test_hits_and_negative_entries_skip_the_service(self):
+        upstream, client = self.cached_client()
+        self.assertEqual(set(client.fetch_many(['a', 'missing'])), {'a'})
+        self.assertEqual(set(client.fetch_many(['a', 'b', 'missing'])), {'a', 'b'})
+
+        self.assertEqual(upstream.requests, [['a', 'missing'], ['b']])
+        stats = client.stats()
+        self.assertEqual((stats['local_hits'], stats['local_misses'], stats['negative_hits']), (2, 3, 2))
+
+    def test_expired_entries_are_refetched(self):
+        upstream, client = self.cached_client(local_ttl=0.01)
+        client.fetch_many(['a'])
+        time.sleep(0.02)
+        client.fetch_many(['a'])
+        self.assertEqual(upstream.requests, [['a'], ['a']])
+
+    def test_concurrent_misses_are_coalesced(self):
+        upstream, client = self.cached_client(latency=0.1)
+        barrier = threading.Barrier(10)
+        results = []
+
+        def fetch():
+            barrier.wait()
+            results.append(client.fetch_many(['a']))
+
+        workers = [threading.Thread(target=fetch) for _ in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(upstream.requests, [['a']])
+        self.assertEqual([result['a']['price'] for result in results], [1] * 10)
+        self.assertEqual(client.stats()['coalesced'], 9)
+
+
+class CodecTests(TestCase):
+    def document(self):
+        created_at = datetime(2024, 3, 1, 12, 30, 15, 123000, tzinfo=dt_timezone.utc)
+        option = {'id': 7, 'cart_item_id': 3, 'attribute': 'size', 'value': 'M',
+                  'created_at': created_at, 'modified_at': created_at}
+        cart_item = {'id': 3, 'cart_id': 'cart-1', 'prod_id': 'p1', 'quantity': 2, 'is_active': True,
+                     'created_at': created_at, 'modified_at': created_at + timedelta(minutes=5),
+                     'item_options': [option]}
+        return {'id': 'cart-1', 'user_id': None, 'cart_items': [cart_item], 'total_quantity': 2,
+                'created_at': created_at, 'modified_at': created_at + timedelta(minutes=5)}
+
+    def test_msgpack_round_trip_matches_json(self):
+        document = self.document()
+
+        decoded = codec.decode(codec.CODECS['msgpack'].encode(document))
+
+        self.assertEqual(decoded, json.loads(codec.CODECS['json'].encode(document)))
+        self.assertEqual(decoded['modified_at'], '2024-03-01T12:35:15.123Z')
+        cart_item = decoded['cart_items'][0]
+        self.assertEqual((cart_item['cart_id'], cart_item['item_options'][0]['cart_item_id']), ('cart-1', 3))
+        self.assertIs(type(cart_item['quantity']), int)
+        self.assertIs(type(decoded['total_quantity']), int)
+
+    def test_msgpack_payloads_start_with_the_version_byte(self):
+        self.assertEqual(codec.CODECS['msgpack'].encode(self.document())[:1], codec.MSGPACK_V1)
+        self.assertEqual(codec.CODECS['msgpack'].encode({'any': 'thing'})[:1], codec.MSGPACK_V1)
+        self.assertEqual(codec.decode(codec.CODECS['msgpack'].encode({'any': 'thing'})), {'any': 'thing'})
+
+    def test_json_payloads_are_read_after_switching_codec(self):
+        raw = codec.CODECS['json'].encode(self.document()).encode('utf-8')
+
+        with override_settings(CART_CACHE_CODEC='msgpack'):
+            self.assertEqual(codec.encode(self.document())[:1], codec.MSGPACK_V1)
+            self.assertEqual(codec.decode(raw), json.loads(raw))
+
+    def test_unknown_version_byte_is_rejected(self):
+        payload = b'\x02' + codec.CODECS['msgpack'].encode(self.document())[1:]
+
+        with self.assertRaisesMessage(ValueError, 'Unknown cache payload version'):
+            codec.decode(payload)
+
+class MergeCartsTests(RedisTestCase):
+    def test_moved_line_is_in_returned_and_cached_document(self):
+        auth_cart = create_cart('user', ('p1', 9, [('size', 'M')]))
+        guest_cart = create_cart(None, ('p1', 5, [('size', 'M')]), ('p2', 1, [('color', 'red')]))
+
+        document = merge_carts(guest_cart.pk, 'user')
+
+        expected = {('p1', (('size', 'M'),)): 14, ('p2', (('color', 'red'),)): 1}
+        self.assertEqual(cart_lines(document), expected)
+        self.assertEqual(document['total_quantity'], 15)
+        self.assertEqual(cart_lines(store.load_cart_document(auth_cart.pk)), expected)
+        auth_cart.refresh_from_db()
+        self.assertEqual((auth_cart.total_quantity, auth_cart.item_count), (15, 2))
+
+    def test_moved_line_keeps_its_options(self):
+        auth_cart = create_cart('user', ('p1', 1, []))
+        guest_cart = create_cart(None, ('p2', 3, [('color', 'red'), ('size', 'L')]))
+        guest_item = guest_cart.cart_items.get()
+
+        document = merge_carts(guest_cart.pk, 'user')
+
+        moved = next(cart_item for cart_item in document['cart_items'] if cart_item['prod_id'] == 'p2')
+        self.assertEqual(moved['id'], str(guest_item.pk))
+        self.assertEqual(moved['cart_id'], str(auth_cart.pk))
+        self.assertEqual(sorted((option['attribute'], option['value']) for option in moved['item_options']),
+                         [('color', 'red'), ('size', 'L')])
+        self.assertEqual(ItemOption.objects.filter(cart_item__cart=auth_cart).count(), 2)
+
+    def test_guest_cart_is_deleted_from_db_and_redis(self):
+        create_cart('user', ('p1', 1, []))
+        guest_cart = create_cart(None, ('p1', 2, []))
+        self.assertIsNotNone(store.load_cart_document(guest_cart.pk))
+
+        merge_carts(guest_cart.pk, 'user')
+
+        self.assertFalse(Cart.objects.filter(pk=guest_cart.pk).exists())
+        self.assertIsNone(store.load_cart_document(guest_cart.pk))
+
+    def test_merging_a_cart_into_itself_changes_nothing(self):
+        auth_cart = create_cart('user', ('p1', 2, []))
+
+        document = merge_carts(auth_cart.pk, 'user')
+
+        self.assertEqual(document['id'], str(auth_cart.pk))
+        self.assertEqual(cart_lines(document), {('p1', ()): 2})
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_missing_guest_cart_returns_the_user_cart(self):
+        auth_cart = create_cart('user', ('p1', 2, []))
+
+        document = merge_carts(uuid.uuid4(), 'user')
+
+        self.assertEqual(document['id'], str(auth_cart.pk))
+        self.assertEqual(cart_lines(document), {('p1', ()): 2})
+
+
+    def test_another_users_cart_is_not_merged(self):
+        auth_cart = create_cart('user', ('p1', 1, []))
+        other_cart = create_cart('other-user', ('p2', 4, []))
+
+        with self.assertRaises(CartOwnershipError):
+            merge_carts(other_cart.pk, 'user')
+
+        self.assertEqual(cart_lines(store.load_cart_document(other_cart.pk)), {('p2', ()): 4})
+        self.assertEqual(list(CartItem.objects.filter(cart=other_cart).values_list('prod_id', 'quantity')), [('p2', 4)])
+        self.assertEqual(list(CartItem.objects.filter(cart=auth_cart).values_list('prod_id', flat=True)), ['p1'])
+
+    def test_merge_endpoint_refuses_another_users_cart(self):
+        user_id = str(uuid.uuid4())
+        other_cart = create_cart(str(uuid.uuid4()), ('p2', 4, []))
+
+        response = APIClient().post(f'/api/v1/carts/{other_cart.pk}/merge/{user_id}')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertTrue(Cart.objects.filter(pk=other_cart.pk).exists())
+        self.assertFalse(Cart.objects.filter(user_id=user_id).exists())
+
+class CartListingTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        # newest first, as the index lists them
+        self.cart_ids = [str(create_cart(f'user-{index}', ('p1', 1, [])).pk) for index in range(12)][::-1]
+
+    def list_page(self, page):
+        return self.client.get('/api/v1/carts/all/', {'page': page}).json()
+
+    def test_pages_list_carts_newest_first(self):
+        first, second = self.list_page(1), self.list_page(2)
+
+        self.assertEqual(first['count'], 12)
+        self.assertEqual([cart['id'] for cart in first['results'] + second['results']], self.cart_ids)
+        self.assertIsNone(second['next'])
+
+    def test_page_with_a_stale_entry_is_filled_from_the_next_ones(self):
+        stale = self.cart_ids[3]
+        redis_client.delete(store.get_layout().key(stale))
+
+        first = self.list_page(1)
+
+        self.assertEqual([cart['id'] for cart in first['results']], [
+            cart_id for cart_id in self.cart_ids if cart_id != stale
+        ][:10])
+        self.assertIsNone(redis_client.zscore(CART_INDEX_KEY, stale))
+        self.assertEqual(self.list_page(1)['count'], 11)
+
+    def test_slices_and_items_of_the_index(self):
+        carts = IndexedDocuments(CART_INDEX_KEY, load_many=store.load_cart_documents)
+
+        self.assertEqual(len(carts), 12)
+        self.assertEqual([cart['id'] for cart in carts[2:5]], self.cart_ids[2:5])
+        self.assertEqual(carts[0]['id'], self.cart_ids[0])
+        self.assertEqual(carts[20:30], [])
+        with self.assertRaises(IndexError):
+            carts[12]
+
+class RebuildCartIndexesTests(RedisTestCase):
+    def assert_rebuilds_cart_index(self):
+        carts = [create_cart(f'user-{index}', ('p1', 1, [])) for index in range(3)]
+        redis_client.delete(CART_INDEX_KEY)
+
+        call_command('rebuild_cart_indexes', stdout=io.StringIO())
+
+        self.assertEqual({member.decode() for member in redis_client.zrange(CART_INDEX_KEY, 0, -1)},
+                         {str(cart.pk) for cart in carts})
+
+    def test_document_layout(self):
+        self.assert_rebuilds_cart_index()
+
+    @override_settings(CART_STORAGE_LAYOUT='hash')
+    def test_hash_layout(self):
+        self.assert_rebuilds_cart_index()
+
+
+@override_settings(CART_STORAGE_LAYOUT='hash')
+class HashLayoutTests(RedisTestCase):
+    def test_quantity_change_is_an_increment_that_keeps_the_item_current(self):
+        cart = create_cart('user', ('p1', 2, [('size', 'M')]), ('p2', 1, []))
+        cart_item = cart.cart_items.get(prod_id='p1')
+
+        with self.assertLogs('cart.unit_of_work', 'INFO') as logs:
+            cart_item.quantity = 5
+            cart_item.save(update_fields=['quantity', 'modified_at'])
+
+        self.assertIn('quantities incremented', '\n'.join(logs.output))
+        expected = store.decode(store.encode(find_item(
+            build_cart_document(carts_with_items(Cart.objects.filter(pk=cart.pk)).get()), str(cart_item.pk),
+        )))
+        for cached in (find_item(store.load_cart_document(cart.pk), str(cart_item.pk)),
+                       store.load_item_document(cart.pk, cart_item.pk)):
+            self.assertEqual((cached['quantity'], cached['modified_at']), (5, expected['modified_at']))
+        self.assertEqual(store.load_cart_document(cart.pk)['total_quantity'], 6)
+        # what an increment changes is kept out of the encoded item, so that can never go stale
+        encoded = store.decode(redis_client.hget(store.cart_hash_key(cart.pk), f'item:{cart_item.pk}'))
+        self.assertNotIn('quantity', encoded)
+        self.assertNotIn('modified_at', encoded)
+
+    def test_items_cached_with_their_modified_at_inside_still_load(self):
+        cart = create_cart('user', ('p1', 2, []))
+        cart_item = find_item(store.load_cart_document(cart.pk), str(cart.cart_items.get().pk))
+        key = store.cart_hash_key(cart.pk)
+        redis_client.hset(key, f'item:{cart_item["id"]}', store.encode(cart_item))
+        redis_client.hdel(key, f'mod:{cart_item["id"]}')
+
+        self.assertEqual(find_item(store.load_cart_document(cart.pk), cart_item['id']), cart_item)
+
+class MigrateCartLayoutTests(RedisTestCase):
+    def migrate(self, to):
+        call_command('migrate_cart_layout', '--to', to, stdout=io.StringIO())
+
+    def test_round_trip_keeps_every_cart(self):
+        carts = [create_cart(f'user-{index}', ('p1', index + 1, [('size', 'M')]), ('p2', 1, [])) for index in range(3)]
+        cart_ids = [str(cart.pk) for cart in carts]
+        document_layout, hash_layout = store.get_layout('document'), store.get_layout('hash')
+        documents = document_layout.load_carts(cart_ids)
+        cart_item_id = documents[0]['cart_items'][0]['id']
+
+        self.migrate('hash')
+
+        self.assertEqual(hash_layout.load_carts(cart_ids), documents)
+        self.assertEqual(document_layout.load_carts(cart_ids), [None] * 3)
+        self.assertFalse(redis_client.exists(store.cart_item_key(cart_item_id)))
+
+        self.migrate('document')
+
+        self.assertEqual(document_layout.load_carts(cart_ids), documents)
+        self.assertEqual(hash_layout.load_carts(cart_ids), [None] * 3)
+        self.assertTrue(redis_client.exists(store.cart_item_key(cart_item_id)))
+
+    def test_cart_written_during_the_batch_is_not_overwritten(self):
+        cart = create_cart('user', ('p1', 1, []))
+        load_carts = store.DocumentLayout.load_carts
+        reads = []
+
+        def load_then_write(layout, cart_ids):
+            documents = load_carts(layout, cart_ids)
+            if not reads:
+                # another client changes the cart after the batch was read
+                redis_client.set(store.cart_key(cart.pk), store.encode({**documents[0], 'total_quantity': 7}))
+            reads.append(cart_ids)
+            return documents
+
+        with mock.patch.object(store.DocumentLayout, 'load_carts', autospec=True, side_effect=load_then_write):
+            self.migrate('hash')
+
+        self.assertEqual(len(reads), 2)
+        self.assertEqual(store.get_layout('hash').load_carts([str(cart.pk)])[0]['total_quantity'], 7)
+
+class IdempotencyKeyTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.cart = create_cart('user')
+        self.path = f'/api/v1/carts/{self.cart.pk}/items/'
+        self.body = {'prod_id': 'p1', 'quantity': 2, 'item_options': [{'attribute': 'size', 'value': 'M'}]}
+
+    def add(self, body=None, key='key-1', path=None):
+        return self.client.post(path or self.path, body or self.body, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_the_stored_response(self):
+        first = self.add()
+        retry = self.add()
+
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn(REPLAYED_HEADER, first)
+        self.assertEqual((retry.status_code, retry[REPLAYED_HEADER]), (201, 'true'))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_retry_while_the_first_request_runs_gets_409(self):
+        redis_client.set(idempotency_key('POST', self.path, 'key-1'), PENDING)
+
+        response = self.add()
+
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_key_reused_with_another_body_gets_422(self):
+        self.add()
+
+        response = self.add({**self.body, 'quantity': 3})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+    def test_key_is_scoped_to_the_endpoint(self):
+        other_cart = create_cart('other-user')
+        self.add()
+
+        response = self.add(path=f'/api/v1/carts/{other_cart.pk}/items/')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn(REPLAYED_HEADER, response)
+        self.assertEqual(CartItem.objects.filter(cart=other_cart).get().quantity, 2)
+
+
+    def test_bulk_add_retry_is_replayed(self):
+        path = f'/api/v1/carts/{self.cart.pk}/items/bulk/'
+        body = {'items': [self.body, {'prod_id': 'p2', 'quantity': 1}]}
+
+        first = self.add(body, path=path)
+        retry = self.add(body, path=path)
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((retry.status_code, retry[REPLAYED_HEADER]), (201, 'true'))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(dict(CartItem.objects.values_list('prod_id', 'quantity')), {'p1': 2, 'p2': 1})
+
+class ConditionalRequestTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.user_id = str(uuid.uuid4())
+        self.cart = create_cart(self.user_id, ('p1', 2, []))
+        self.cart_item = self.cart.cart_items.get()
+        self.cart_path = f'/api/v1/carts/{self.cart.pk}/'
+        self.item_path = f'/api/v1/carts/{self.cart.pk}/items/{self.cart_item.pk}/'
+
+    def etag(self):
+        return self.client.get(self.cart_path)['ETag']
+
+    def test_reads_carry_a_strong_etag(self):
+        response = self.client.get(self.cart_path)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['ETag'], r'^"\d+"$')
+        self.assertEqual(self.client.get(f'/api/v1/carts/user/{self.user_id}/')['ETag'], response['ETag'])
+
+    def test_if_none_match_gets_304_until_the_cart_changes(self):
+        etag = self.etag()
+
+        self.assertEqual(self.client.get(self.cart_path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(f'/api/v1/carts/user/{self.user_id}/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.patch(self.item_path, {'quantity': 3}, format='json')
+        response = self.client.get(self.cart_path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['total_quantity'], 3)
+
+    def test_if_match_with_a_stale_etag_gets_412(self):
+        etag = self.etag()
+        self.assertEqual(self.client.patch(self.item_path, {'quantity': 3}, format='json',
+                                           HTTP_IF_MATCH=etag).status_code, 200)
+
+        response = self.client.patch(self.item_path, {'quantity': 5}, format='json', HTTP_IF_MATCH=etag)
+
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response['ETag'], self.etag())
+        self.cart_item.refresh_from_db()
+        self.assertEqual(self.cart_item.quantity, 3)
+
+    def test_if_match_star_matches_any_cached_version(self):
+        response = self.client.patch(self.item_path, {'quantity': 4}, format='json', HTTP_IF_MATCH='*')
+
+        self.assertEqual(response.status_code, 200)
+        self.cart_item.refresh_from_db()
+        self.assertEqual(self.cart_item.quantity, 4)
+
+    def test_version_is_bumped_with_the_write_not_before_it(self):
+        etag = self.etag()
+        seen = []
+        update = RetrieveUpdateDestroyCartItemView.update
+
+        def update_and_read_back(view, request, *args, **kwargs):
+            seen.append(self.client.get(self.cart_path))
+            return update(view, request, *args, **kwargs)
+
+        with mock.patch.object(RetrieveUpdateDestroyCartItemView, 'update', autospec=True,
+                               side_effect=update_and_read_back):
+            self.client.patch(self.item_path, {'quantity': 3}, format='json', HTTP_IF_MATCH=etag)
+
+        # while the write runs, the cart still reads as the version the client matched
+        self.assertEqual((seen[0]['ETag'], seen[0].json()['total_quantity']), (etag, 2))
+        response = self.client.get(self.cart_path)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['total_quantity'], 3)
+        self.assertFalse(redis_client.exists(store.cart_claim_key(self.cart.pk)))
+
+    def test_write_holding_the_cart_makes_others_with_the_same_etag_wait(self):
+        etag = self.etag()
+        redis_client.set(store.cart_claim_key(self.cart.pk), 'another-request')
+
+        response = self.client.patch(self.item_path, {'quantity': 3}, format='json', HTTP_IF_MATCH=etag)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.cart_item.refresh_from_db()
+        self.assertEqual(self.cart_item.quantity, 2)
+
+    def test_failed_write_uses_up_no_version(self):
+        etag = self.etag()
+
+        response = self.client.patch(self.item_path, {'quantity': 0}, format='json', HTTP_IF_MATCH=etag)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.etag(), etag)
+        self.assertFalse(redis_client.exists(store.cart_claim_key(self.cart.pk)))
+        self.assertEqual(self.client.patch(self.item_path, {'quantity': 3}, format='json',
+                                           HTTP_IF_MATCH=etag).status_code, 200)
+
+    def test_cold_cart_is_matchable_after_one_read(self):
+        stale = self.etag()
+        redis_client.flushdb()
+
+        self.assertEqual(self.client.patch(self.item_path, {'quantity': 5}, format='json',
+                                           HTTP_IF_MATCH=stale).status_code, 412)
+        response = self.client.get(self.cart_path, HTTP_IF_NONE_MATCH=stale)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], stale)
+        self.assertEqual(self.client.get(self.cart_path, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        response = self.client.patch(self.item_path, {'quantity': 5}, format='json', HTTP_IF_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.cart_item.refresh_from_db()
+        self.assertEqual(self.cart_item.quantity, 5)
+
+    def test_cold_user_cart_is_matchable_after_one_read(self):
+        redis_client.flushdb()
+
+        etag = self.client.get(f'/api/v1/carts/user/{self.user_id}/')['ETag']
+
+        self.assertEqual(self.client.patch(self.item_path, {'quantity': 5}, format='json',
+                                           HTTP_IF_MATCH=etag).status_code, 200)
+
+
+class CartChangesTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.cart = create_cart('user', ('p1', 2, []))
+        self.cart_item = self.cart.cart_items.get()
+        self.path = f'/api/v1/carts/{self.cart.pk}/changes/'
+        self.etag = self.client.get(f'/api/v1/carts/{self.cart.pk}/')['ETag']
+
+    def set_quantity(self, quantity):
+        self.client.patch(f'/api/v1/carts/{self.cart.pk}/items/{self.cart_item.pk}/', {'quantity': quantity},
+                          format='json')
+
+    def test_changes_since_a_version(self):
+        self.set_quantity(5)
+
+        response = self.client.get(self.path, {'since': self.etag})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['since'], int(self.etag.strip('"')))
+        self.assertEqual(response['ETag'], store.cart_etag(data['version']))
+        self.assertEqual([change['ops'] for change in data['changes']],
+                         [[{'op': 'quantity', 'id': self.cart_item.pk, 'quantity': 5}]])
+        self.assertEqual(data['changes'][0]['total_quantity'], 5)
+
+    def test_nothing_changed_since_the_current_version(self):
+        response = self.client.get(self.path, {'since': self.etag.strip('"')})
+
+        self.assertEqual((response.status_code, response.json()['changes']), (200, []))
+
+    def test_since_that_is_not_a_version_gets_400(self):
+        for since in ('', 'abc', '1.5', '-1', 'W/"5"', '1' * 20):
+            with self.subTest(since=since):
+                self.assertEqual(self.client.get(self.path, {'since': since}).status_code, 400)
+
+    def test_trimmed_log_falls_back_to_a_snapshot(self):
+        with override_settings(CART_CHANGE_LOG_LENGTH=1):
+            self.set_quantity(3)
+            self.set_quantity(4)
+
+        data = self.client.get(self.path, {'since': self.etag}).json()
+
+        self.assertNotIn('changes', data)
+        self.assertEqual(data['snapshot']['total_quantity'], 4)
+        self.assertEqual(store.cart_etag(data['version']), self.client.get(f'/api/v1/carts/{self.cart.pk}/')['ETag'])
+
+    def test_uncached_cart_falls_back_to_a_snapshot_from_the_db(self):
+        redis_client.flushdb()
+
+        data = self.client.get(self.path, {'since': self.etag}).json()
+
+        self.assertEqual(data['snapshot']['id'], str(self.cart.pk))
+        self.assertEqual(data['snapshot']['total_quantity'], 2)
+        self.assertIsNotNone(store.load_cart_document(self.cart.pk))
+
+class BulkAddCartItemsTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.cart = create_cart('user')
+        self.path = f'/api/v1/carts/{self.cart.pk}/items/bulk/'
+
+    def item(self, prod_id, quantity, **options):
+        return {'prod_id': prod_id, 'quantity': quantity,
+                'item_options': [{'attribute': attribute, 'value': value} for attribute, value in options.items()]}
+
+    def test_duplicate_lines_in_one_payload_are_merged(self):
+        items = [self.item('p1', 1, Size='M', color='red'), self.item('p1', 2, color='RED', size='m'),
+                 self.item('p2', 1)]
+
+        response = self.client.post(self.path, {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted((item.prod_id, item.quantity) for item in CartItem.objects.all()), [('p1', 3), ('p2', 1)])
+        self.assertEqual(ItemOption.objects.count(), 2)
+
+    def test_lines_merge_into_existing_ones(self):
+        self.client.post(self.path, {'items': [self.item('p1', 2, size='M')]}, format='json')
+
+        self.client.post(self.path, {'items': [self.item('p1', 1, SIZE='m'), self.item('p2', 4)]}, format='json')
+
+        self.assertEqual(sorted((item.prod_id, item.quantity) for item in CartItem.objects.all()), [('p1', 3), ('p2', 4)])
+        self.assertEqual(cart_lines(store.load_cart_document(self.cart.pk)),
+                         {('p1', (('size', 'M'),)): 3, ('p2', ()): 4})
+
+    def test_too_many_items_get_400(self):
+        items = [self.item(f'p{index}', 1) for index in range(BULK_MAX_ITEMS + 1)]
+
+        response = self.client.post(self.path, {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_cart_is_flushed_to_redis_once(self):
+        flush_cart = CartUnitOfWork._flush_cart
+        with mock.patch.object(CartUnitOfWork, '_flush_cart', autospec=True, side_effect=flush_cart) as flushed:
+            self.client.post(self.path, {'items': [self.item(f'p{index}', 1, size='M') for index in range(5)]},
+                             format='json')
+
+        self.assertEqual(flushed.call_count, 1)
+        self.assertEqual(len(store.load_cart_document(self.cart.pk)['cart_items']), 5)
+
+
+class SweepExpiredCartsTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fresh = create_cart(None, ('p1', 1, []))
+        self.expired = create_cart(None, ('p1', 1, [('size', 'M')]))
+        self.still_cached = create_cart(None, ('p1', 1, []))
+        self.user_cart = create_cart('user', ('p1', 1, []))
+        # a week old: past the guest TTL, within the user one
+        Cart.objects.exclude(pk=self.fresh.pk).update(modified_at=timezone.now() - timedelta(days=8))
+        # gone from Redis, as when expired or evicted
+        with store.write_batch() as pipe:
+            for cart in (self.expired, self.user_cart):
+                store.delete_cart(pipe, cart.pk, cart.user_id)
+
+    def sweep(self, *args):
+        stdout = io.StringIO()
+        call_command('sweep_expired_carts', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_deletes_only_expired_guest_carts_no_longer_cached(self):
+        output = self.sweep()
+
+        self.assertIn('guest carts: 2 past their TTL, 1 deleted', output)
+        self.assertIn('user carts: 0 past their TTL, 0 deleted', output)
+        self.assertEqual(set(Cart.objects.values_list('pk', flat=True)),
+                         {self.fresh.pk, self.still_cached.pk, self.user_cart.pk})
+        self.assertFalse(CartItem._base_manager.filter(cart_id=self.expired.pk).exists())
+        self.assertFalse(ItemOption.objects.filter(cart_item__cart_id=self.expired.pk).exists())
+
+    def test_batches_walk_every_expired_cart(self):
+        output = self.sweep('--batch-size', '1')
+
+        self.assertIn('guest carts: 2 past their TTL, 1 deleted', output)
+        self.assertFalse(Cart.objects.filter(pk=self.expired.pk).exists())
+
+    @override_settings(USER_CART_TTL=7 * 24 * 60 * 60)
+    def test_cart_read_after_leaving_redis_is_kept(self):
+        self.assertIsNone(store.load_cart_document(self.user_cart.pk))
+
+        self.assertEqual(APIClient().get(f'/api/v1/carts/{self.user_cart.pk}/').status_code, 200)
+        output = self.sweep()
+
+        self.assertIn('user carts: 1 past their TTL, 0 deleted', output)
+        self.assertTrue(Cart.objects.filter(pk=self.user_cart.pk).exists())
+
+    @override_settings(USER_CART_TTL=7 * 24 * 60 * 60)
+    def test_cart_whose_view_is_still_cached_is_kept(self):
+        self.user_cart.save_cart_to_redis()
+        redis_client.delete(store.get_layout().key(self.user_cart.pk))
+
+        self.assertIn('user carts: 1 past their TTL, 0 deleted', self.sweep())
+        self.assertTrue(Cart.objects.filter(pk=self.user_cart.pk).exists())
+
+    def test_dry_run_deletes_nothing(self):
+        output = self.sweep('--dry-run')
+
+        self.assertIn('guest carts: 2 past their TTL, 1 would be deleted', output)
+        self.assertEqual(Cart.objects.count(), 4)
+
+
+class AuditCartStoreTests(RedisTestCase):
+    def audit(self, *args):
+        stdout = io.StringIO()
+        call_command('audit_cart_store', '--rate', '0', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_consistent_store_has_nothing_to_report(self):
+        create_cart('user', ('p1', 1, [('size', 'M')]))
+
+        self.assertIn('Redis and the DB agree', self.audit())
+
+    def test_orphaned_keys_are_found_and_repaired(self):
+        cart = create_cart('user', ('p1', 1, [('size', 'M')]))
+        cart_item = cart.cart_items.get()
+        layout = store.get_layout()
+        # copies of the cart and its item under IDs that have no row
+        orphan_cart_key = layout.key(uuid.uuid4())
+        orphan_item_key = store.cart_item_key(cart_item.pk + 1000)
+        redis_client.copy(layout.key(cart.pk), orphan_cart_key)
+        redis_client.copy(store.cart_item_key(cart_item.pk), orphan_item_key)
+
+        output = self.audit()
+
+        self.assertIn('carts: orphaned 1', output)
+        self.assertIn('items: orphaned 1', output)
+        self.assertIn('Found 2 problems', output)
+        self.assertEqual(redis_client.exists(orphan_cart_key, orphan_item_key), 2)
+
+        self.assertIn('Repaired 2 problems', self.audit('--repair'))
+        self.assertEqual(redis_client.exists(orphan_cart_key, orphan_item_key), 0)
+        self.assertIsNotNone(store.load_cart_document(cart.pk))
+        self.assertIn('Redis and the DB agree', self.audit())
+
+    def test_drifted_cart_is_found_and_rewritten_from_the_db(self):
+        cart = create_cart('user', ('p1', 1, []))
+        # a queryset update goes around the model, so Redis never hears of it
+        CartItem.objects.filter(cart=cart).update(quantity=7)
+
+        output = self.audit('--check', 'drift')
+
+        self.assertIn('drifted 1', output)
+        self.assertEqual(cart_lines(store.load_cart_document(cart.pk)), {('p1', ()): 1})
+
+        self.assertIn('Repaired 1 problems', self.audit('--check', 'drift', '--repair'))
+        self.assertEqual(cart_lines(store.load_cart_document(cart.pk)), {('p1', ()): 7})
+        self.assertIn('Redis and the DB agree', self.audit('--check', 'drift'))
+
+
+class WarmCartCacheTests(RedisTestCase):
+    def warm(self, *args):
+        stdout = io.StringIO()
+        call_command('warm_cart_cache', '--batch-size', '3', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def cached_cart_ids(self):
+        return {cart_id for cart_id in Cart.objects.values_list('pk', flat=True) if store.load_cart_document(cart_id)}
+
+    def test_shards_together_cache_every_cart(self):
+        carts = create_carts(10, items_per_cart=2, options_per_item=1)
+        low, high = shard_bounds(0, 2)
+
+        self.warm('--shard', '0', '--shards', '2')
+
+        self.assertEqual(self.cached_cart_ids(), {cart.pk for cart in carts if low <= cart.pk <= high})
+
+        self.warm('--shard', '1', '--shards', '2')
+
+        self.assertEqual(self.cached_cart_ids(), {cart.pk for cart in carts})
+        self.assertEqual(cart_lines(store.load_cart_document(carts[0].pk)),
+                         {('prod-0', (('attribute-0', 'value'),)): 1, ('prod-1', (('attribute-0', 'value'),)): 2})
+        self.assertFalse(redis_client.exists(warmup_checkpoint_key(0, 2), warmup_checkpoint_key(1, 2)))
+
+    def test_cached_carts_are_left_alone(self):
+        cart = create_cart('user', ('p1', 1, []))
+        create_carts(2)
+
+        self.assertIn('cached 2 of 3 carts', self.warm())
+        self.assertEqual(len(self.cached_cart_ids()), 3)
+        self.assertEqual(cart_lines(store.load_cart_document(cart.pk)), {('p1', ()): 1})
+
+
+
+class CartEventsTests(RedisTestCase):
+    def consumer(self, name, **options):
+        return CartEventConsumer('test-group', name, start='0', block=10, **options)
+
+    def test_cart_writes_publish_events(self):
+        cart = create_cart('user', ('p1', 2, []))
+        cart_item = cart.cart_items.get()
+        cart_item.quantity = 5
+        cart_item.save(update_fields=['quantity', 'modified_at'])
+
+        events = [event for _, event in self.consumer('c1').read()]
+
+        self.assertEqual([(event['type'], event.get('delta')) for event in events],
+                         [('cart_created', None), ('item_added', 2), ('item_updated', 3)])
+        self.assertEqual({event['cart_id'] for event in events}, {str(cart.pk)})
+        self.assertEqual(events[-1]['prod_id'], 'p1')
+        self.assertLess(events[0]['version'], events[-1]['version'])
+
+    def test_deleted_cart_publishes_an_event_without_a_version(self):
+        cart = create_cart(None)
+        APIClient().delete(f'/api/v1/carts/{cart.pk}/')
+
+        event = self.consumer('c1').read()[-1][1]
+
+        self.assertEqual((event['type'], event['cart_id']), ('cart_deleted', str(cart.pk)))
+        self.assertNotIn('version', event)
+
+    def test_unacknowledged_events_are_read_again_after_a_restart(self):
+        create_cart('user')
+        first = self.consumer('c1').read()
+        self.assertTrue(first)
+
+        restarted = self.consumer('c1')
+
+        self.assertEqual(restarted.read(), first)
+        restarted.ack(*[entry_id for entry_id, _ in first])
+        self.assertEqual(self.consumer('c1').read(), [])
+
+    def test_events_of_an_idle_consumer_are_taken_over(self):
+        create_cart('user')
+        taken = self.consumer('c1').read()
+
+        claimed = self.consumer('c2', min_idle_time=0).read()
+
+        self.assertEqual(claimed, taken)
+        pending = redis_client.xpending_range(CART_EVENTS_KEY, 'test-group', '-', '+', 10)
+        self.assertEqual({entry['consumer'] for entry in pending}, {b'c2'})
+
+    def test_consume_leaves_events_whose_handler_failed_pending(self):
+        create_cart('user', ('p1', 1, []))
+        consumer = self.consumer('c1')
+        handled, reads = [], iter(range(3))
+
+        def handle(event):
+            if event['type'] == 'item_added':
+                raise ValueError('not now')
+            handled.append(event['type'])
+
+        consumer.consume(handle, stop=lambda: next(reads, None) is None)
+
+        self.assertEqual(handled, ['cart_created'])
+        pending = redis_client.xpending_range(CART_EVENTS_KEY, 'test-group', '-', '+', 10)
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(self.consumer('c1').read()[0][1]['type'], 'item_added')
+
+    def test_tail_yields_every_event_after_start(self):
+        first = create_cart('user')
+        second = create_cart('other-user')
+        stream = tail('0', block=10)
+
+        events = [next(stream)[1] for _ in range(2)]
+
+        self.assertEqual([(event['type'], event['cart_id']) for event in events],
+                         [('cart_created', str(first.pk)), ('cart_created', str(second.pk))])
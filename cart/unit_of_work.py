@@ -0,0 +1,339 @@
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+import redis
+from asgiref.sync import sync_to_async
+from django.db import transaction
+
+from . import snapshot, store
+
+logger = logging.getLogger(__name__)
+
+_active = ContextVar('cart_unit_of_work', default=None)
+
+
+class PendingCartChanges:
+    """Everything that changed in one cart since the last flush, keyed by object ID (last write wins)."""
+
+    def __init__(self, cart_id):
+        self.cart_id = str(cart_id)
+        self.cart_data = None
+        self.created = False
+        self.items = {}
+        self.created_items = set()
+        self.removed_items = {}
+        self.options = {}
+        self.removed_options = {}
+        self.quantity_deltas = {}
+        # per item, for the cart:events feed: its product and how much its quantity changed
+        self.prod_ids = {}
+        self.deltas = {}
+        self.get_cart = None
+
+    def record_delta(self, cart_item_id, prod_id, delta):
+        self.prod_ids[cart_item_id] = prod_id
+        self.deltas[cart_item_id] = self.deltas.get(cart_item_id, 0) + delta
+
+    def only_quantities_changed(self):
+        return (
+            self.cart_data is None and not self.created_items and not self.removed_items
+            and not self.options and not self.removed_options
+            and set(self.items) == set(self.quantity_deltas)
+        )
+
+    def touched_item_ids(self):
+        item_ids = set(self.items)
+        item_ids.update(option['cart_item_id'] for option in self.options.values())
+        item_ids.update(option['cart_item_id'] for option in self.removed_options.values())
+        return item_ids - set(self.removed_items)
+
+    def describe(self, document):
+        """
+        The change log entry for these changes, once applied to ``document`` (see
+        ``store.put_cart``); ``None`` when the cart itself changed.
+        """
+        if self.cart_data is not None:
+            return None
+        options_changed = {option['cart_item_id'] for option in self.options.values()}
+        options_changed.update(option['cart_item_id'] for option in self.removed_options.values())
+
+        ops = [{'op': 'remove', 'id': cart_item_id} for cart_item_id in self.removed_items]
+        for cart_item_id in sorted(self.touched_item_ids()):
+            cart_item_data = snapshot.find_item(document, cart_item_id)
+            if cart_item_data is None:
+                continue
+            if cart_item_id in self.created_items:
+                ops.append({'op': 'add', 'item': cart_item_data})
+            elif cart_item_id in self.quantity_deltas and cart_item_id not in options_changed:
+                ops.append({'op': 'quantity', 'id': cart_item_id, 'quantity': cart_item_data['quantity']})
+            else:
+                ops.append({'op': 'update', 'item': cart_item_data})
+        return {'total_quantity': document['total_quantity'], 'modified_at': document['modified_at'], 'ops': ops}
+
+    def events(self):
+        """
+        These changes as events for the ``cart:events`` feed (see ``cart.events``): one for the
+        cart if it was created or changed, then one per item added, removed or updated, with
+        how much its quantity changed.
+        """
+        events = []
+        if self.cart_data is not None:
+            events.append({'type': 'cart_created' if self.created else 'cart_updated'})
+        for cart_item_id in self.removed_items:
+            if cart_item_id not in self.created_items:
+                events.append({'type': 'item_removed', 'item': cart_item_id,
+                               'prod_id': self.prod_ids.get(cart_item_id), 'delta': self.deltas.get(cart_item_id, 0)})
+        for cart_item_id in sorted(self.touched_item_ids()):
+            events.append({'type': 'item_added' if cart_item_id in self.created_items else 'item_updated',
+                           'item': cart_item_id, 'prod_id': self.prod_ids.get(cart_item_id),
+                           'delta': self.deltas.get(cart_item_id, 0)})
+        return events
+
+    def apply(self, document):
+        """Patch the cached document in place; returns ``False`` if it turns out to be stale."""
+        if self.cart_data is not None:
+            snapshot.apply_cart(document, self.cart_data)
+
+        for cart_item_id in self.removed_items:
+            removed = snapshot.drop_item(document, cart_item_id)
+            if removed is not None:
+                self.removed_items[cart_item_id] = removed
+
+        for cart_item_id, item_data in self.items.items():
+            existing = snapshot.find_item(document, cart_item_id)
+            if existing is None and cart_item_id not in self.created_items:
+                return False
+            item_options = existing['item_options'] if existing else []
+            item_data = {**item_data, 'item_options': item_options}
+            if existing is not None and cart_item_id in self.quantity_deltas:
+                # add to what the cache holds rather than overwrite it: flushes of concurrent
+                # requests can arrive in any order, and each one only knows its own change
+                item_data['quantity'] = existing['quantity'] + self.quantity_deltas[cart_item_id]
+            snapshot.apply_item(document, item_data)
+
+        for item_option_data in self.options.values():
+            cart_item_data = snapshot.find_item(document, item_option_data['cart_item_id'])
+            if cart_item_data is None:
+                if item_option_data['cart_item_id'] in self.removed_items:
+                    continue
+                return False
+            snapshot.apply_option(cart_item_data, item_option_data)
+
+        for item_option_data in self.removed_options.values():
+            cart_item_data = snapshot.find_item(document, item_option_data['cart_item_id'])
+            if cart_item_data is not None:
+                snapshot.drop_option(cart_item_data, item_option_data['id'])
+
+
+class CartUnitOfWork:
+    """
+    Collects cart mutations and writes every affected Redis document once.
+
+    Each recorded change is only staged when its DB transaction commits (via
+    ``transaction.on_commit``), so work rolled back in the database never reaches Redis.
+    """
+
+    def __init__(self):
+        self._changes = {}
+        self._after_flush = []
+
+    def after_flush(self, callback):
+        """Call ``callback()`` once this unit of work has written its changes to Redis (or failed to)."""
+        self._after_flush.append(callback)
+
+    def _stage(self, cart_id, get_cart, change):
+        def commit():
+            changes = self._changes.get(str(cart_id))
+            if changes is None:
+                changes = self._changes[str(cart_id)] = PendingCartChanges(cart_id)
+            if changes.get_cart is None:
+                changes.get_cart = get_cart
+            change(changes)
+
+        transaction.on_commit(commit)
+
+    def record_cart(self, cart, created=False):
+        cart_data = snapshot.serialize_cart(cart)
+
+        def change(changes):
+            changes.cart_data = cart_data
+            changes.created = changes.created or created
+
+        self._stage(cart.id, lambda: cart, change)
+
+    def record_item(self, cart_item, created=False):
+        item_data = snapshot.serialize_item(cart_item)
+        del item_data['item_options']
+        delta = cart_item.quantity - (0 if created else getattr(cart_item, '_saved_quantity', cart_item.quantity))
+
+        def change(changes):
+            changes.record_delta(item_data['id'], item_data['prod_id'], delta)
+            changes.items[item_data['id']] = item_data
+            changes.quantity_deltas.pop(item_data['id'], None)
+            if created:
+                changes.created_items.add(item_data['id'])
+
+        self._stage(cart_item.cart_id, lambda: cart_item.cart, change)
+
+    def record_quantity_change(self, cart_item, delta):
+        """Record that only ``cart_item.quantity`` changed, by ``delta``."""
+        item_data = snapshot.serialize_item(cart_item)
+        del item_data['item_options']
+
+        def change(changes):
+            changes.record_delta(item_data['id'], item_data['prod_id'], delta)
+            # if a full write of this item is already pending it carries the new quantity anyway
+            full_write_pending = item_data['id'] in changes.items and item_data['id'] not in changes.quantity_deltas
+            changes.items[item_data['id']] = item_data
+            if not full_write_pending:
+                changes.quantity_deltas[item_data['id']] = changes.quantity_deltas.get(item_data['id'], 0) + delta
+
+        self._stage(cart_item.cart_id, lambda: cart_item.cart, change)
+
+    def record_item_deleted(self, cart_item, cart_item_id):
+        # Django clears the primary key on delete, so the caller passes the old ID in
+        item_data = {"id": str(cart_item_id), "cart_id": str(cart_item.cart_id), "item_options": []}
+        quantity = getattr(cart_item, '_saved_quantity', cart_item.quantity)
+
+        def change(changes):
+            changes.record_delta(item_data['id'], cart_item.prod_id, -quantity)
+            changes.items.pop(item_data['id'], None)
+            changes.quantity_deltas.pop(item_data['id'], None)
+            changes.removed_items[item_data['id']] = item_data
+
+        self._stage(cart_item.cart_id, lambda: cart_item.cart, change)
+
+    def record_option(self, item_option):
+        item_option_data = snapshot.serialize_option(item_option)
+        prod_id = item_option.cart_item.prod_id
+
+        def change(changes):
+            changes.record_delta(item_option_data['cart_item_id'], prod_id, 0)
+            changes.options[item_option_data['id']] = item_option_data
+
+        self._stage(item_option.cart_item.cart_id, lambda: item_option.cart_item.cart, change)
+
+    def record_option_deleted(self, item_option, item_option_id):
+        item_option_data = {"id": str(item_option_id), "cart_item_id": str(item_option.cart_item_id)}
+        prod_id = item_option.cart_item.prod_id
+
+        def change(changes):
+            changes.record_delta(item_option_data['cart_item_id'], prod_id, 0)
+            changes.options.pop(item_option_data['id'], None)
+            changes.removed_options[item_option_data['id']] = item_option_data
+
+        self._stage(item_option.cart_item.cart_id, lambda: item_option.cart_item.cart, change)
+
+    def flush(self):
+        changes_by_cart, self._changes = self._changes, {}
+        callbacks, self._after_flush = self._after_flush, []
+        for changes in changes_by_cart.values():
+            try:
+                self._flush_cart(changes)
+            except redis.exceptions.ConnectionError as e:
+                logger.error(f"Error flushing cart {changes.cart_id} to Redis: {str(e)}")
+            except Exception as e:
+                logger.error(f"An error occurred while flushing cart {changes.cart_id} to Redis: {str(e)}")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"An error occurred after flushing carts to Redis: {str(e)}")
+
+    def _flush_cart(self, changes):
+        if changes.only_quantities_changed():
+            modified_at = max(item_data['modified_at'] for item_data in changes.items.values())
+            if store.increment_quantities(changes.cart_id, changes.quantity_deltas, modified_at, changes.events()):
+                logger.info(f"Cart with ID {changes.cart_id}: quantities incremented in Redis")
+                return
+
+        initial = dict(changes.cart_data) if changes.created else None
+
+        # one read of the cached cart, then every key update in a single MULTI/EXEC, retried
+        # if another flush changes the cart in between
+        store.watched_write(changes.cart_id, lambda pipe: self._write_cart(pipe, changes, initial))
+        logger.info(f"Cart with ID 'cart:main:{changes.cart_id}' flushed to Redis")
+
+    def _write_cart(self, pipe, changes, initial):
+        document = snapshot.patch_cart_document(
+            pipe, changes.cart_id, changes.apply,
+            rebuild=lambda: snapshot.build_cart_document(changes.get_cart()),
+            describe=changes.describe,
+            events=changes.events(),
+            initial=initial,
+            cart_item_ids=changes.touched_item_ids(),
+            # a live view: apply() swaps in the full documents of the items it drops
+            removed_cart_items=changes.removed_items.values(),
+        )
+
+        ttl = store.cart_ttl(document['user_id'])
+        for item_data in changes.removed_items.values():
+            store.delete_item(pipe, item_data)
+        for item_option_data in changes.removed_options.values():
+            store.delete_option(pipe, item_option_data)
+        for item_option_data in changes.options.values():
+            store.put_option(pipe, item_option_data, ttl)
+        for cart_item_id in changes.touched_item_ids():
+            cart_item_data = snapshot.find_item(document, cart_item_id)
+            if cart_item_data is not None:
+                store.put_item(pipe, cart_item_data, ttl)
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Gather cart mutations made inside the block and flush them to Redis once, on commit.
+
+    Nested blocks join the outermost one, so model methods can always open their own
+    block: on its own it flushes that single change, inside a request (see
+    ``CartUnitOfWorkMiddleware``) or an enclosing block it just records it.
+    Can also be used as a decorator.
+    """
+    uow = _active.get()
+    if uow is not None:
+        yield uow
+        return
+
+    uow = CartUnitOfWork()
+    token = _active.set(uow)
+    try:
+        yield uow
+    finally:
+        _active.reset(token)
+        transaction.on_commit(uow.flush)
+
+
+@asynccontextmanager
+async def async_unit_of_work():
+    """
+    ``unit_of_work`` for async code, such as a request served by an async view.
+
+    Sync code the block hands to a thread (``sync_to_async``) records into it. There is no
+    transaction open at this level, so the flush runs right away, in a thread as well.
+    """
+    uow = _active.get()
+    if uow is not None:
+        yield uow
+        return
+
+    uow = CartUnitOfWork()
+    token = _active.set(uow)
+    try:
+        yield uow
+    finally:
+        _active.reset(token)
+        if uow._changes or uow._after_flush:
+            await sync_to_async(uow.flush)()
+
+
+def after_flush(callback):
+    """
+    Call ``callback()`` once the current unit of work has flushed, or right away outside of
+    one, when whatever was recorded has been flushed already.
+    """
+    uow = _active.get()
+    if uow is None:
+        callback()
+    else:
+        uow.after_flush(callback)
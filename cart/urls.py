@@ -1,20 +1,34 @@
+from django.conf import settings
 from django.urls import path
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 from rest_framework import routers
 
-from . import views
+from . import async_views, views
 
 # ●	POST /carts: Creates a new cart for a user (guest or authenticated).
 # ●	GET /carts/all: List all available carts for admin management
 # ●	GET /carts/{cart_id}: Retrieves cart details by cart ID.
 # ●	GET /carts/user/{user_id}: Retrieves a user's cart.
+# ●	GET /carts/{cart_id}/changes?since={version}: What changed in a cart since a version.
 # ●	POST /carts/{cart_id}/items: Adds items to the cart.
+# ●	POST /carts/{cart_id}/items/bulk: Adds many items to the cart at once.
 # ●	GET /carts/{cart_id}/items/{item_id}: Retrieve an item from the cart.
 # ●	PUT /carts/{cart_id}/items/{item_id}: Updates the quantity of an item in the cart.
 # ●	DELETE /carts/{cart_id}/items/{item_id}: Removes an item from the cart.
 # ●	POST /carts/{cart_id}/checkout: Initiates the checkout process from the cart.
 # ●	DELETE /carts/{cart_id}/: Remove a cart entirely.
 
+if settings.CART_ASYNC_VIEWS:
+    retrieve_delete_cart_view = async_views.retrieve_delete_cart
+    retrieve_user_cart_view = async_views.retrieve_user_cart
+    add_cart_item_view = async_views.add_cart_item
+    cart_item_view = async_views.cart_item
+else:
+    retrieve_delete_cart_view = views.RetrieveDeleteCartView.as_view()
+    retrieve_user_cart_view = views.RetrieveUserCartView.as_view()
+    add_cart_item_view = views.AddCartItemView.as_view()
+    cart_item_view = views.RetrieveUpdateDestroyCartItemView.as_view()
+
 router = routers.DefaultRouter()
 router.register('carts/wishlist', views.WishlistView, basename='wishlist')
 
@@ -24,11 +38,12 @@ urlpatterns = [
     path('carts/all/', views.ListCartView.as_view(), name='cart.all'),
 
     path('carts/options/all/', views.ListOptionsView.as_view(), name='options.all'),
-    path('carts/<uuid:pk>/items/', views.AddCartItemView.as_view(), name='cart.item.add'),
-    path('carts/<uuid:pk>/', views.RetrieveDeleteCartView.as_view(), name='cart.retrieve.destroy'),
-    path('carts/user/<uuid:user_id>/', views.RetrieveUserCartView.as_view(), name='cart.user.retrieve'),
-    path('carts/<uuid:cart_id>/items/<int:pk>/', views.RetrieveUpdateDestroyCartItemView.as_view(),
-         name='cart.item.modify'),
+    path('carts/<uuid:pk>/items/', add_cart_item_view, name='cart.item.add'),
+    path('carts/<uuid:pk>/items/bulk/', views.BulkAddCartItemsView.as_view(), name='cart.item.bulk_add'),
+    path('carts/<uuid:pk>/', retrieve_delete_cart_view, name='cart.retrieve.destroy'),
+    path('carts/user/<uuid:user_id>/', retrieve_user_cart_view, name='cart.user.retrieve'),
+    path('carts/<uuid:pk>/changes/', views.CartChangesView.as_view(), name='cart.changes'),
+    path('carts/<uuid:cart_id>/items/<int:pk>/', cart_item_view, name='cart.item.modify'),
     path('carts/<guest_cart_id>/merge/<uuid:user_id>', views.MergeGuestAndAuthCartsView.as_view(), name='cart.merge'),
     path('carts/<uuid:pk>/checkout/', views.CartCheckoutView.as_view(), name='cart.checkout'),
 
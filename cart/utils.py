@@ -1,27 +1,23 @@
 import datetime
-import os
 import logging
-import json
 
-import redis
 from django.conf import settings
-
-from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
 from django.http import HttpResponse
+from django.utils import timezone
 
-from cart.models import CartItem, Cart
-
-redis_client = redis.StrictRedis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=os.getenv('REDIS_PORT', 6379),
-    db=0, password=os.getenv('REDIS_PASSWORD', ''))
+from cart import events, snapshot, store
+from cart.lines import item_signature, line_signature
+from cart.models import Cart, CartItem, ItemOption
+from cart.signals import update_cart
+from cart.unit_of_work import unit_of_work
 
 logger = logging.getLogger(__name__)
 
 
 def get_guest_cart_id(request):
     # guest_cart_id = request.COOKIES['guest_cart_id']
-    print('request.COOKIES ', request.COOKIES)
+    logger.debug(f"Guest cart cookie: {request.COOKIES.get('guest_cart_id')}")
     return None
 
 
@@ -32,130 +28,191 @@ def set_guest_cart_id(cart_id: str):
 
 
 def get_or_create_auth_cart(user_id: int):
-    redis_key = f'cart:user:{user_id}'
-    auth_cart_data = redis_client.get(redis_key)
-    print("auth_cart_data", json.loads(auth_cart_data.decode('utf-8')))
-
-    if auth_cart_data:
-        return json.loads(auth_cart_data.decode('utf-8'))
-
-    # If the cart doesn't exist in Redis, create a new cart
-    auth_cart = {
-        'user_id': user_id,
-        'cart_items': []
-    }
-
-    # Updated Redis key for the authenticated user's cart
-    redis_key = f'cart:user:{user_id}'
-    redis_client.set(redis_key, json.dumps(auth_cart))
-    return auth_cart
-
-
-def compare_dicts(ordered_dicts, array_of_dicts):
-    for od in ordered_dicts:
-        found = False
-        for ad in array_of_dicts:
-            if od['attribute'] == ad['attribute'] and od['value'] == ad['value']:
-                found = True
-                break
-        if not found:
-            return False
-    return True
-
+    auth_cart_data = store.load_user_cart_document(user_id)
+
+    # entries written before the user key became a pointer may be partial copies without an ID
+    if auth_cart_data and auth_cart_data.get('id'):
+        return auth_cart_data
+
+    # If the cart doesn't exist in Redis, create a new cart; saving it caches it and points the user key at it
+    cart = Cart.objects.filter(user_id=user_id).first() or Cart.objects.create(user_id=user_id)
+    return snapshot.build_cart_document(cart)
+
+
+def get_existing_cart_items_redis(cart, signatures):
+    """
+    The items of the already-loaded ``cart`` document that are the lines with the given
+    signatures, found through the cart's line index; returns ``{signature: item}``.
+    """
+    cart_item_ids, indexed = store.find_lines(cart['id'], list(signatures))
+    if not indexed and cart['cart_items']:
+        # cached before the line index existed: build it now and match by signature this once
+        with store.write_batch() as pipe:
+            store.put_lines(pipe, cart)
+            store.expire_cart(pipe, cart['id'], cart['user_id'])
+        return {
+            item_signature(cart_item_data): cart_item_data for cart_item_data in cart['cart_items']
+            if item_signature(cart_item_data) in signatures
+        }
+
+    items_by_id = {cart_item_data['id']: cart_item_data for cart_item_data in cart['cart_items']}
+    existing = {}
+    for signature, cart_item_id in zip(signatures, cart_item_ids):
+        cart_item_data = items_by_id.get(cart_item_id)
+        # the index can point at an item whose options changed since, or that is gone
+        if cart_item_data is not None and item_signature(cart_item_data) == signature:
+            logger.info(f"Cart Item with ID {cart_item_id} matches the current cart item")
+            existing[signature] = cart_item_data
+    return existing
+
+
+def get_existing_cart_item_redis(cart, prod_id, options_data):
+    signature = line_signature(prod_id, options_data)
+    return get_existing_cart_items_redis(cart, [signature]).get(signature)
+
+
+def get_existing_cart_items_db(cart, lines):
+    """
+    The same lookup against the database, the authority once the cart row is locked.
+
+    ``lines`` maps signatures to product IDs; returns ``{signature: item}``, reusing the
+    items of ``cart`` where it has them.
+    """
+    items_by_id = {cart_item_data['id']: cart_item_data for cart_item_data in cart['cart_items']}
+    cart_items = CartItem.objects.filter(cart_id=cart['id'], prod_id__in=set(lines.values()))
+    existing = {}
+    for cart_item in cart_items.prefetch_related('item_options'):
+        cart_item_data = snapshot.serialize_item(
+            cart_item, [snapshot.serialize_option(option) for option in cart_item.item_options.all()]
+        )
+        signature = item_signature(cart_item_data)
+        if signature in lines:
+            existing[signature] = items_by_id.get(cart_item_data['id'], cart_item_data)
+    return existing
+
+
+def get_existing_cart_item_db(cart, prod_id, options_data):
+    signature = line_signature(prod_id, options_data)
+    return get_existing_cart_items_db(cart, {signature: prod_id}).get(signature)
 
-def get_existing_cart_item_redis(cart, prod_id, options_data, user_id=None):
-    # Construct the Redis key based on the user_id
-    redis_key = f'cart:user:{user_id}' if user_id is not None else f'cart:main:{cart["id"]}'
 
-    # Retrieve cart data from Redis
-    cart_data_json = redis_client.get(redis_key)
-
-    if cart_data_json:
-        # If data is found, parse it from JSON
-        cart_data = json.loads(cart_data_json.decode('utf-8'))
-        logger.info(f'Cart detail: {cart_data} retrieved successfully')
-        cart_items = cart_data.get('cart_items', [])
-
-        logger.info(f'cart_items {cart_items} retrieved successfully')
-
-        for cart_item_data in cart_items:
-            logger.info(f'Cart Item: {cart_item_data}')
-            if cart_item_data['prod_id'] == prod_id:
-                options = cart_item_data.get('item_options', [])
-
-                is_cart_item_exist = compare_dicts(options_data, options)
+def merge_cart_items(cart, cart_item, quantity_to_add):
+    """
+    Add ``quantity_to_add`` to an existing line; returns ``False`` if the item is gone from the DB.
+
+    The row is locked for the read-add-write, so concurrent merges of the same line queue up
+    instead of overwriting each other, and the cache receives the change as a delta.
+    """
+    with transaction.atomic():
+        try:
+            db_item = CartItem.objects.select_for_update().get(id=cart_item['id'])
+        except CartItem.DoesNotExist:
+            logger.warning(f"Cart Item with ID {cart_item['id']} not found in DB, Redis left untouched")
+            return False
+        db_item.quantity += quantity_to_add
+        db_item.save(update_fields=['quantity', 'modified_at'])
 
-                if is_cart_item_exist:
-                    logger.info(f"Cart with ID {cart_item_data['id']} matches the current cart item")
-                    return cart_item_data
-            else:
-                continue
-    return None
+    logger.info(f"New CartItem quantity = {db_item.quantity} after adding {quantity_to_add}")
 
+    # Keep the caller's copy of the cart in step with what the DB now holds
+    cart['total_quantity'] = cart.get('total_quantity', 0) + db_item.quantity - cart_item['quantity']
+    cart_item['quantity'] = db_item.quantity
+    return True
 
-def merge_cart_items(cart, cart_item, quantity_to_add):
-    # Update the quantity of the existing cart item
-    cart_item['quantity'] += quantity_to_add
 
-    # update the cart item count in the db too
-    try:
-        db_item = CartItem.objects.get(id=cart_item['id'])
-        db_item.quantity += quantity_to_add
-        db_item.save()
-        # print('total_quantity', Cart.objects.get(id=cart['id']).total_quantity)
-    except CartItem.DoesNotExist:
-        pass
-
-    logger.info(f"New CartItem quantity = {cart_item['quantity']} + {quantity_to_add}")
-
-    # Find the index of the cart_item in the cart_items list
-    for index, item in enumerate(cart['cart_items']):
-        if item['id'] == cart_item['id']:
-            # Replace the existing item with the updated item
-            cart['cart_items'][index] = cart_item
-            break
-    cart["total_quantity"] = Cart.objects.get(id=cart['id']).total_quantity
-
-    # print("cart ", cart)
-    # Save the updated cart data back to Redis
-    redis_user_key = f"cart:user:{cart['user_id']}" if cart["user_id"] else None
-    redis_cart_key = f"cart:main:{cart['id']}"
-    redis_cart_item_key = f"cart_item:main:{cart_item['id']}"
-    redis_cart_other_key = f"cart_item:cart:{cart['id']}:{cart_item['id']}"
-
-    if redis_user_key:
-        redis_client.set(redis_user_key, json.dumps(cart, cls=DjangoJSONEncoder))
-    redis_client.set(redis_cart_key, json.dumps(cart, cls=DjangoJSONEncoder))
-    redis_client.set(redis_cart_other_key, json.dumps(cart_item, cls=DjangoJSONEncoder))
-    redis_client.set(redis_cart_item_key, json.dumps(cart_item, cls=DjangoJSONEncoder))
-    logger.info(f"Cart with ID {cart['id']} saved to Redis successfully")
+def add_cart_items(cart, items_data):
+    """
+    Add many items to ``cart`` (a cart document) at once; returns the resulting lines' documents.
+
+    Items that are the same line are merged first. Then, in one transaction, existing
+    lines are found with one HMGET (confirmed by one query for the misses), locked and
+    bumped with a single ``bulk_update``, new lines and their options are inserted with
+    two ``bulk_create`` calls, and the cart counters get one F() update. Everything is
+    recorded in the unit of work, so Redis is written once.
+    """
+    lines = {}
+    for item_data in items_data:
+        item_options = item_data.get('item_options', [])
+        signature = line_signature(item_data['prod_id'], item_options)
+        if signature in lines:
+            lines[signature]['quantity'] += item_data['quantity']
+        else:
+            lines[signature] = {**item_data, 'item_options': item_options}
+
+    with transaction.atomic():
+        # adds to one cart queue up on its row, see CartItemSerializer.create
+        Cart.objects.select_for_update().only('id').get(id=cart['id'])
+
+        existing = get_existing_cart_items_redis(cart, list(lines))
+        missing = {signature: line['prod_id'] for signature, line in lines.items() if signature not in existing}
+        if missing:
+            existing.update(get_existing_cart_items_db(cart, missing))
+
+        signatures_by_id = {cart_item_data['id']: signature for signature, cart_item_data in existing.items()}
+        merged_items = list(CartItem.objects.select_for_update().filter(id__in=list(signatures_by_id)))
+        now = timezone.now()
+        for cart_item in merged_items:
+            cart_item.quantity += lines[signatures_by_id[str(cart_item.id)]]['quantity']
+            cart_item.modified_at = now
+        CartItem.objects.bulk_update(merged_items, ['quantity', 'modified_at'])
+
+        # lines matched above but deleted since are created like any other new line
+        merged_signatures = {signatures_by_id[str(cart_item.id)] for cart_item in merged_items}
+        new_signatures = [signature for signature in lines if signature not in merged_signatures]
+        new_items = CartItem.objects.bulk_create([
+            CartItem(
+                cart_id=cart['id'], prod_id=lines[signature]['prod_id'], quantity=lines[signature]['quantity'],
+                is_active=lines[signature].get('is_active', True),
+            )
+            for signature in new_signatures
+        ])
+        new_options = {
+            signature: [ItemOption(cart_item=cart_item, **option_data) for option_data in lines[signature]['item_options']]
+            for signature, cart_item in zip(new_signatures, new_items)
+        }
+        item_options = ItemOption.objects.bulk_create(
+            [item_option for item_options in new_options.values() for item_option in item_options]
+        )
+
+        # bulk writes skip the CartItem signals, so the counters are updated here, once
+        added_quantity = sum(lines[signatures_by_id[str(cart_item.id)]]['quantity'] for cart_item in merged_items)
+        added_quantity += sum(cart_item.counted_totals()[0] for cart_item in new_items)
+        update_cart(cart['id'], added_quantity, sum(cart_item.counted_totals()[1] for cart_item in new_items))
+
+        with unit_of_work() as uow:
+            for cart_item in merged_items:
+                uow.record_quantity_change(cart_item, lines[signatures_by_id[str(cart_item.id)]]['quantity'])
+            for cart_item in new_items:
+                uow.record_item(cart_item, created=True)
+            for item_option in item_options:
+                uow.record_option(item_option)
+
+    results = {}
+    for cart_item in merged_items:
+        signature = signatures_by_id[str(cart_item.id)]
+        results[signature] = snapshot.serialize_item(cart_item, existing[signature]['item_options'])
+    for signature, cart_item in zip(new_signatures, new_items):
+        results[signature] = snapshot.serialize_item(
+            cart_item, [snapshot.serialize_option(item_option) for item_option in new_options[signature]]
+        )
+    return [results[signature] for signature in lines]
 
 
 def get_cart_from_redis(cart_id=None, user_id=None):
-    cart_data_json = redis_client.get(f'cart:main:{cart_id}')
-    user_cart_data_json = redis_client.get(f'cart:user:{user_id}')
-    # print(cart_data_json, user_cart_data_json)
-
-    if cart_data_json:
+    cart_data = store.load_cart_document(cart_id) if cart_id else None
+    if cart_data:
         logger.info(f"Cart with ID {cart_id} retrieved from Redis successfully")
-        return json.loads(cart_data_json.decode('utf-8'))
-    elif user_cart_data_json:
+        return cart_data
+
+    user_cart_data = store.load_user_cart_document(user_id) if user_id else None
+    if user_cart_data:
         logger.info(f"Cart with User ID {user_id} retrieved from Redis successfully")
-        return json.loads(user_cart_data_json.decode('utf-8'))
+        return user_cart_data
     return None
 
 
-def delete_cart_from_redis(cart_id, user_id=None):
-    if user_id:
-        redis_user_key = f'cart:user:{user_id}'
-        redis_client.delete(redis_user_key)
-    redis_cart_key = f'cart:main:{cart_id}'
-    redis_client.delete(redis_cart_key)
+def delete_cart_from_redis(cart_id, user_id=None, cart_items=()):
+    with store.write_batch() as pipe:
+        store.delete_cart(pipe, cart_id, user_id, cart_items)
+        events.publish(pipe, cart_id, {'type': 'cart_deleted'})
     logger.info(f'Cart with ID {cart_id} deleted from Redis successfully')
-
-
-def delete_cart_item_from_redis(cart_item_id, cart_id=None):
-    if cart_id:
-        redis_client.delete(f'cart_item:cart:{cart_id}:{cart_item_id}')
-    redis_client.delete(f'cart_item:main:{cart_item_id}')
-    logger.info(f'Cart Item with ID {cart_item_id} deleted from Redis successfully')
@@ -1,102 +1,52 @@
-import os
 import json
 import logging
-import redis
-import requests
-from django.core.serializers.json import DjangoJSONEncoder
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404
 
 from rest_framework import generics
 from rest_framework import status
-from rest_framework.generics import GenericAPIView
+from rest_framework.generics import GenericAPIView, get_object_or_404
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
+from . import store
+from .checkout import price_cart
+from .conditional import cached_cart_response, if_match
+from .idempotency import idempotent
+from .listing import CART_INDEX_KEY, ITEM_OPTION_INDEX_KEY, IndexedDocuments
+from .merge import CartOwnershipError, merge_carts
 from .pagination import DefaultPagination
+from .products import ProductServiceError
+from .queries import carts_with_items
 from .serializers import CartSerializer, RetrieveCartSerializer, CartItemSerializer, \
-    CartItemQuantityUpdateSerializer, CustomItemOptionsSerializer, WishlistSerializer
+    CartItemQuantityUpdateSerializer, CustomItemOptionsSerializer, WishlistSerializer, CartItemRetrievalSerializer, \
+    BulkCartItemSerializer, CheckoutSummarySerializer, change_representation
 from .models import Cart, CartItem, ItemOption, Wishlist
-from .utils import get_or_create_auth_cart, set_guest_cart_id, \
-    delete_cart_from_redis, delete_cart_item_from_redis, get_cart_from_redis
-
-redis_client = redis.StrictRedis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=os.getenv('REDIS_PORT', 6379),
-    db=0, password=os.getenv('REDIS_PASSWORD', ''))
+from .snapshot import build_cart_document
+from .utils import get_or_create_auth_cart, delete_cart_from_redis
+from .warmup import warm_cart_after_miss
 
 logger = logging.getLogger(__name__)
 
 
-def get_all_carts_from_redis():
-    cart_keys = redis_client.keys('cart:user:*')
-    cart_keys.extend(redis_client.keys('cart:main:*'))
-    logger.info(f"Cart Keys {cart_keys} retrieved successfully")
-    carts = []
-    for cart_key in cart_keys:
-        cart_data_json = redis_client.get(cart_key)
-        if cart_data_json:
-            cart_data = json.loads(cart_data_json.decode('utf-8'))
-            carts.append(cart_data)
-    return carts
-
-
-def get_all_cart_items_from_redis():
-    cart_item_keys = redis_client.keys('cart_item:main:*')
-    logger.info(f"Cart Keys {cart_item_keys} retrieved successfully")
-    cart_items = []
-    for cart_item_key in cart_item_keys:
-        cart_item_data_json = redis_client.get(cart_item_key)
-        if cart_item_data_json:
-            cart_data = json.loads(cart_item_data_json.decode('utf-8'))
-            cart_items.append(cart_data)
-    return cart_items
-
-
-def get_all_options_from_redis():
-    item_option_keys = redis_client.keys('item_option:main:*')
-    logger.info(f"Option Keys {item_option_keys} retrieved successfully")
-    item_options = []
-    for item_key in item_option_keys:
-        option_data_json = redis_client.get(item_key)
-        if option_data_json:
-            option_data = json.loads(option_data_json.decode('utf-8'))
-            item_options.append(option_data)
-    return item_options
-
-
 class MergeGuestAndAuthCartsView(GenericAPIView):
     def post(self, request, user_id, guest_cart_id=''):
-        auth_cart = get_or_create_auth_cart(user_id)
-
-        if guest_cart_id:
-            guest_cart_data = redis_client.get(f'cart:main:{guest_cart_id}')
-            if guest_cart_data:
-                guest_cart = json.loads(guest_cart_data.decode('utf-8'))
-                guest_cart_items = guest_cart.get('cart_items', [])
-
-                if auth_cart:
-                    for guest_cart_item in guest_cart_items:
-                        existing_item = None
-                        for auth_cart_item in auth_cart['cart_items']:
-                            if (
-                                    guest_cart_item['prod_id'] == auth_cart_item['prod_id']
-                                    and guest_cart_item['item_options'] == auth_cart_item['item_options']
-                            ):
-                                existing_item = auth_cart_item
-                                break
-
-                        if existing_item:
-                            existing_item['quantity'] += guest_cart_item['quantity']
-                        else:
-                            auth_cart['cart_items'].append(guest_cart_item)
-                else:
-                    auth_cart['user_id'] = user_id
-                    set_guest_cart_id('')
-
-                redis_client.delete(f'cart:main:{guest_cart_id}')
-
-                # Update the authenticated cart in Redis
-                redis_client.set(f'cart:user:{user_id}', json.dumps(auth_cart))
-
+        if not guest_cart_id:
+            return Response(get_or_create_auth_cart(user_id), status=status.HTTP_200_OK)
+
+        try:
+            guest_cart_id = uuid.UUID(guest_cart_id)
+        except ValueError:
+            return Response({'detail': 'Invalid guest cart ID.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            auth_cart = merge_carts(guest_cart_id, user_id)
+        except CartOwnershipError as e:
+            logger.warning(f"Merge of cart {guest_cart_id} into the cart of user {user_id} refused: {e}")
+            return Response({'detail': 'Only a guest cart can be merged.'}, status=status.HTTP_409_CONFLICT)
         return Response(auth_cart, status=status.HTTP_200_OK)
 
 
@@ -110,7 +60,7 @@ class CreateUserCartView(generics.CreateAPIView):
     queryset = Cart.objects.all()
 
     def perform_create(self, serializer):
-        print('serializer ', serializer.validated_data)
+        logger.debug(f"Creating cart for {serializer.validated_data}")
         cart = serializer.save()
         if not serializer.validated_data['user_id']:
             self.request.session['guest_cart_id'] = cart.id
@@ -124,51 +74,55 @@ class WishlistView(ModelViewSet):
 
 class ListOptionsView(generics.ListAPIView):
     """
-    API View for listing all available carts for the benefit of the admin.
+    API View for listing all available item options for the benefit of the admin.
 
-    This view displays all carts.
+    This view displays one page of item options, read from the Redis option index.
     """
     serializer_class = CustomItemOptionsSerializer
-    queryset = ItemOption.objects.all()
+    pagination_class = DefaultPagination
+    queryset = ItemOption.objects.order_by('-created_at')
 
     def list(self, request, *args, **kwargs):
-        options = get_all_options_from_redis()  # Fetch all carts from Redis
+        options = IndexedDocuments(ITEM_OPTION_INDEX_KEY)
 
-        if not options:
+        if not options.count():
             logger.warning("Options retrieved from DB NOT from Redis")
-            options = self.get_queryset()  # If not found in Redis, fetch from the database
+            return super().list(request, *args, **kwargs)
 
-        serializer = self.get_serializer(options, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        page = self.paginate_queryset(options)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
 
 
 class ListCartView(generics.ListAPIView):
     """
     API View for listing all available carts for the benefit of the admin.
 
-    This view displays all carts.
+    This view displays one page of carts, read from the Redis cart index.
     """
     serializer_class = RetrieveCartSerializer
     pagination_class = DefaultPagination
-    queryset = Cart.objects.all()
+    queryset = carts_with_items(Cart.objects.order_by('-created_at'))
 
     def list(self, request, *args, **kwargs):
-        carts = get_all_carts_from_redis()  # Fetch all carts from Redis
+        carts = IndexedDocuments(CART_INDEX_KEY, load_many=store.load_cart_documents)
 
-        if not carts:
-            print('Carts retrieved from DB NOT from Redis')
+        if not carts.count():
             logger.warning("Carts retrieved from DB NOT from Redis")
-            carts = self.get_queryset()  # If not found in Redis, fetch from the database
+            return super().list(request, *args, **kwargs)
 
-            serializer = self.get_serializer(carts, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        return Response(carts, status=status.HTTP_200_OK)
+        return self.get_paginated_response(self.paginate_queryset(carts))
 
 
 class RetrieveDeleteCartView(generics.RetrieveDestroyAPIView):
     serializer_class = RetrieveCartSerializer
     queryset = Cart.objects.all()
 
+    def get_queryset(self):
+        if self.request.method == 'GET':
+            return carts_with_items()
+        return super().get_queryset()
+
     def get_serializer_class(self):
         if self.request.method == 'GET':
             logger.info("Method in 'GET' accessed from CartItemView")
@@ -177,35 +131,52 @@ class RetrieveDeleteCartView(generics.RetrieveDestroyAPIView):
 
     def retrieve(self, request, *args, **kwargs):
         cart_id = self.kwargs['pk']
+        if settings.CART_VIEW_CACHE:
+            # a cache hit is the stored body, sent without decoding or serializing anything
+            response = cached_cart_response(request, cart_id=cart_id)
+            if response is not None:
+                return response
+
         cart_data = self.get_user_id_from_redis(cart_id)
 
         if cart_data:
-            cart = self.get_user_id_from_redis(cart_id)['cart']  # Fetch cart data from Redis
-            print('Redis Cart Retrieval ', cart)
+            cart = cart_data['cart']  # Fetch cart data from Redis
         else:
             logger.warning(f"Cart with ID {self.kwargs['pk']} not found in Redis, checking DB")
+            # cached again from the DB, so the cart has an ETag to send with If-Match
+            if warm_cart_after_miss(cart_id) and settings.CART_VIEW_CACHE:
+                response = cached_cart_response(request, cart_id=cart_id)
+                if response is not None:
+                    return response
             cart = self.get_object()  # If not found in Redis, fetch from the database
 
         serializer = self.get_serializer(cart)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @if_match('pk')
     def delete(self, request, *args, **kwargs):
-        cart_id = self.kwargs['pk']
-        cart_data = self.get_user_id_from_redis(cart_id)  # Fetch cart data from Redis
-
-        if cart_data:
-            delete_cart_from_redis(cart_data['cart']['id'], cart_data['cart']['user_id'])
-        else:
-            logger.warning(f"Cart with ID {self.kwargs['pk']} not found in Redis, checking DB")
-            cart = self.get_object()  # If not found in Redis, fetch from the database
-            self.perform_destroy(cart)  # Perform delete operation
-
+        cart_id = str(self.kwargs['pk'])
+        cached = store.load_cart_document(cart_id, touch=False)
+
+        # the cart goes from both stores; the cascade does not call CartItem.delete, so the
+        # Redis copies of every item the DB or the cache knows about are removed here
+        with transaction.atomic():
+            cart = carts_with_items(Cart.objects.select_for_update().filter(pk=cart_id)).first()
+            if cart is None and cached is None:
+                raise Http404
+            document = build_cart_document(cart) if cart is not None else cached
+            if cart is not None:
+                cart.delete()
+
+        cart_items = {cart_item_data['id']: cart_item_data for cart_item_data in document['cart_items']}
+        for cart_item_data in (cached or {}).get('cart_items', []):
+            cart_items.setdefault(cart_item_data['id'], cart_item_data)
+        delete_cart_from_redis(cart_id, document['user_id'] or (cached or {}).get('user_id'), cart_items.values())
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_user_id_from_redis(self, cart_id):
-        cart_data_json = redis_client.get(f'cart:main:{cart_id}')
-        if cart_data_json:
-            cart_data = json.loads(cart_data_json.decode('utf-8'))
+        cart_data = store.load_cart_document(cart_id)
+        if cart_data:
             return {
                 'user_id': cart_data.get('user_id'),
                 'cart': cart_data,
@@ -220,22 +191,81 @@ class RetrieveUserCartView(generics.RetrieveAPIView):
     This View allows you to retrieve and update details of individual order items.
     """
     serializer_class = RetrieveCartSerializer
-    queryset = Cart.objects.all()
+    queryset = carts_with_items()
     lookup_field = 'user_id'
 
     def retrieve(self, request, *args, **kwargs):
-        cart_data_json = redis_client.get(f"cart:user:{self.kwargs['user_id']}")
+        if settings.CART_VIEW_CACHE:
+            response = cached_cart_response(request, user_id=self.kwargs['user_id'])
+            if response is not None:
+                return response
 
-        if cart_data_json:
-            cart = json.loads(cart_data_json.decode('utf-8'))
-        else:
+        cart = store.load_user_cart_document(self.kwargs['user_id'])
+
+        if not cart:
             logger.warning(f"Cart with ID {self.kwargs['user_id']} not found in Redis, checking DB")
+            cart_id = Cart.objects.filter(user_id=self.kwargs['user_id']).values_list('pk', flat=True).first()
+            if cart_id is not None and warm_cart_after_miss(cart_id) and settings.CART_VIEW_CACHE:
+                response = cached_cart_response(request, cart_id=cart_id)
+                if response is not None:
+                    return response
             cart = self.get_object()  # If not found in Redis, fetch from the database
 
         serializer = self.get_serializer(cart)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+class CartChangesView(GenericAPIView):
+    """
+    ``GET /carts/{id}/changes/?since={version}``: what changed in the cart after the version a
+    client last read (its ETag), so the client can patch its copy instead of reading the whole
+    cart again.
+
+    The changes come from the cart's change log (see ``store.load_changes``) as item adds,
+    updates, removes and new quantities. When the log cannot bridge from ``since``, the
+    response carries the whole cart as ``snapshot`` instead.
+    """
+    queryset = carts_with_items()
+
+    def get(self, request, pk):
+        since = store.parse_cart_version(request.query_params.get('since', ''))
+        if since is None:
+            return Response({'detail': 'since must be a cart version.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        version, changes = store.load_changes(pk, since)
+        if changes is None:
+            return self.snapshot(pk, since, version)
+        data = {
+            'cart_id': str(pk), 'version': version, 'since': since,
+            'changes': [change_representation(change) for change in changes],
+        }
+        return Response(data, status=status.HTTP_200_OK, headers={'ETag': store.cart_etag(version)})
+
+    def snapshot(self, pk, since, version):
+        cart = None
+        if settings.CART_VIEW_CACHE:
+            etag, body = store.load_cart_view(pk)
+            if body is None:
+                etag, body = store.cache_cart_view(pk) or (None, None)
+            if body is not None:
+                cart, version = json.loads(body), int(etag.strip('"'))
+        if cart is None:
+            # every change is an absolute value, so a version read before the cart only
+            # makes the client apply again what it already has
+            document = store.load_cart_document(pk)
+            if document is None:
+                logger.warning(f"Cart with ID {pk} not found in Redis, checking DB")
+                document = self.get_object()
+                version = None
+                # cached again, so the read counts as an access for the expiry sweep
+                warm_cart_after_miss(pk)
+            cart = RetrieveCartSerializer(document).data
+
+        data = {'cart_id': str(pk), 'version': version, 'since': since, 'snapshot': cart}
+        headers = {'ETag': store.cart_etag(version)} if version is not None else None
+        return Response(data, status=status.HTTP_200_OK, headers=headers)
+
+
 class AddCartItemView(generics.CreateAPIView):
     """
     API View for adding cart item to cart.
@@ -245,6 +275,30 @@ class AddCartItemView(generics.CreateAPIView):
     serializer_class = CartItemSerializer
     queryset = CartItem.objects.all()
 
+    @idempotent
+    @if_match('pk')
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
+    def get_serializer_context(self):
+        return {'cart_id': self.kwargs['pk']}
+
+
+class BulkAddCartItemsView(generics.CreateAPIView):
+    """
+    API View for adding many cart items to a cart at once.
+
+    Used to restore saved carts, "buy again" and offline sync: the items are merged with each
+    other and with the cart's existing lines and written in one transaction and one Redis flush.
+    """
+    serializer_class = BulkCartItemSerializer
+    queryset = CartItem.objects.all()
+
+    @idempotent
+    @if_match('pk')
+    def post(self, request, *args, **kwargs):
+        return super().post(request, *args, **kwargs)
+
     def get_serializer_context(self):
         return {'cart_id': self.kwargs['pk']}
 
@@ -257,6 +311,11 @@ class RetrieveUpdateDestroyCartItemView(generics.RetrieveUpdateDestroyAPIView):
     """
     queryset = CartItem.objects.all()
 
+    def get_queryset(self):
+        if self.request.method in ['PUT', 'PATCH']:
+            return super().get_queryset().select_for_update()
+        return super().get_queryset()
+
     def get_serializer_class(self):
         if self.request.method in ['PUT', 'PATCH']:
             logger.info("Method in ['PUT', 'PATCH'] accessed from CartItemView")
@@ -268,110 +327,79 @@ class RetrieveUpdateDestroyCartItemView(generics.RetrieveUpdateDestroyAPIView):
 
         if not cart_item_data:
             logger.warning(f"Cart with ID {self.kwargs['pk']} not found in Redis, checking DB")
-            print(f"Cart with ID {self.kwargs['pk']} not found in Redis, checking DB")
+            logger.debug(f"Cart with ID {self.kwargs['pk']} not found in Redis, checking DB")
             cart_item_data = self.get_object()  # If not found in Redis, fetch from the database
+            # cached again, so the read counts as an access for the expiry sweep
+            warm_cart_after_miss(self.kwargs['cart_id'])
 
         serializer = self.get_serializer(cart_item_data)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-    def update(self, request, *args, **kwargs):
-        # Get the cart item to update
-        cart_item_data = self.get_cart_item_from_redis(kwargs['cart_id'], kwargs['pk'])
-        cart_data = get_cart_from_redis(kwargs['cart_id'])
+    @idempotent
+    @if_match('cart_id')
+    def put(self, request, *args, **kwargs):
+        return super().put(request, *args, **kwargs)
 
-        if not cart_item_data:
-            logger.warning(f"Cart Item with ID {kwargs['pk']} not found in Redis, checking DB")
-            cart_item_data = self.get_object()  # If not found in Redis, fetch from the database
+    @idempotent
+    @if_match('cart_id')
+    def patch(self, request, *args, **kwargs):
+        return super().patch(request, *args, **kwargs)
 
+    def update(self, request, *args, **kwargs):
         # Update the cart item with the new data
         serializer = self.get_serializer(data=request.data, partial=True)
 
         if serializer.is_valid():
-            # Serialize the data to JSON before saving to Redis
-            serialized_data = serializer.data
-
-            # Redis keys
-            redis_cart_item_key = f"cart_item:main:{kwargs['pk']}"
-            redis_cart_other_key = f"cart_item:cart:{kwargs['cart_id']}:{kwargs['pk']}"
-            redis_user_key = f"cart:user:{cart_data['user_id']}" if cart_data["user_id"] else None
-            redis_cart_key = f"cart:main:{cart_data['id']}"
-
-            cart_item_data['quantity'] = serialized_data['quantity']
-            # effect the change in the db
-            try:
-                db_item = CartItem.objects.get(id=cart_item_data['id'])
-                db_item.quantity = serialized_data['quantity']
-                db_item.save()
-            except CartItem.DoesNotExist:
-                pass
-
-            # update the cart itself in Redis
-            if cart_data:
-                for index, item in enumerate(cart_data['cart_items']):
-                    if item['id'] == cart_item_data['id']:
-                        # Replace the existing item with the updated item
-                        cart_data['cart_items'][index] = cart_item_data
-                        break
-                cart_data["total_quantity"] = Cart.objects.get(id=cart_data['id']).total_quantity
-
-            print("serialized_data['quantity']: ", serialized_data['quantity'])
-
-            # Save the serialized data to Redis
-            if redis_user_key:
-                redis_client.set(redis_user_key, json.dumps(cart_data, cls=DjangoJSONEncoder))
-            redis_client.set(redis_cart_key, json.dumps(cart_data, cls=DjangoJSONEncoder))
-            redis_client.set(redis_cart_other_key, json.dumps(cart_item_data))
-            redis_client.set(redis_cart_item_key, json.dumps(cart_item_data))
+            # the DB row is the source of truth; a quantity-only save becomes a counter increment in Redis.
+            # It is locked so the delta sent to Redis is computed against the quantity actually replaced.
+            with transaction.atomic():
+                cart_item = self.get_object()
+                cart_item.quantity = serializer.validated_data.get('quantity', cart_item.quantity)
+                cart_item.save(update_fields=['quantity', 'modified_at'])
 
             logger.info(f"Cart with ID {kwargs['pk']} saved to Redis successfully")
 
-            return Response(cart_item_data, status=status.HTTP_200_OK)
+            return Response(CartItemRetrievalSerializer(cart_item).data, status=status.HTTP_200_OK)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @idempotent
+    @if_match('cart_id')
     def delete(self, request, *args, **kwargs):
-        cart_id = self.kwargs['cart_id']
-        cart_item_id = self.kwargs['pk']
-
-        cart_item_data = self.get_cart_item_from_redis(cart_id, cart_item_id)
-
-        if cart_item_data:
-            delete_cart_item_from_redis(cart_item_id, cart_id)
-        else:
-            logger.warning(f"Cart Item with ID {self.kwargs['pk']} not found in Redis, checking DB")
-            cart = self.get_object()  # If not found in Redis, fetch from the database
-            self.perform_destroy(cart)  # Perform delete operation
+        # CartItem.delete drops the item from the cached cart and removes its Redis keys
+        cart_item = self.get_object()
+        self.perform_destroy(cart_item)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_cart_item_from_redis(self, cart_id, cart_item_id):
-        cart_item_data_other_json = redis_client.get(f'cart_item:cart:{cart_id}:{cart_item_id}')
-        cart_item_data_json = redis_client.get(f'cart_item:main:{cart_item_id}')
-
-        if cart_item_data_json:
-            cart_item_data = json.loads(cart_item_data_json.decode('utf-8'))
-        elif cart_item_data_other_json:
-            cart_item_data = json.loads(cart_item_data_other_json.decode('utf-8'))
-        else:
-            return None
-        return cart_item_data
+        return store.load_item_document(cart_id, cart_item_id)
 
 
 class CartCheckoutView(generics.CreateAPIView):
-    def create(self, request, *args, **kwargs):
-        # Retrieve cart items and user information from the request
-        cart_items = request.data.get('cart_items', [])
-        user_id = request.data.get('user_id')
-
-        # Step 2: Check product availability and pricing (interact with Product Service)
-        product_ids = [item['product_id'] for item in cart_items]
-
-        # Step 3: Calculate the total price based on product prices and quantities
-
-        # Step 4: Process the payment (interact with Payment Service)
-        # payment_result = PaymentService.process_payment(user_id, total_price)
-
-        # Step 5: If payment is successful, create an order (interact with Order Service)
-
-        # If any step fails, handle the error accordingly
-        return Response({'message': 'Checkout failed'}, status=status.HTTP_400_BAD_REQUEST)
+    serializer_class = CheckoutSummarySerializer
+
+    @idempotent
+    def create(self, request, pk, *args, **kwargs):
+        cart = store.load_cart_document(pk)
+        if cart is None:
+            cart = build_cart_document(get_object_or_404(Cart, id=pk))
+            # cached again, so the read counts as an access for the expiry sweep
+            warm_cart_after_miss(pk)
+        if not any(cart_item['is_active'] for cart_item in cart['cart_items']):
+            return Response({'message': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            summary = price_cart(cart)
+        except ProductServiceError as e:
+            logger.error(f"Checkout of cart {pk} failed: {e}")
+            return Response({'message': 'Product service unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        data = self.get_serializer(summary).data
+        if summary['unavailable']:
+            logger.info(f"Checkout of cart {pk} blocked: {len(summary['unavailable'])} lines unavailable")
+            return Response(data, status=status.HTTP_409_CONFLICT)
+
+        # Payment and order creation (Payment/Order services) follow from this priced summary.
+        logger.info(f"Cart {pk} priced for checkout: {summary['total_price']} for {summary['total_quantity']} items")
+        return Response(data, status=status.HTTP_200_OK)
@@ -0,0 +1,166 @@
+import json
+import logging
+import threading
+import uuid
+
+import redis
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . import snapshot, store
+from .connection import redis_client
+from .models import Cart
+from .queries import carts_with_items
+
+logger = logging.getLogger(__name__)
+
+WARMUP_LOCK_KEY = 'cart:warmup:lock'
+
+
+def warmup_checkpoint_key(shard, shards):
+    return f'cart:warmup:checkpoint:{shard}:{shards}'
+
+
+def shard_bounds(shard, shards):
+    """
+    The ``(low, high)`` bounds, both inclusive, of the cart IDs in ``shard`` out of ``shards``;
+    ``high`` is ``None`` for the last shard.
+
+    Cart IDs are random UUIDs, so equal slices of the UUID space hold about as many carts
+    each, and a range filter on the primary key needs no extra index.
+    """
+    space = 1 << 128
+    low = uuid.UUID(int=space * shard // shards)
+    high = uuid.UUID(int=space * (shard + 1) // shards - 1) if shard + 1 < shards else None
+    return low, high
+
+
+def carts_to_warm(shard=0, shards=1, modified_since=None, after=None):
+    """
+    The shard's carts, most recently modified first, from ``after`` (a ``(modified_at, id)``
+    checkpoint) on. Ordered and resumed by ``(modified_at, id)``, so each batch is a range scan.
+    """
+    low, high = shard_bounds(shard, shards)
+    carts = Cart.objects.filter(pk__gte=low)
+    if high is not None:
+        carts = carts.filter(pk__lte=high)
+    if modified_since is not None:
+        carts = carts.filter(modified_at__gte=modified_since)
+    if after is not None:
+        modified_at, cart_id = after
+        carts = carts.filter(Q(modified_at__lt=modified_at) | Q(modified_at=modified_at, pk__lt=cart_id))
+    return carts.order_by('-modified_at', '-pk')
+
+
+def warm_carts(cart_ids):
+    """
+    Cache the given carts from the DB and return how many were written.
+
+    The carts, their items and their options are loaded in three queries, and every key of
+    the batch is written in one MULTI/EXEC. Carts that are already cached are skipped, and
+    their keys are WATCHed, so a request that caches a cart while the batch is being written
+    makes the batch retry without it rather than be overwritten with an older copy.
+    """
+    if not cart_ids:
+        return 0
+    documents = [snapshot.build_cart_document(cart) for cart in carts_with_items(Cart.objects.filter(pk__in=cart_ids))]
+    layout = store.get_layout()
+
+    def write(pipe):
+        # the keys are WATCHed by now, so checking them on another connection is still safe
+        check = redis_client.pipeline(transaction=False)
+        for document in documents:
+            check.exists(layout.key(document['id']))
+        missing = [document for document, cached in zip(documents, check.execute()) if not cached]
+        pipe.multi()
+        for document in missing:
+            ttl = store.cart_ttl(document['user_id'])
+            store.put_cart(pipe, document)
+            for cart_item_data in document['cart_items']:
+                store.put_item(pipe, cart_item_data, ttl)
+                for item_option_data in cart_item_data['item_options']:
+                    store.put_option(pipe, item_option_data, ttl)
+        return len(missing)
+
+    return redis_client.transaction(write, *[layout.key(document['id']) for document in documents],
+                                    value_from_callable=True)
+
+
+def warm_cart_after_miss(cart_id):
+    """
+    Cache a cart that a read had to fetch from the DB, so it has a version (and an ETag for
+    ``If-Match``) again and the next reads hit Redis. Being cached again also counts as an
+    access for the expiry sweep. Returns ``False`` when Redis could not be reached; the error
+    is logged rather than raised, since the read can still be served from the DB.
+    """
+    try:
+        warm_carts([cart_id])
+    except redis.RedisError as e:
+        logger.warning(f"Caching cart {cart_id} after a cache miss failed: {e}")
+        return False
+    return True
+
+
+def load_checkpoint(shard, shards):
+    raw = redis_client.get(warmup_checkpoint_key(shard, shards))
+    if not raw:
+        return None
+    modified_at, cart_id = json.loads(raw)
+    return parse_datetime(modified_at), cart_id
+
+
+def save_checkpoint(shard, shards, modified_at, cart_id):
+    # full microsecond precision: resuming from a rounded timestamp could skip carts
+    redis_client.set(warmup_checkpoint_key(shard, shards), json.dumps([modified_at.isoformat(), str(cart_id)]),
+                     ex=settings.CART_WARMUP_CHECKPOINT_TTL)
+
+
+def warm_cache(shard=0, shards=1, batch_size=500, modified_since=None, limit=None, resume=True, progress=None):
+    """
+    Warm the shard's carts in batches of ``batch_size``, most recently modified first.
+
+    After each batch the position is saved in Redis, so a run that is stopped picks up where
+    it left off; ``resume=False`` starts over. Each of ``shards`` processes warms its own
+    slice of the carts. ``progress(warmed, written)`` is called after every batch. Returns
+    ``(warmed, written)``: carts read from the DB and carts that were not cached yet.
+    """
+    after = load_checkpoint(shard, shards) if resume else None
+    warmed = written = 0
+    while limit is None or warmed < limit:
+        size = batch_size if limit is None else min(batch_size, limit - warmed)
+        batch = list(carts_to_warm(shard, shards, modified_since, after).values_list('modified_at', 'pk')[:size])
+        if not batch:
+            redis_client.delete(warmup_checkpoint_key(shard, shards))
+            break
+        written += warm_carts([cart_id for _, cart_id in batch])
+        warmed += len(batch)
+        after = batch[-1]
+        save_checkpoint(shard, shards, *after)
+        if progress is not None:
+            progress(warmed, written)
+    return warmed, written
+
+
+def start_warmup_on_startup():
+    """
+    Warm the ``CART_WARMUP_ON_STARTUP_LIMIT`` most recently modified carts in a background thread.
+
+    Only the process that takes the ``cart:warmup:lock`` key does it, so a fleet of workers
+    booting together warms the cache once. Serving is never delayed.
+    """
+    limit = settings.CART_WARMUP_ON_STARTUP_LIMIT
+
+    def run():
+        try:
+            if not redis_client.set(WARMUP_LOCK_KEY, 1, nx=True, ex=settings.CART_WARMUP_LOCK_TTL):
+                return
+            warmed, written = warm_cache(limit=limit, resume=False)
+            logger.info(f"Startup warm-up cached {written} of the {warmed} most recent carts")
+        except Exception as e:
+            logger.error(f"Startup cache warm-up failed: {e}")
+        finally:
+            connection.close()
+
+    threading.Thread(target=run, name='cart-warmup', daemon=True).start()
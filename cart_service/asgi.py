@@ -9,8 +9,16 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cart_service.settings')
+# the hot cart endpoints have async variants; serve them unless told otherwise
+os.environ.setdefault('CART_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
+
+if settings.CART_WARMUP_ON_STARTUP:
+    from cart.warmup import start_warmup_on_startup
+
+    start_warmup_on_startup()
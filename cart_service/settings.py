@@ -2,6 +2,7 @@ import os
 
 import dj_database_url
 import dotenv
+from corsheaders.defaults import default_headers
 
 from pathlib import Path
 
@@ -45,11 +46,9 @@ INSTALLED_APPS = [
     'django_extensions',
     'drf_spectacular',
     'rest_framework',
-    "debug_toolbar",
 ]
 
 MIDDLEWARE = [
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
@@ -58,8 +57,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'cart.middleware.CartUnitOfWorkMiddleware',
 ]
 
+# The toolbar is only routed in development (see cart_service/urls.py). Its middleware is
+# sync-only and would make every request under ASGI switch to a thread and back.
+if os.getenv('DEBUG'):
+    INSTALLED_APPS.append("debug_toolbar")
+    MIDDLEWARE.insert(0, "debug_toolbar.middleware.DebugToolbarMiddleware")
+
 ROOT_URLCONF = 'cart_service.urls'
 
 TEMPLATES = [
@@ -144,6 +150,8 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOWED_ORIGIN_REGEXES = ['127.0.0.1', 'http://fixamalb-676692095.eu-north-1.elb.amazonaws.com/']
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key', 'if-none-match', 'if-match')
+CORS_EXPOSE_HEADERS = ['Idempotent-Replayed', 'ETag']
 
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
@@ -174,17 +182,117 @@ LOGGING = {
 }
 
 
+# Every Redis user in the project (the cart modules and CACHES/sessions) shares one
+# process-wide BlockingConnectionPool built from these settings, see cart/connection.py.
+REDIS = {
+    'HOST': os.getenv('REDIS_HOST', 'localhost'),
+    'PORT': int(os.getenv('REDIS_PORT', 6379)),
+    'DB': int(os.getenv('REDIS_DB', 0)),
+    'PASSWORD': os.getenv('REDIS_PASSWORD', ''),
+    'MAX_CONNECTIONS': int(os.getenv('REDIS_MAX_CONNECTIONS', 20)),
+    'POOL_TIMEOUT': float(os.getenv('REDIS_POOL_TIMEOUT', 2)),
+    'SOCKET_CONNECT_TIMEOUT': float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', 1)),
+    'SOCKET_TIMEOUT': float(os.getenv('REDIS_SOCKET_TIMEOUT', 1)),
+    'RETRY_ATTEMPTS': int(os.getenv('REDIS_RETRY_ATTEMPTS', 3)),
+    'RETRY_BACKOFF_BASE': float(os.getenv('REDIS_RETRY_BACKOFF_BASE', 0.05)),
+    'RETRY_BACKOFF_CAP': float(os.getenv('REDIS_RETRY_BACKOFF_CAP', 0.5)),
+    'HEALTH_CHECK_INTERVAL': int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+}
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', 6379)}",
+        "LOCATION": f"redis://{REDIS['HOST']}:{REDIS['PORT']}/{REDIS['DB']}",
         "OPTIONS": {
-            "PASSWORD": os.getenv('REDIS_PASSWORD', ''),
+            "PASSWORD": REDIS['PASSWORD'],
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
     }
 }
 
+DJANGO_REDIS_CONNECTION_FACTORY = 'cart.connection.SharedPoolConnectionFactory'
+
+# Encoding of cached cart documents: 'json' (readable, the original format) or 'msgpack'
+# (compact, versioned binary). Either codec reads entries written by the other.
+CART_CACHE_CODEC = os.getenv('CART_CACHE_CODEC', 'json')
+
+# How carts are laid out in Redis: 'document' (one encoded blob per cart) or 'hash' (one hash
+# per cart with a field and a quantity counter per item). Switch with `manage.py migrate_cart_layout`.
+CART_STORAGE_LAYOUT = os.getenv('CART_STORAGE_LAYOUT', 'document')
+
+# Cached carts expire after this many seconds without being read or written; each access
+# renews the TTL, at most once per CART_TTL_REFRESH_INTERVAL. 0 keeps carts forever.
+# `manage.py sweep_expired_carts` deletes expired carts from the DB. Every cart key has a TTL,
+# so Redis can also run with maxmemory-policy volatile-ttl to evict the carts nearest expiry first.
+# A cart read from the DB because it was not in Redis is cached again, which counts as an access.
+GUEST_CART_TTL = int(os.getenv('GUEST_CART_TTL', 7 * 24 * 60 * 60))
+USER_CART_TTL = int(os.getenv('USER_CART_TTL', 30 * 24 * 60 * 60))
+CART_TTL_REFRESH_INTERVAL = int(os.getenv('CART_TTL_REFRESH_INTERVAL', 60 * 60))
+
+# `manage.py warm_cart_cache` refills Redis from the DB after a flush or failover and saves its
+# position for CART_WARMUP_CHECKPOINT_TTL seconds. With CART_WARMUP_ON_STARTUP, one server process
+# also warms the CART_WARMUP_ON_STARTUP_LIMIT most recently modified carts in the background.
+CART_WARMUP_ON_STARTUP = os.getenv('CART_WARMUP_ON_STARTUP', '0') == '1'
+CART_WARMUP_ON_STARTUP_LIMIT = int(os.getenv('CART_WARMUP_ON_STARTUP_LIMIT', 50000))
+CART_WARMUP_LOCK_TTL = int(os.getenv('CART_WARMUP_LOCK_TTL', 10 * 60))
+CART_WARMUP_CHECKPOINT_TTL = int(os.getenv('CART_WARMUP_CHECKPOINT_TTL', 24 * 60 * 60))
+
+# With CART_VIEW_CACHE, every write of a cart also stores its rendered GET response under
+# cart:view:{id}, and reads of a cached cart return those bytes with the cart's version
+# (cart:version:{id}) as the ETag.
+CART_VIEW_CACHE = os.getenv('CART_VIEW_CACHE', '1') == '1'
+
+# A write sent with If-Match holds its cart (cart:claim:{id}) until its changes reach Redis, or
+# for at most CART_WRITE_CLAIM_TTL seconds; other If-Match writes to the cart get 409 meanwhile.
+CART_WRITE_CLAIM_TTL = int(os.getenv('CART_WRITE_CLAIM_TTL', 30))
+
+# Every version of a cached cart is also logged under cart:changes:{id}, a stream capped at
+# CART_CHANGE_LOG_LENGTH entries, from which GET /carts/{id}/changes/ serves what changed
+# since a version a client already has.
+CART_CHANGE_LOG_LENGTH = int(os.getenv('CART_CHANGE_LOG_LENGTH', 100))
+
+# With CART_EVENTS, every cart change is also published to the cart:events stream (see
+# cart/events.py) for other services to consume; the stream keeps about CART_EVENTS_MAXLEN entries.
+CART_EVENTS = os.getenv('CART_EVENTS', '1') == '1'
+CART_EVENTS_MAXLEN = int(os.getenv('CART_EVENTS_MAXLEN', 100000))
+
+# With CART_ASYNC_VIEWS, cart and user cart reads, item adds and quantity updates are served by
+# the async views in cart/async_views.py. cart_service/asgi.py turns it on by default.
+CART_ASYNC_VIEWS = os.getenv('CART_ASYNC_VIEWS', '0') == '1'
+
+# Product service used to price carts at checkout. BATCH fetches many products per request
+# (GET {BASE_URL}/products/?ids=a,b,c); otherwise products are fetched one per request
+# (GET {BASE_URL}/products/{id}/), at most MAX_CONCURRENCY at a time. TIMEOUT bounds the
+# whole lookup, not each request. Point CLIENT at cart.products.FakeProductClient to run
+# without the service.
+PRODUCT_SERVICE = {
+    'CLIENT': os.getenv('PRODUCT_SERVICE_CLIENT', 'cart.products.HTTPProductClient'),
+    'OPTIONS': {
+        'base_url': os.getenv('PRODUCT_SERVICE_URL', 'http://localhost:8001/api/v1'),
+        'timeout': float(os.getenv('PRODUCT_SERVICE_TIMEOUT', 2)),
+        'max_concurrency': int(os.getenv('PRODUCT_SERVICE_MAX_CONCURRENCY', 8)),
+        'batch': os.getenv('PRODUCT_SERVICE_BATCH', '1') == '1',
+        'batch_size': int(os.getenv('PRODUCT_SERVICE_BATCH_SIZE', 100)),
+    },
+    # Product info is cached in process for LOCAL_TTL seconds and in Redis for REDIS_TTL
+    # seconds; unknown products for NEGATIVE_TTL seconds. Prices can be up to
+    # LOCAL_TTL + REDIS_TTL seconds stale.
+    'CACHE': {
+        'ENABLED': os.getenv('PRODUCT_CACHE_ENABLED', '1') == '1',
+        'LOCAL_TTL': float(os.getenv('PRODUCT_CACHE_LOCAL_TTL', 30)),
+        'LOCAL_MAXSIZE': int(os.getenv('PRODUCT_CACHE_LOCAL_MAXSIZE', 10000)),
+        'REDIS_TTL': int(os.getenv('PRODUCT_CACHE_REDIS_TTL', 300)),
+        'NEGATIVE_TTL': int(os.getenv('PRODUCT_CACHE_NEGATIVE_TTL', 10)),
+        'STATS_INTERVAL': float(os.getenv('PRODUCT_CACHE_STATS_INTERVAL', 60)),
+    },
+}
+
+# Responses to requests sent with an Idempotency-Key header are replayed to retries for
+# IDEMPOTENCY_KEY_TTL seconds. A key is reserved for at most IDEMPOTENCY_LOCK_TTL seconds
+# while its first request runs.
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_LOCK_TTL = int(os.getenv('IDEMPOTENCY_LOCK_TTL', 30))
+
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
 
@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cart_service.settings')
 
 application = get_wsgi_application()
+
+if settings.CART_WARMUP_ON_STARTUP:
+    from cart.warmup import start_warmup_on_startup
+
+    start_warmup_on_startup()